@@ -1,14 +1,124 @@
+import asyncio
 import logging
-import time
 from pyclash import clash
+from pyclash.registry import SqliteJobRegistry, SUBMITTED, FINISHED
 
 from airflow.models import BaseOperator
 from airflow.exceptions import AirflowException
 from airflow.plugins_manager import AirflowPlugin
 from airflow.utils.decorators import apply_defaults
 
+try:
+    from airflow.triggers.base import BaseTrigger, TriggerEvent
+except ImportError:  # deferring tasks requires Airflow 2.2
+    BaseTrigger = object
+    TriggerEvent = None
+
 log = logging.getLogger(__name__)
 
+
+def submission_key(context):
+    """ Identifies the jobs of a task instance across its retries """
+    ti = context["ti"]
+    return f"{ti.dag_id}.{ti.task_id}.{ti.execution_date.isoformat()}"
+
+
+def previous_submission(registry, key, context):
+    """ Returns the records of a previous try which can be reattached """
+    if registry is None or context["ti"].try_number <= 1:
+        return []
+    records = registry.group_members(key)
+    if any(r["status"] == SUBMITTED for r in records) and all(
+        r["status"] in (SUBMITTED, FINISHED) for r in records
+    ):
+        return records
+    return []
+
+
+def rerun_since(context):
+    """ The start of the DAG run, since group names are reused across runs """
+    return context["dag_run"].start_date.timestamp()
+
+
+def open_registry(registry_path):
+    return SqliteJobRegistry(registry_path) if registry_path else None
+
+
+class ClashJobTrigger(BaseTrigger):
+    """
+    Waits for Clash jobs in the triggerer (instead of a worker slot).
+
+    Fires once all jobs have published their result and their VMs have
+    removed their instance groups, so that the resumed task can clean up
+    right away. The event contains the states and results of the jobs.
+    """
+
+    def __init__(self, states, results=None, poll_interval=30):
+        super().__init__()
+        self.states = states
+        self.results = results or [None] * len(states)
+        self.poll_interval = poll_interval
+
+    def serialize(self):
+        return (
+            "clash_plugin.ClashJobTrigger",
+            {
+                "states": self.states,
+                "results": self.results,
+                "poll_interval": self.poll_interval,
+            },
+        )
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        jobs = [
+            clash.Job.from_state(state, result=result)
+            for state, result in zip(self.states, self.results)
+        ]
+        try:
+            # the client libraries block, so they run in the default executor
+            while any(job.result is None for job in jobs):
+                for job in jobs:
+                    if job.result is None:
+                        await loop.run_in_executor(None, job.poll)
+                if any(job.result is None for job in jobs):
+                    await asyncio.sleep(self.poll_interval)
+
+            pending = list(jobs)
+            while pending:
+                for job in list(pending):
+                    if not await loop.run_in_executor(None, job.has_instance_group):
+                        pending.remove(job)
+                if pending:
+                    await asyncio.sleep(self.poll_interval)
+        except Exception as e:
+            log.exception("Could not wait for the Clash jobs")
+            yield TriggerEvent({"status": "error", "message": str(e)})
+            return
+
+        yield TriggerEvent(
+            {
+                "status": "success",
+                "states": [job.state() for job in jobs],
+                "results": [job.result for job in jobs],
+            }
+        )
+
+
+def complete_jobs(event, registry):
+    """ Recreates the jobs of a trigger event and records their results """
+    if event["status"] != "success":
+        raise AirflowException(f"Waiting for Clash failed: {event['message']}")
+
+    jobs = []
+    for state, result in zip(event["states"], event["results"]):
+        job = clash.Job.from_state(state, registry=registry, result=result)
+        if registry:
+            registry.record(job.state(), FINISHED, result)
+        jobs.append(job)
+    return jobs
+
+
 class ComputeEngineJobOperator(BaseOperator):
     template_fields = ("args", "cmd_file")
     ui_color = "#ceebff"
@@ -23,20 +133,46 @@ class ComputeEngineJobOperator(BaseOperator):
         env_vars={},
         gcs_target={},
         gcs_mounts={},
-        *args,
-        **kwargs
+        gcs_inputs={},
+        registry_path=None,
+        **kwargs,
     ):
         self.job = clash.Job(job_config=job_config, name_prefix=name_prefix)
+        self.registry_path = registry_path
 
         self.args = args
         self.cmd_file = cmd_file
         self.env_vars = env_vars
         self.gcs_target = gcs_target
         self.gcs_mounts = gcs_mounts
+        self.gcs_inputs = gcs_inputs
 
-        super(ComputeEngineJobOperator, self).__init__(*args, **kwargs)
+        super(ComputeEngineJobOperator, self).__init__(**kwargs)
 
     def execute(self, context):
+        self._start(context)
+        self._complete(self.job.attach())
+
+    def _start(self, context):
+        """ Submits the job or reattaches to the one of the previous try """
+        registry = open_registry(self.registry_path)
+        key = submission_key(context)
+        previous = previous_submission(registry, key, context)
+        if previous:
+            log.info("Reattaching to the Clash Job of the previous try...")
+            self.job = clash.Job.from_state(
+                previous[0]["state"], registry=registry, result=previous[0]["result"]
+            )
+        else:
+            self._submit(registry, key)
+
+    def _submit(self, registry, key):
+        if registry:
+            # record the job under the task instance (see previous_submission)
+            self.job.registry = registry
+            self.job.group = key
+            self.job.group_index = 0
+
         log.info("Running Clash Job...")
         if self.cmd_file:
             self.job.run_file(
@@ -44,6 +180,7 @@ class ComputeEngineJobOperator(BaseOperator):
                 env_vars=self.env_vars,
                 gcs_target=self.gcs_target,
                 gcs_mounts=self.gcs_mounts,
+                gcs_inputs=self.gcs_inputs,
             )
         elif self.args:
             self.job.run(
@@ -51,14 +188,13 @@ class ComputeEngineJobOperator(BaseOperator):
                 env_vars=self.env_vars,
                 gcs_target=self.gcs_target,
                 gcs_mounts=self.gcs_mounts,
+                gcs_inputs=self.gcs_inputs,
             )
         else:
             raise AirflowException("No command was given")
 
-        result = self.job.attach()
-
-        # workaround: wait for the instance to clean up resources
-        time.sleep(180)
+    def _complete(self, result):
+        # waits until the VM has removed its instance group
         self.job.clean_up()  # clean up remaining resources
 
         if result["status"] != 0:
@@ -67,31 +203,115 @@ class ComputeEngineJobOperator(BaseOperator):
             )
 
 
+class DeferrableComputeEngineJobOperator(ComputeEngineJobOperator):
+    """
+    Submits the job and releases the worker slot while it runs.
+
+    Requires Airflow 2.2 (and a running triggerer).
+    """
+
+    @apply_defaults
+    def __init__(self, poll_interval=30, **kwargs):
+        self.poll_interval = poll_interval
+        super(DeferrableComputeEngineJobOperator, self).__init__(**kwargs)
+
+    def execute(self, context):
+        self._start(context)
+        self.defer(
+            trigger=ClashJobTrigger(
+                [self.job.state()], [self.job.result], self.poll_interval
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event):
+        self.job = complete_jobs(event, open_registry(self.registry_path))[0]
+        self._complete(self.job.result)
+
+
 class ComputeEngineJobGroupOperator(BaseOperator):
     ui_color = "#99d4ff"
 
     @apply_defaults
-    def __init__(self, name, job_factory, runtime_specs, *args, **kwargs):
+    def __init__(self, name, job_factory, runtime_specs, registry_path=None, **kwargs):
         self.group = clash.JobGroup(name=name, job_factory=job_factory)
         for spec in runtime_specs:
             self.group.add_job(spec)
-        super(ComputeEngineJobGroupOperator, self).__init__(*args, **kwargs)
+        self.registry_path = registry_path
+        super(ComputeEngineJobGroupOperator, self).__init__(**kwargs)
 
     def execute(self, context):
-        self.group.run()
-        result = self.group.wait()
+        self._start(context, subscribe=True)
+        self._complete(self.group.wait())
 
-        # workaround: wait for the instances to clean up resources
-        time.sleep(180)
+    def _start(self, context, subscribe):
+        """
+        Runs the group or, on retries with a registry, only the members which
+        failed or are missing (members of the previous try which are still
+        running are reattached)
+        """
+        registry = self._open_registry()
+        if registry and context["ti"].try_number > 1:
+            resubmitted = self.group.rerun_failed(
+                subscribe=subscribe, since=rerun_since(context)
+            )
+            log.info(f"Resubmitted the members {resubmitted} of the Clash Job Group")
+        else:
+            self.group.run(subscribe=subscribe)
+
+    def _open_registry(self):
+        registry = open_registry(self.registry_path)
+        if registry:
+            self.group.registry = registry
+            self.group.job_factory.registry = registry
+        return registry
+
+    def _complete(self, succeeded):
+        # waits until the VMs have removed their instance groups
         self.group.clean_up()  # clean up remaining resources
 
-        if not result:
+        if not succeeded:
             raise AirflowException("The command failed")
 
 
+class DeferrableComputeEngineJobGroupOperator(ComputeEngineJobGroupOperator):
+    """
+    Submits the jobs of the group and releases the worker slot while they run.
+
+    Requires Airflow 2.2 (and a running triggerer).
+    """
+
+    @apply_defaults
+    def __init__(self, poll_interval=30, **kwargs):
+        self.poll_interval = poll_interval
+        super(DeferrableComputeEngineJobGroupOperator, self).__init__(**kwargs)
+
+    def execute(self, context):
+        self._start(context, subscribe=False)
+        # the failed members of previous tries are complete, so clean them up now
+        for job in self.group.replaced_jobs:
+            job.clean_up()
+        self.defer(
+            trigger=ClashJobTrigger(
+                [job.state() for job in self.group.running_jobs],
+                [job.result for job in self.group.running_jobs],
+                self.poll_interval,
+            ),
+            method_name="execute_complete",
+        )
+
+    def execute_complete(self, context, event):
+        self.group.running_jobs = complete_jobs(event, self._open_registry())
+        self._complete(
+            all(job.result["status"] == 0 for job in self.group.running_jobs)
+        )
+
+
 class ClashPlugin(AirflowPlugin):
     name = "clash_plugin"
     operators = [
         ComputeEngineJobOperator,
-        ComputeEngineJobGroupOperator
+        ComputeEngineJobGroupOperator,
+        DeferrableComputeEngineJobOperator,
+        DeferrableComputeEngineJobGroupOperator,
     ]
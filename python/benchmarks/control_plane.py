@@ -0,0 +1,190 @@
+"""
+Control-plane benchmarks for Clash.
+
+Runs Job.run / attach / clean_up and JobGroup.run / wait / clean_up against
+the in-process fake of GCE and PubSub and reports the wall time, the API
+calls by method, the peak number of threads and the peak memory.
+
+    python -m benchmarks.control_plane --sizes 1,10,100,1000,5000 --latency 0.005
+"""
+
+import argparse
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from pyclash import clash
+from pyclash.ratelimit import RateLimitedCloudSdk
+
+from benchmarks.fake_cloud import FakeCloud
+
+JOB_CONFIG = clash.JobConfigBuilder().project_id("benchmark-project").build()
+
+
+class ThreadSampler:
+    """ Samples the number of active threads in the background """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = threading.active_count()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            self.peak = max(self.peak, threading.active_count() - 1)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+
+@contextmanager
+def measure(result, phase):
+    start = time.perf_counter()
+    yield
+    result["wall_seconds"][phase] = round(time.perf_counter() - start, 4)
+
+
+def bench_jobs(gcloud, size):
+    """ Runs, attaches to and cleans up single jobs """
+    result = {"wall_seconds": {}, "failures": 0}
+    jobs = []
+    with measure(result, "run"):
+        for _ in range(size):
+            job = clash.Job(JOB_CONFIG, gcloud=gcloud)
+            try:
+                job.run(args=["echo", "hello"])
+                jobs.append(job)
+            except Exception:
+                result["failures"] += 1
+
+    with measure(result, "attach"):
+        for job in jobs:
+            try:
+                job.attach(timeout_seconds=60)
+            except Exception:
+                result["failures"] += 1
+
+    with measure(result, "clean_up"):
+        for job in jobs:
+            try:
+                job.clean_up()
+            except Exception:
+                result["failures"] += 1
+    return result
+
+
+def bench_group(gcloud, size):
+    """ Runs, waits for and cleans up a job group """
+    result = {"wall_seconds": {}, "failures": 0}
+    group = clash.JobGroup("benchmark", clash.JobFactory(JOB_CONFIG, gcloud=gcloud))
+    for i in range(size):
+        group.add_job(clash.JobRuntimeSpec(args=["echo", str(i)]))
+
+    try:
+        with measure(result, "run"):
+            group.run()
+        with measure(result, "wait"):
+            group.wait()
+        with measure(result, "clean_up"):
+            group.clean_up()
+    except Exception:
+        result["failures"] += 1
+    return result
+
+
+SCENARIOS = {"jobs": bench_jobs, "group": bench_group}
+
+
+def run_scenario(name, size, options):
+    gcloud = FakeCloud(
+        latency=options.latency,
+        error_rate=options.error_rate,
+        job_duration=options.job_duration,
+        seed=options.seed,
+    )
+    client = RateLimitedCloudSdk(gcloud) if options.rate_limited else gcloud
+    if options.memory:
+        tracemalloc.start()
+    try:
+        with ThreadSampler() as threads:
+            start = time.perf_counter()
+            result = SCENARIOS[name](client, size)
+            result["wall_seconds"]["total"] = round(time.perf_counter() - start, 4)
+        if options.memory:
+            result["peak_memory_bytes"] = tracemalloc.get_traced_memory()[1]
+    finally:
+        if options.memory:
+            tracemalloc.stop()
+        gcloud.close()
+
+    result.update(
+        {
+            "scenario": name,
+            "size": size,
+            "api_calls": dict(sorted(gcloud.calls.items())),
+            "api_calls_total": sum(gcloud.calls.values()),
+            "injected_errors": sum(gcloud.errors.values()),
+            "peak_threads": threads.peak,
+        }
+    )
+    if options.rate_limited:
+        result["client_metrics"] = client.metrics.snapshot()
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="1,10,100,1000,5000")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per call")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--job-duration", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument(
+        "--rate-limited",
+        action="store_true",
+        help="wraps the fake in a RateLimitedCloudSdk",
+    )
+    parser.add_argument("--no-memory", dest="memory", action="store_false")
+    parser.add_argument("--output", help="writes the results as JSON lines")
+    options = parser.parse_args(argv)
+
+    # the fake answers immediately, so there is no need to wait between polls
+    clash.Job.POLLING_INTERVAL_SECONDS = 1
+    clash.Job.PLACEMENT_POLLING_INTERVAL_SECONDS = 0
+
+    results = []
+    for size in map(int, options.sizes.split(",")):
+        for name in options.scenarios.split(","):
+            result = run_scenario(name, size, options)
+            results.append(result)
+            sys.stdout.write(
+                "{scenario:>6} {size:>5}: {total:>9.3f}s {calls:>7} calls "
+                "{threads:>5} threads {memory:>12} bytes {failures} failures\n".format(
+                    scenario=name,
+                    size=size,
+                    total=result["wall_seconds"]["total"],
+                    calls=result["api_calls_total"],
+                    threads=result["peak_threads"],
+                    memory=result.get("peak_memory_bytes", "-"),
+                    failures=result["failures"],
+                )
+            )
+
+    if options.output:
+        with open(options.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+""" An in-process fake of the GCE and PubSub clients used by Clash """
+
+import heapq
+import itertools
+import random
+import threading
+import time
+from collections import Counter
+
+from pyclash.local import InMemoryCloud
+
+
+class FakeApiError(Exception):
+    """ An injected API error (e.g. 503 or 429) """
+
+    def __init__(self, method, code):
+        super().__init__(f"Injected error {code} in {method}")
+        self.method = method
+        self.code = code
+
+
+class Scheduler:
+    """ Runs delayed callbacks on a single thread (instead of one timer per VM) """
+
+    def __init__(self):
+        self._events = []
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def call_later(self, delay, callback):
+        with self._condition:
+            heapq.heappush(
+                self._events, (time.time() + delay, next(self._counter), callback)
+            )
+            self._condition.notify()
+
+    def stop(self):
+        """ Drops the pending callbacks and ends the thread """
+        with self._condition:
+            self._stopped = True
+            self._events.clear()
+            self._condition.notify()
+        self._thread.join()
+
+    def _loop(self):
+        while True:
+            with self._condition:
+                while not self._stopped and (
+                    not self._events or self._events[0][0] > time.time()
+                ):
+                    timeout = self._events[0][0] - time.time() if self._events else None
+                    self._condition.wait(timeout)
+                if self._stopped:
+                    return
+                _, _, callback = heapq.heappop(self._events)
+            callback()
+
+
+class FakeCloud(InMemoryCloud):
+    """
+    Stands in for pyclash.clash.CloudSdk.
+
+    Every API call is counted by method, delayed by the configured latency and
+    fails with the configured probability. A MIG insert starts a simulated VM,
+    which publishes a status message after job_duration seconds and then
+    removes its instance group and topic (like the EXIT trap of the runner).
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        error_rate=0.0,
+        error_code=503,
+        job_duration=0.0,
+        exit_code=0,
+        seed=None,
+    ):
+        super().__init__()
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.job_duration = job_duration
+        self.exit_code = exit_code
+
+        self.calls = Counter()
+        self.errors = Counter()
+        self._random = random.Random(seed)
+        self.scheduler = Scheduler()
+
+    def close(self):
+        """ Stops the simulated VMs and the threads of the fake """
+        self.scheduler.stop()
+        self.shutdown()
+
+    def _call(self, method):
+        with self._lock:
+            self.calls[method] += 1
+            failed = self.error_rate and self._random.random() < self.error_rate
+            if failed:
+                self.errors[method] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if failed:
+            raise FakeApiError(method, self.error_code)
+
+    def _start(self, project, zone, name, template_name):
+        self._add_instance_group(project, zone, name, running=True)
+        result = {"status": self.exit_code, "logs": "", "timings": {}}
+        self.scheduler.call_later(
+            self.job_duration, lambda: self._finish(project, zone, name, result)
+        )
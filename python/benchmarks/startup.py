@@ -0,0 +1,111 @@
+"""
+Startup benchmarks for Clash.
+
+Measures the wall time of importing pyclash.clash and of running
+`clash --help` in fresh interpreters and reports which of the heavy GCP
+client libraries were imported on the way.
+
+    python -m benchmarks.startup --runs 10
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+# the client libraries which CloudSdk imports on first use
+HEAVY_MODULES = [
+    "googleapiclient.discovery",
+    "google.cloud.pubsub_v1",
+    "google.cloud.logging",
+    "grpc",
+]
+
+SCENARIOS = {
+    "import": "import pyclash.clash",
+    "cli_help": (
+        "from pyclash.cli import cli\n"
+        "try:\n"
+        "    cli(['--help'])\n"
+        "except SystemExit:\n"
+        "    pass"
+    ),
+}
+
+REPORT_MODULES = (
+    "\nimport json, sys\n"
+    "sys.stderr.write(json.dumps([m for m in {modules} if m in sys.modules]))"
+)
+
+
+def run_scenario(name, runs):
+    code = SCENARIOS[name]
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, "-c", code], stdout=subprocess.DEVNULL, check=True
+        )
+        durations.append(time.perf_counter() - start)
+
+    process = subprocess.run(
+        [sys.executable, "-c", code + REPORT_MODULES.format(modules=HEAVY_MODULES)],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        check=True,
+    )
+    heavy_modules = json.loads(process.stderr.decode().splitlines()[-1])
+
+    # the interpreter itself takes a while to start, so report it separately
+    return {
+        "scenario": name,
+        "runs": runs,
+        "median_seconds": round(statistics.median(durations), 4),
+        "min_seconds": round(min(durations), 4),
+        "heavy_modules": heavy_modules,
+    }
+
+
+def interpreter_startup(runs):
+    durations = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        durations.append(time.perf_counter() - start)
+    return round(statistics.median(durations), 4)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--output", help="writes the results as JSON lines")
+    options = parser.parse_args(argv)
+
+    baseline = interpreter_startup(options.runs)
+    sys.stdout.write(f"{'python':>8}: {baseline:>7.3f}s\n")
+
+    results = []
+    for name in options.scenarios.split(","):
+        result = run_scenario(name, options.runs)
+        result["interpreter_seconds"] = baseline
+        results.append(result)
+        sys.stdout.write(
+            "{scenario:>8}: {median:>7.3f}s (min {min:.3f}s) heavy modules: {modules}\n".format(
+                scenario=name,
+                median=result["median_seconds"],
+                min=result["min_seconds"],
+                modules=", ".join(result["heavy_modules"]) or "-",
+            )
+        )
+
+    if options.output:
+        with open(options.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+""" Disk images with pre-pulled Docker images, which speed up the start of jobs """
+
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+import time
+import uuid
+
+import jinja2
+
+from pyclash.clash import CloudSdk, MANAGED_LABEL, DEFAULT_JOB_CONFIG
+
+logger = logging.getLogger(__name__)
+
+# the images which the runner of every job pulls (see clash_runner.sh.j2)
+HELPER_IMAGES = ["google/cloud-sdk:228.0.0-alpine", "google/cloud-sdk:228.0.0"]
+
+DEFAULT_TIMEOUT_SECONDS = 60 * 60
+
+# the lines which the VM writes to its serial console (see bake-init.yaml.j2)
+REPORT_PREFIX = "clash-bake: "
+
+
+class BakeError(Exception):
+    """ Raised if the VM could not pull the images """
+
+
+class ImageBaker:
+    """
+    Bakes disk images: a VM boots the base image (Container-Optimized OS by
+    default), pulls the Docker images and shuts down. Its disk becomes an
+    image of the given family, which jobs can use with
+    JobConfigBuilder().baked_image(family).
+
+    The runner still pulls the job image, but only the layers which changed
+    since the bake. If the image changed, the result of the job has a
+    baked_digest which differs from its image_digest (and a warning is
+    logged), so the family should be baked again.
+    """
+
+    POLLING_INTERVAL_SECONDS = 10
+
+    def __init__(
+        self,
+        project_id: str,
+        zone: str,
+        subnetwork: str,
+        gcloud: Optional[CloudSdk] = None,
+        machine_type: str = "n1-standard-1",
+        boot_disk_size_gb: int = 100,
+        service_account: str = "default",
+        base_image: Optional[Dict[str, str]] = None,
+    ):
+        self.template_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(
+                searchpath=os.path.join(os.path.dirname(__file__), "templates")
+            )
+        )
+        self.project_id = project_id
+        self.zone = zone
+        self.subnetwork = subnetwork
+        self.gcloud = gcloud or CloudSdk()
+        self.machine_type = machine_type
+        self.boot_disk_size_gb = boot_disk_size_gb
+        self.service_account = service_account
+        self.base_image = base_image or DEFAULT_JOB_CONFIG["disk_image"]
+
+    def bake(
+        self, images: List[str], family: str, timeout_seconds=DEFAULT_TIMEOUT_SECONDS
+    ) -> Dict[str, Any]:
+        """
+        Creates a disk image of the family with the images (and the helper
+        images of the runner) and returns its name, family and the digests
+        of the images
+        """
+        images = list(dict.fromkeys(images + HELPER_IMAGES))
+        vm_name = f"clash-bake-{str(uuid.uuid1())[0:8]}"
+        compute = self.gcloud.get_compute_client()
+        try:
+            self._create_vm(compute, vm_name, images)
+            digests = self._wait_for_bake(compute, vm_name, timeout_seconds)
+            image_name = f"{family}-{int(time.time())}"
+            operation = (
+                compute.images()
+                .insert(
+                    project=self.project_id,
+                    body={
+                        "name": image_name,
+                        "family": family,
+                        "sourceDisk": f"zones/{self.zone}/disks/{vm_name}",
+                        "description": json.dumps({"images": digests}),
+                        "labels": {MANAGED_LABEL: "true"},
+                    },
+                )
+                .execute()
+            )
+            self._wait_for_operation(compute.globalOperations(), operation["name"])
+            return {"name": image_name, "family": family, "images": digests}
+        finally:
+            try:
+                compute.instances().delete(
+                    project=self.project_id, zone=self.zone, instance=vm_name
+                ).execute()
+            except Exception as e:
+                logger.warning(f"Could not remove VM {vm_name}. Message: {e}")
+
+    def _create_vm(self, compute, vm_name, images):
+        source_image = (
+            compute.images()
+            .getFromFamily(
+                project=self.base_image["project"], family=self.base_image["family"]
+            )
+            .execute()["selfLink"]
+        )
+        region = self.zone.rsplit("-", 1)[0]
+        user_data = self.template_env.get_template("bake-init.yaml.j2").render(
+            images=images
+        )
+        operation = (
+            compute.instances()
+            .insert(
+                project=self.project_id,
+                zone=self.zone,
+                body={
+                    "name": vm_name,
+                    "machineType": f"zones/{self.zone}/machineTypes/{self.machine_type}",
+                    "disks": [
+                        {
+                            # the image is created before the VM is removed
+                            "autoDelete": True,
+                            "boot": True,
+                            "initializeParams": {
+                                "sourceImage": source_image,
+                                "diskSizeGb": str(self.boot_disk_size_gb),
+                            },
+                        }
+                    ],
+                    "networkInterfaces": [
+                        {
+                            "subnetwork": f"projects/{self.project_id}/regions/"
+                            f"{region}/subnetworks/{self.subnetwork}"
+                        }
+                    ],
+                    "serviceAccounts": [
+                        {
+                            "email": self.service_account,
+                            "scopes": [
+                                "https://www.googleapis.com/auth/devstorage.read_only"
+                            ],
+                        }
+                    ],
+                    "metadata": {"items": [{"key": "user-data", "value": user_data}]},
+                    "labels": {MANAGED_LABEL: "true"},
+                },
+            )
+            .execute()
+        )
+        self._wait_for_operation(
+            compute.zoneOperations(), operation["name"], zone=self.zone
+        )
+
+    def _wait_for_bake(self, compute, vm_name, timeout_seconds):
+        """ Waits for the VM to shut down and returns the digests of the images """
+        start_time = time.time()
+        while time.time() - start_time <= timeout_seconds:
+            instance = (
+                compute.instances()
+                .get(project=self.project_id, zone=self.zone, instance=vm_name)
+                .execute()
+            )
+            if instance["status"] == "TERMINATED":
+                return self._read_report(compute, vm_name)
+            time.sleep(ImageBaker.POLLING_INTERVAL_SECONDS)
+        raise TimeoutError(f"Baking took longer than {timeout_seconds} seconds")
+
+    def _read_report(self, compute, vm_name):
+        output = (
+            compute.instances()
+            .getSerialPortOutput(
+                project=self.project_id, zone=self.zone, instance=vm_name, port=1
+            )
+            .execute()["contents"]
+        )
+        digests = {}
+        done = False
+        for line in output.splitlines():
+            if not line.startswith(REPORT_PREFIX):
+                continue
+            report = line[len(REPORT_PREFIX) :].split()
+            if report[:1] == ["pulled"] and len(report) == 3:
+                digests[report[1]] = report[2]
+            done = done or report == ["done"]
+        if not done:
+            raise BakeError(f"VM {vm_name} could not pull the images")
+        return digests
+
+    def _wait_for_operation(self, operations, operation, zone=None):
+        args = {"project": self.project_id, "operation": operation}
+        if zone:
+            args["zone"] = zone
+        while True:
+            result = operations.get(**args).execute()
+            if result["status"] == "DONE":
+                if "error" in result:
+                    raise BakeError(result["error"])
+                return
+            time.sleep(ImageBaker.POLLING_INTERVAL_SECONDS)
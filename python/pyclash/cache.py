@@ -0,0 +1,294 @@
+""" Results of previous runs which identical jobs can reuse """
+
+from typing import Any, Dict, List, Optional
+import hashlib
+import io
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from pyclash.clash import is_not_found
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join("~", ".clash", "results.db")
+DEFAULT_TTL_SECONDS = 7 * 24 * 60 * 60
+DEFAULT_MAX_ENTRIES = 10000
+
+
+def is_pinned(image: str) -> bool:
+    """ True if the image is referenced by its digest (tags are mutable) """
+    return "@sha256:" in image
+
+
+def input_generations(storage, gcs_inputs: Dict[str, Any]) -> List[List[str]]:
+    """
+    Returns the path and generation of every object below the gcs_inputs.
+
+    A generation changes whenever an object is overwritten, so the list
+    identifies the exact inputs of a run.
+    """
+    generations = []
+    for source in sorted(gcs_inputs):
+        bucket, _, prefix = source.partition("/")
+        page_token = None
+        while True:
+            response = (
+                storage.objects()
+                .list(
+                    bucket=bucket,
+                    prefix=prefix,
+                    pageToken=page_token,
+                    fields="items(name,generation),nextPageToken",
+                )
+                .execute()
+            )
+            generations += [
+                [f"{bucket}/{item['name']}", str(item["generation"])]
+                for item in response.get("items", [])
+            ]
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                break
+    return generations
+
+
+class ResultCache:
+    """
+    Stores the results of successful jobs by a hash of their inputs.
+
+    Subclasses implement the storage. An entry is a dictionary with the keys
+    job (the name of the job which produced the result, e.g. to find its
+    logs), result (its status message), gcs_target (its outputs) and created.
+    Entries expire after ttl_seconds.
+    """
+
+    def __init__(self, ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.ttl_seconds = ttl_seconds
+
+    def key(
+        self,
+        job_config: Dict[str, Any],
+        script: str,
+        env_vars: Dict[str, str],
+        gcs_target: Dict[str, str],
+        gcs_mounts: Dict[str, str],
+        gcs_inputs: Dict[str, Any],
+        gcloud=None,
+    ) -> Optional[str]:
+        """
+        Returns the key of a run or None if its result cannot be reused.
+
+        Only jobs with an image which is pinned by digest and without
+        gcs_mounts (which are read while the job runs) are cached.
+        """
+        if not is_pinned(job_config["image"]) or gcs_mounts:
+            return None
+        generations = (
+            input_generations(gcloud.get_storage_client(), gcs_inputs)
+            if gcs_inputs
+            else []
+        )
+        content = json.dumps(
+            {
+                "image": job_config["image"],
+                "script": script,
+                "env_vars": env_vars,
+                "gcs_target": gcs_target,
+                "gcs_inputs": gcs_inputs,
+                "generations": generations,
+            },
+            sort_keys=True,
+        )
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """ Returns the entry of a key or None if it is missing or expired """
+        raise NotImplementedError()
+
+    def put(self, key: str, entry: Dict[str, Any]):
+        """ Stores an entry (the created timestamp is set by the cache) """
+        raise NotImplementedError()
+
+    def evict(self) -> int:
+        """ Removes the expired entries and returns their number """
+        raise NotImplementedError()
+
+    def _is_expired(self, created):
+        return time.time() - created > self.ttl_seconds
+
+
+class SqliteResultCache(ResultCache):
+    """
+    Keeps the entries in a local SQLite database.
+
+    Besides expiring, the least recently used entries are evicted once
+    there are more than max_entries.
+    """
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+    ):
+        super().__init__(ttl_seconds)
+        self.max_entries = max_entries
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    entry TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+                """
+            )
+
+    def get(self, key):
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT entry, created FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                return None
+            if self._is_expired(row[1]):
+                self._connection.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            self._connection.execute(
+                "UPDATE results SET accessed = ? WHERE key = ?", (time.time(), key)
+            )
+        return json.loads(row[0])
+
+    def put(self, key, entry):
+        now = time.time()
+        entry = dict(entry, created=now)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO results (key, entry, created, accessed) "
+                "VALUES (?, ?, ?, ?)",
+                (key, json.dumps(entry), now, now),
+            )
+            self._connection.execute(
+                """
+                DELETE FROM results WHERE key NOT IN (
+                    SELECT key FROM results ORDER BY accessed DESC LIMIT ?
+                )
+                """,
+                (self.max_entries,),
+            )
+
+    def evict(self):
+        with self._lock, self._connection:
+            return self._connection.execute(
+                "DELETE FROM results WHERE created < ?",
+                (time.time() - self.ttl_seconds,),
+            ).rowcount
+
+
+class GcsResultCache(ResultCache):
+    """
+    Keeps the entries as JSON objects in a GCS bucket (shared by all clients).
+
+    Expired entries are removed when they are read or by evict(). A lifecycle
+    rule on the prefix can remove entries which are never read again.
+    """
+
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "clash-results",
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        gcloud=None,
+    ):
+        super().__init__(ttl_seconds)
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.gcloud = gcloud
+        self._storage = None
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            if self.gcloud is None:
+                from pyclash.clash import CloudSdk
+
+                self.gcloud = CloudSdk()
+            self._storage = self.gcloud.get_storage_client()
+        return self._storage
+
+    def _object_name(self, key):
+        return f"{self.prefix}/{key}.json"
+
+    def get(self, key):
+        try:
+            content = (
+                self.storage.objects()
+                .get_media(bucket=self.bucket, object=self._object_name(key))
+                .execute()
+            )
+        except Exception as e:
+            if is_not_found(e):
+                return None
+            raise
+        entry = json.loads(content)
+        if self._is_expired(entry["created"]):
+            self._delete(self._object_name(key))
+            return None
+        return entry
+
+    def put(self, key, entry):
+        from googleapiclient.http import MediaIoBaseUpload
+
+        entry = dict(entry, created=time.time())
+        media = MediaIoBaseUpload(
+            io.BytesIO(json.dumps(entry).encode("utf-8")), mimetype="application/json"
+        )
+        self.storage.objects().insert(
+            bucket=self.bucket,
+            body={
+                "name": self._object_name(key),
+                "metadata": {"created": str(entry["created"])},
+            },
+            media_body=media,
+        ).execute()
+
+    def evict(self):
+        evicted = 0
+        page_token = None
+        while True:
+            response = (
+                self.storage.objects()
+                .list(
+                    bucket=self.bucket,
+                    prefix=f"{self.prefix}/",
+                    pageToken=page_token,
+                    fields="items(name,metadata),nextPageToken",
+                )
+                .execute()
+            )
+            for item in response.get("items", []):
+                created = float(item.get("metadata", {}).get("created", 0))
+                if self._is_expired(created) and self._delete(item["name"]):
+                    evicted += 1
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return evicted
+
+    def _delete(self, name):
+        try:
+            self.storage.objects().delete(bucket=self.bucket, object=name).execute()
+            return True
+        except Exception as e:
+            # e.g. another client removed the entry first
+            logger.debug(f"Could not remove cache entry {name}. Message: {e}")
+            return False
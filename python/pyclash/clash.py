@@ -1,23 +1,78 @@
 """ Clash """
 
 import logging
-from typing import List, Dict, Optional, Any
+from typing import List, Dict, Optional, Any, Iterator
 import uuid
+import hashlib
+import io
+import urllib.parse
+from datetime import datetime, timezone
 import copy
 import json
 import time
+import shlex
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import os
 import os.path
+from contextlib import contextmanager
 
 import jinja2
-import googleapiclient.discovery
-from google.cloud import pubsub_v1 as pubsub
-from google.cloud.pubsub_v1.types import MessageStoragePolicy
-from google.cloud import logging as glogging
+
+from pyclash.tracing import (
+    Instrumentation,
+    span,
+    vm_spans,
+    timing_breakdown,
+)
+from pyclash.registry import (
+    JobRegistry,
+    PLACING,
+    SUBMITTED,
+    FAILED,
+    FINISHED,
+    CLEANED_UP,
+)
 
 logger = logging.getLogger(__name__)
 
+# the location of the local SSDs within the container
+SCRATCH_PATH = "/scratch"
+
+DEFAULT_UTILIZATION_INTERVAL_SECONDS = 10
+
+# the labels which mark the resources of Clash (see pyclash.sweeper)
+MANAGED_LABEL = "clash-managed"
+CREATED_LABEL = "clash-created"
+
+# the port of the coordinator (rank 0) of multi-node jobs
+DEFAULT_COORDINATOR_PORT = 29500
+
+# the status of the notice which preempted VMs publish before they restart
+PREEMPTED = "preempted"
+
+# GCE stops preempted VMs after 30 seconds, some of which the flush needs
+PREEMPTION_GRACE_SECONDS = 20
+
+# the status of jobs which the VM stopped at their deadline (like timeout(1))
+TIMED_OUT_STATUS = 124
+
+# GCE removes VMs whose runner could not stop the job at its deadline after
+# this margin (which leaves time for reporting and cleaning up)
+MAX_RUN_DURATION_MARGIN_SECONDS = 15 * 60
+
+# the log of the containers (see --log-driver=gcplogs of the runner)
+CONTAINER_LOG_NAME = "gcplogs-docker-driver"
+
+# the prefix of the payloads in the staging bucket (see PayloadStore)
+DEFAULT_STAGING_PREFIX = "clash-staging"
+
+# host directories which hold the prefetched gcs_inputs
+INPUTS_HOST_PATH = "/var/clash-inputs"
+INPUTS_SCRATCH_HOST_PATH = "/mnt/disks/scratch/clash-inputs"
+
 DEFAULT_JOB_CONFIG = {
     "project_id": "my-gcp-project",
     "image": "google/cloud-sdk",
@@ -95,6 +150,14 @@ class JobConfigBuilder:
         self.config["disk_image"] = disk_image
         return self
 
+    def baked_image(self, family, project=None):
+        """
+        Boots the VMs from the latest disk image of a family which was baked
+        with pyclash.bake (by default of the project of the job)
+        """
+        self.config["disk_image"] = {"project": project, "family": family}
+        return self
+
     def scopes(self, scopes):
         self.config["scopes"] = scopes
         return self
@@ -103,10 +166,161 @@ class JobConfigBuilder:
         self.config["labels"] = labels
         return self
 
+    def boot_disk_size_gb(self, size_gb):
+        self.config["boot_disk_size_gb"] = size_gb
+        return self
+
+    def boot_disk_type(self, disk_type):
+        """ e.g. pd-standard, pd-balanced or pd-ssd """
+        self.config["boot_disk_type"] = disk_type
+        return self
+
+    def local_ssds(self, count):
+        """ Attaches local NVMe SSDs which are mounted as scratch space into the job """
+        self.config["local_ssds"] = count
+        return self
+
+    def data_disks(self, data_disks):
+        """
+        Attaches additional disks to the VM.
+
+        Each disk is a dict with a device_name, the mount_path within the job and
+        either the name of an existing disk (source) or size_gb and disk_type for
+        a new, empty disk. Existing disks are attached read-only by default, so
+        that all jobs of a group can share the same dataset disk.
+        """
+        self.config["data_disks"] = data_disks
+        return self
+
+    def zones(self, zones):
+        """ Candidate zones which are tried if a zone is out of capacity """
+        self.config["zones"] = zones
+        return self
+
+    def subnetworks(self, subnetworks):
+        """ Subnetworks per region (for candidate zones outside of the default region) """
+        self.config["subnetworks"] = subnetworks
+        return self
+
+    def placement_policy(self, policy):
+        """ ordered, spread or least_recently_stocked_out (see ZonePlacement) """
+        self.config["placement_policy"] = policy
+        return self
+
+    def placement_timeout(self, seconds):
+        """ Maximum time to wait for a VM before trying the next candidate zone """
+        self.config["placement_timeout_seconds"] = seconds
+        return self
+
+    def artifact_sync_interval(self, seconds):
+        """ Syncs gcs_target artifacts every n seconds while the job is running """
+        self.config["artifact_sync_interval"] = seconds
+        return self
+
+    def nodes(self, count):
+        """
+        Runs the job on several VMs (e.g. for distributed training).
+
+        Each container gets the env vars CLASH_RANK, CLASH_WORLD_SIZE,
+        CLASH_COORDINATOR_ADDRESS and CLASH_COORDINATOR_PORT. The VMs use the
+        host network, so the firewall has to allow traffic between them.
+        """
+        self.config["nodes"] = count
+        return self
+
+    def coordinator_port(self, port):
+        """ The port which rank 0 of a multi-node job listens on """
+        self.config["coordinator_port"] = port
+        return self
+
+    def staging_bucket(self, bucket, prefix=DEFAULT_STAGING_PREFIX):
+        """
+        Stages the script and env file of jobs in a GCS bucket (by their
+        content) instead of passing them in the metadata of the VMs
+        """
+        self.config["staging_bucket"] = bucket
+        self.config["staging_prefix"] = prefix
+        return self
+
+    def max_run_duration(self, seconds):
+        """
+        Stops the job on the VM once it ran for n seconds (including the
+        startup of the VM), defaults to the timeout_seconds of the job
+        """
+        self.config["max_run_duration_seconds"] = seconds
+        return self
+
+    def utilization_interval(self, seconds):
+        """ Samples the utilization of the container every n seconds """
+        self.config["utilization_interval_seconds"] = seconds
+        return self
+
+    def auto_size(self, enabled):
+        """
+        Uses the machine type which is recommended by the utilization history
+        of the job (see Job and pyclash.sizing)
+        """
+        self.config["auto_size"] = enabled
+        return self
+
     def build(self):
         return copy.deepcopy(self.config)
 
 
+def normalize_data_disks(job_config) -> List[Dict[str, Any]]:
+    """ Fills in the defaults of the data disks in a job configuration """
+    disks = []
+    for disk in job_config.get("data_disks", []):
+        if "device_name" not in disk or "mount_path" not in disk:
+            raise ValueError("Data disks require a device_name and a mount_path")
+        disks.append(
+            {
+                "device_name": disk["device_name"],
+                "mount_path": disk["mount_path"],
+                "source": disk.get("source"),
+                "read_only": disk.get("read_only", "source" in disk),
+                "size_gb": disk.get("size_gb", 100),
+                "disk_type": disk.get("disk_type", "pd-standard"),
+            }
+        )
+    return disks
+
+
+def normalize_gcs_inputs(
+    gcs_inputs: Dict[str, Any], on_local_ssd: bool = False
+) -> List[Dict[str, str]]:
+    """
+    Translates the gcs_inputs of a job into the copy operations of the runner.
+
+    Each key is a GCS prefix (bucket/path) and each value is either the target
+    directory within the container or a dict with the target directory (path)
+    and optional lists of include / exclude patterns. Patterns are Python
+    regular expressions which are matched against the object path relative
+    to the prefix.
+    """
+    host_path = INPUTS_SCRATCH_HOST_PATH if on_local_ssd else INPUTS_HOST_PATH
+    inputs = []
+    for i, (source, target) in enumerate(gcs_inputs.items()):
+        if isinstance(target, str):
+            target = {"path": target}
+
+        excluded = []
+        if target.get("include"):
+            included = "|".join(f"(?:{p})" for p in target["include"])
+            excluded.append(f"(?!{included})")
+        excluded.extend(f"(?:{p})" for p in target.get("exclude", []))
+
+        inputs.append(
+            {
+                "source": f"gs://{source}",
+                "path": target["path"],
+                "host_path": f"{host_path}/{i}",
+                "exclude_regex": shlex.quote("|".join(excluded)) if excluded else "",
+            }
+        )
+    return inputs
+
+
 class MemoryCache:
     """ Having this class avoids dependency issues with the compute engine client"""
 
@@ -120,21 +334,39 @@ class MemoryCache:
 
 
 class CloudSdk:
-    """ Provides access to the GCP services (e.g. logging, compute engine, etc.) """
+    """
+    Provides access to the GCP services (e.g. logging, compute engine, etc.)
+
+    The client libraries are imported on first use, since importing them
+    takes a while (e.g. for the CLI or when Airflow parses DAGs).
+    """
 
     def __init__(self):
         pass
 
     def get_compute_client(self):
+        import googleapiclient.discovery
+
         return googleapiclient.discovery.build("compute", "v1", cache=MemoryCache())
 
+    def get_storage_client(self):
+        import googleapiclient.discovery
+
+        return googleapiclient.discovery.build("storage", "v1", cache=MemoryCache())
+
     def get_publisher(self):
+        from google.cloud import pubsub_v1 as pubsub
+
         return pubsub.PublisherClient()
 
     def get_subscriber(self):
+        from google.cloud import pubsub_v1 as pubsub
+
         return pubsub.SubscriberClient()
 
     def get_logging(self, project=None):
+        from google.cloud import logging as glogging
+
         if project:
             return glogging.Client(project=project)
         return glogging.Client()
@@ -155,6 +387,9 @@ class CloudInitConfig:
         env_vars: Optional[Dict[str, str]] = None,
         gcs_target: Optional[Dict[str, str]] = None,
         gcs_mounts: Optional[Dict[str, str]] = None,
+        gcs_inputs: Optional[Dict[str, Any]] = None,
+        deadline: Optional[int] = None,
+        gcloud=None,
     ):
         self.template_env = jinja2.Environment(
             loader=jinja2.FileSystemLoader(
@@ -167,6 +402,11 @@ class CloudInitConfig:
         self.env_vars = env_vars or {}
         self.gcs_target = gcs_target or {}
         self.gcs_mounts = gcs_mounts or {}
+        self.gcs_inputs = gcs_inputs or {}
+        # the time (epoch seconds) at which the runner stops the job
+        self.deadline = deadline
+        # uploads the payloads if the job config has a staging_bucket
+        self.gcloud = gcloud
 
     def render(self):
         """
@@ -182,22 +422,121 @@ class CloudInitConfig:
             zone=self.job_config["zone"],
             image=self.job_config["image"],
             privileged=self.job_config["privileged"],
+            preemptible=self.job_config["preemptible"],
+            preemption_grace_seconds=PREEMPTION_GRACE_SECONDS,
+            deadline=self.deadline,
+            timed_out_status=TIMED_OUT_STATUS,
+            local_ssds=self.job_config.get("local_ssds", 0),
+            scratch_path=SCRATCH_PATH,
+            nodes=self.job_config.get("nodes", 1),
+            coordinator_port=self.job_config.get(
+                "coordinator_port", DEFAULT_COORDINATOR_PORT
+            ),
+            utilization_interval=self.job_config.get(
+                "utilization_interval_seconds", DEFAULT_UTILIZATION_INTERVAL_SECONDS
+            ),
+            data_disks=normalize_data_disks(self.job_config),
+            gcs_inputs=normalize_gcs_inputs(
+                self.gcs_inputs, on_local_ssd=self.job_config.get("local_ssds", 0) > 0
+            ),
         )
 
         env_var_file = "\n".join(
             [f"{var}={value}" for var, value in self.env_vars.items()]
         )
 
-        return self.template_env.get_template("cloud-init.yaml.j2").render(
-            vm_name=self.vm_name,
-            clash_runner_script=clash_runner_script,
+        script_sh = self.template_env.get_template("script.sh.j2").render(
             gcs_target=self.gcs_target,
             gcs_mounts=self.gcs_mounts,
+            artifact_sync_interval=self.job_config.get("artifact_sync_interval"),
+            preemptible=self.job_config["preemptible"],
             script=self.script,
+        )
+
+        fetch_script = None
+        if self.job_config.get("staging_bucket"):
+            store = PayloadStore(
+                self.job_config["staging_bucket"],
+                self.job_config.get("staging_prefix", DEFAULT_STAGING_PREFIX),
+                self.gcloud or CloudSdk(),
+            )
+            fetch_script = self.template_env.get_template("clash_fetch.sh.j2").render(
+                bucket=store.bucket,
+                script=store.stage(script_sh),
+                env=store.stage(env_var_file),
+            )
+
+        return self.template_env.get_template("cloud-init.yaml.j2").render(
+            clash_runner_script=clash_runner_script,
+            script_sh=script_sh,
             env_var_file=env_var_file,
+            fetch_script=fetch_script,
+            local_ssds=self.job_config.get("local_ssds", 0),
+            data_disks=normalize_data_disks(self.job_config),
         )
 
 
+class PayloadStore:
+    """
+    Stages payloads (the script and env file of jobs) in a GCS bucket by
+    their SHA-256, so that only a small bootstrap has to be passed in the
+    metadata of the VMs. Jobs with the same payload share an object, which
+    is uploaded once.
+
+    The objects are not removed by Clash (e.g. use a lifecycle rule on the
+    prefix) and env files might contain secrets, so the bucket should not be
+    readable by others.
+    """
+
+    # the staged objects (bucket, name) which are known to exist
+    _STAGED = set()
+    _LOCK = threading.Lock()
+
+    def __init__(self, bucket: str, prefix: str, gcloud):
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.gcloud = gcloud
+
+    def stage(self, content: str) -> Dict[str, str]:
+        """
+        Uploads a payload unless it exists and returns its sha256 and its
+        object name (URL-encoded)
+        """
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        name = f"{self.prefix}/{digest}"
+        with PayloadStore._LOCK:
+            staged = (self.bucket, name) in PayloadStore._STAGED
+        if not staged:
+            self._upload(name, data)
+            with PayloadStore._LOCK:
+                PayloadStore._STAGED.add((self.bucket, name))
+        return {"object": urllib.parse.quote(name, safe=""), "sha256": digest}
+
+    def _upload(self, name, data):
+        from googleapiclient.http import MediaIoBaseUpload
+
+        objects = self.gcloud.get_storage_client().objects()
+        try:
+            objects.get(bucket=self.bucket, object=name).execute()
+            return  # e.g. staged by another client
+        except Exception as e:
+            if not is_not_found(e):
+                raise
+        media = MediaIoBaseUpload(io.BytesIO(data), mimetype="text/plain")
+        try:
+            # the content of an object never changes, so it is never overwritten
+            objects.insert(
+                bucket=self.bucket,
+                body={"name": name},
+                media_body=media,
+                ifGenerationMatch=0,
+            ).execute()
+        except Exception as e:
+            if error_status(e) != 412:  # uploaded in the meantime
+                raise
+
+
 class MachineConfig:
     """
     This class provides methods for creating a machine configuration
@@ -225,13 +564,22 @@ class MachineConfig:
         image_response = (
             self.compute.images()
             .getFromFamily(
-                project=self.job_config["disk_image"]["project"],
+                project=self.job_config["disk_image"]["project"]
+                or self.job_config["project_id"],
                 family=self.job_config["disk_image"]["family"],
             )
             .execute()
         )
         source_disk_image = image_response["selfLink"]
 
+        max_run_duration = None
+        if self.cloud_init.deadline:
+            # a backstop in case the runner cannot stop the job itself
+            max_run_duration = (
+                max(int(self.cloud_init.deadline - time.time()), 0)
+                + MAX_RUN_DURATION_MARGIN_SECONDS
+            )
+
         rendered = json.loads(
             self.template_env.get_template("machine_config.json.j2").render(
                 vm_name=self.vm_name,
@@ -242,8 +590,15 @@ class MachineConfig:
                 scopes=self.job_config["scopes"],
                 subnetwork=self.job_config["subnetwork"],
                 preemptible=self.job_config["preemptible"],
+                max_run_duration=max_run_duration,
                 service_account=self.job_config["service_account"],
-                labels=self.job_config.get("labels", {}),
+                labels=dict(
+                    self.job_config.get("labels", {}), **{MANAGED_LABEL: "true"}
+                ),
+                boot_disk_size_gb=self.job_config.get("boot_disk_size_gb", 100),
+                boot_disk_type=self.job_config.get("boot_disk_type"),
+                local_ssds=self.job_config.get("local_ssds", 0),
+                data_disks=normalize_data_disks(self.job_config),
             )
         )
 
@@ -252,6 +607,102 @@ class MachineConfig:
         return rendered
 
 
+def message_storage_policy(job_config):
+    """ Returns the regions which may store the messages of a job (or None) """
+    from google.cloud.pubsub_v1.types import MessageStoragePolicy
+
+    regions = job_config.get("allowed_persistence_regions")
+    return (
+        MessageStoragePolicy(allowed_persistence_regions=regions) if regions else None
+    )
+
+
+def resource_labels() -> Dict[str, str]:
+    """
+    The labels of the PubSub resources of a job (which, unlike the compute
+    resources, have no creation timestamp)
+    """
+    return {MANAGED_LABEL: "true", CREATED_LABEL: str(int(time.time()))}
+
+
+def error_status(error: Exception) -> Optional[int]:
+    """ Returns the HTTP status of an API error (or None) """
+    response = getattr(error, "resp", None)  # googleapiclient.errors.HttpError
+    if response is not None:
+        return int(response.status)
+    return getattr(error, "code", None)  # google.api_core.exceptions
+
+
+def is_not_found(error: Exception) -> bool:
+    """ True if an API error says that a resource does not exist (404) """
+    return error_status(error) == 404
+
+
+class StockoutError(Exception):
+    """ Raised if a zone cannot provide the requested VM """
+
+
+class ZonePlacement:
+    """
+    Decides in which order the candidate zones of a job are tried.
+
+    Policies:
+        ordered: the zones are tried in the configured order.
+        spread: consecutive jobs start at different zones (round robin).
+        least_recently_stocked_out: zones without a recent stockout come first.
+    """
+
+    ORDERED = "ordered"
+    SPREAD = "spread"
+    LEAST_RECENTLY_STOCKED_OUT = "least_recently_stocked_out"
+
+    # stockouts are shared by all jobs of the process (zone -> timestamp)
+    _STOCKOUTS = {}
+    _SPREAD_COUNTER = itertools.count()
+
+    def __init__(self, job_config):
+        self.job_config = job_config
+        self.policy = job_config.get("placement_policy", ZonePlacement.ORDERED)
+
+    def candidates(self) -> List[Dict[str, Any]]:
+        """
+        Returns a job configuration for each candidate zone.
+
+        Returns:
+            list: the configurations in the order in which they should be tried
+        """
+        zones = list(self.job_config.get("zones") or [])
+        if not zones:
+            return [self.job_config]
+
+        if self.policy == ZonePlacement.SPREAD:
+            offset = next(ZonePlacement._SPREAD_COUNTER) % len(zones)
+            zones = zones[offset:] + zones[:offset]
+        elif self.policy == ZonePlacement.LEAST_RECENTLY_STOCKED_OUT:
+            zones.sort(key=lambda zone: ZonePlacement._STOCKOUTS.get(zone, 0))
+        elif self.policy != ZonePlacement.ORDERED:
+            raise ValueError(f"Unknown placement policy: {self.policy}")
+
+        return [self._config_for_zone(zone) for zone in zones]
+
+    def _config_for_zone(self, zone):
+        config = copy.deepcopy(self.job_config)
+        config["zone"] = zone
+        region = zone.rsplit("-", 1)[0]
+        if region != self.job_config["region"]:
+            subnetworks = self.job_config.get("subnetworks") or {}
+            if region not in subnetworks:
+                # subnetworks are regional, so the default one cannot be reused
+                raise ValueError(f"No subnetwork is configured for region {region}")
+            config["region"] = region
+            config["subnetwork"] = subnetworks[region]
+        return config
+
+    @staticmethod
+    def record_stockout(zone):
+        ZonePlacement._STOCKOUTS[zone] = time.time()
+
+
 class JobRuntimeSpec:
     """ Specifies runtime properties of jobs """
 
@@ -261,24 +712,187 @@ class JobRuntimeSpec:
         env_vars: Optional[Dict[str, str]] = None,
         gcs_mounts: Optional[Dict[str, str]] = None,
         gcs_target: Optional[Dict[str, str]] = None,
+        gcs_inputs: Optional[Dict[str, Any]] = None,
+        script: Optional[str] = None,
     ):
         self.args = args
         self.env_vars = env_vars or {}
         self.gcs_mounts = gcs_mounts or {}
         self.gcs_target = gcs_target or {}
+        self.gcs_inputs = gcs_inputs or {}
+        # a Bash script which is run instead of the args
+        self.script = script
+
+
+def run_spec(job, spec: JobRuntimeSpec):
+    """ Runs a job as specified (without waiting for its result) """
+    if spec.script is None:
+        job.run(
+            args=spec.args,
+            env_vars=spec.env_vars,
+            gcs_mounts=spec.gcs_mounts,
+            gcs_target=spec.gcs_target,
+            gcs_inputs=spec.gcs_inputs,
+        )
+    else:
+        job._run_script(
+            spec.script,
+            spec.env_vars,
+            spec.gcs_target,
+            spec.gcs_mounts,
+            False,
+            spec.gcs_inputs,
+        )
 
 
 class JobFactory:
-    def __init__(self, job_config, gcloud=CloudSdk()):
+    def __init__(
+        self,
+        job_config,
+        gcloud=CloudSdk(),
+        instrumentation: Optional[Instrumentation] = None,
+        registry: Optional[JobRegistry] = None,
+        result_cache=None,
+        utilization_history=None,
+    ):
         self.job_config = job_config
         self.gcloud = gcloud
+        self.instrumentation = instrumentation or Instrumentation()
+        self.registry = registry
+        self.result_cache = result_cache
+        self.utilization_history = utilization_history
 
     def create(self, name_prefix):
         return Job(
-            name_prefix=name_prefix, job_config=self.job_config, gcloud=self.gcloud
+            name_prefix=name_prefix,
+            job_config=self.job_config,
+            gcloud=self.gcloud,
+            instrumentation=self.instrumentation,
+            registry=self.registry,
+            result_cache=self.result_cache,
+            utilization_history=self.utilization_history,
         )
 
 
+class WorkQueue:
+    """
+    A PubSub topic of work items which the jobs of JobGroup.map pull from and
+    a topic of the results of the items.
+
+    An item is a Bash script (the message) with the attributes index and
+    attempt. Workers acknowledge items once they are done, so PubSub
+    redelivers the items of workers which died (e.g. preempted VMs).
+    """
+
+    DEFAULT_MAX_ATTEMPTS = 3
+    ACK_DEADLINE_SECONDS = 600
+    ACK_EXTENSION_INTERVAL_SECONDS = 60
+    # workers stop after this many pulls without an item
+    MAX_EMPTY_PULLS = 3
+    EMPTY_PULL_INTERVAL_SECONDS = 10
+
+    def __init__(self, name, job_config, gcloud):
+        self.template_env = jinja2.Environment(
+            loader=jinja2.FileSystemLoader(
+                searchpath=os.path.join(os.path.dirname(__file__), "templates")
+            )
+        )
+        self.name = name
+        self.job_config = job_config
+        self.gcloud = gcloud
+        project_id = job_config["project_id"]
+        publisher = gcloud.get_publisher()
+        subscriber = gcloud.get_subscriber()
+        self.topic = publisher.topic_path(project_id, name)
+        self.subscription = subscriber.subscription_path(project_id, name)
+        self.results_topic = publisher.topic_path(project_id, f"{name}-results")
+        self.results_subscription = subscriber.subscription_path(
+            project_id, f"{name}-results"
+        )
+        self._results = {}
+
+    def create(self):
+        """ Creates the topics and subscriptions """
+        publisher = self.gcloud.get_publisher()
+        subscriber = self.gcloud.get_subscriber()
+        for topic, subscription, ack_deadline in [
+            (self.topic, self.subscription, WorkQueue.ACK_DEADLINE_SECONDS),
+            (self.results_topic, self.results_subscription, None),
+        ]:
+            publisher.create_topic(
+                topic,
+                message_storage_policy=message_storage_policy(self.job_config),
+                labels=resource_labels(),
+            )
+            subscriber.create_subscription(
+                subscription,
+                topic,
+                ack_deadline_seconds=ack_deadline,
+                labels=resource_labels(),
+            )
+
+    def put(self, scripts: List[str]):
+        """ Adds an item per script (their index is their position) """
+        publisher = self.gcloud.get_publisher()
+        futures = [
+            publisher.publish(
+                self.topic, script.encode("utf-8"), index=str(index), attempt="1"
+            )
+            for index, script in enumerate(scripts)
+        ]
+        for future in futures:
+            future.result()
+
+    def worker_script(self, max_attempts: int) -> str:
+        """ Returns the script of the workers (which needs the Cloud SDK) """
+        return self.template_env.get_template("map_worker.sh.j2").render(
+            topic=self.topic,
+            subscription=self.subscription,
+            results_topic=self.results_topic,
+            max_attempts=max_attempts,
+            ack_deadline=WorkQueue.ACK_DEADLINE_SECONDS,
+            ack_extension_interval=WorkQueue.ACK_EXTENSION_INTERVAL_SECONDS,
+            max_empty_pulls=WorkQueue.MAX_EMPTY_PULLS,
+            empty_pull_interval=WorkQueue.EMPTY_PULL_INTERVAL_SECONDS,
+        )
+
+    def results(self) -> Dict[int, Dict[str, Any]]:
+        """ Receives the pending results and returns the latest one per item """
+        subscriber = self.gcloud.get_subscriber()
+        while True:
+            response = subscriber.pull(
+                self.results_subscription, max_messages=100, return_immediately=True
+            )
+            if not response.received_messages:
+                return dict(self._results)
+            for message in response.received_messages:
+                result = json.loads(message.message.data)
+                index = result.pop("index")
+                latest = self._results.get(index)
+                # the results of the attempts of an item might arrive in any order
+                if latest is None or latest["attempt"] <= result["attempt"]:
+                    self._results[index] = result
+            subscriber.acknowledge(
+                self.results_subscription,
+                [message.ack_id for message in response.received_messages],
+            )
+
+    def remove(self):
+        """ Removes the topics and subscriptions """
+        publisher = self.gcloud.get_publisher()
+        subscriber = self.gcloud.get_subscriber()
+        for subscription in [self.subscription, self.results_subscription]:
+            try:
+                subscriber.delete_subscription(subscription)
+            except Exception as e:
+                logger.warning(f"Could not remove subscription {subscription}: {e}")
+        for topic in [self.topic, self.results_topic]:
+            try:
+                publisher.delete_topic(topic)
+            except Exception as e:
+                logger.warning(f"Could not remove topic {topic}: {e}")
+
+
 class JobGroup:
     """
     This class allows the creation of multiple jobs.
@@ -295,10 +909,19 @@ class JobGroup:
         self.job_factory = job_factory
         self.job_config = job_factory.job_config
         self.gcloud = job_factory.gcloud
+        self.instrumentation = (
+            getattr(job_factory, "instrumentation", None) or Instrumentation()
+        )
+        self.registry = getattr(job_factory, "registry", None)
 
         self.job_specs = []
         self.running_jobs = []
         self.jobs_status_codes = []
+        # failed jobs which were replaced by rerun_failed (cleaned up later)
+        self.replaced_jobs = []
+        self._subscribed_jobs = set()
+        # the queue of the items of map
+        self.work_queue = None
 
     def add_job(self, runtime_spec):
         """
@@ -307,21 +930,231 @@ class JobGroup:
         """
         self.job_specs.append(runtime_spec)
 
-    def run(self):
+    def map(
+        self,
+        args_template: List[str],
+        items: List[Any],
+        workers: int = 1,
+        max_attempts: int = WorkQueue.DEFAULT_MAX_ATTEMPTS,
+        env_vars: Optional[Dict[str, str]] = None,
+        gcs_mounts: Optional[Dict[str, str]] = None,
+        gcs_target: Optional[Dict[str, str]] = None,
+        gcs_inputs: Optional[Dict[str, Any]] = None,
+        parallelism: int = 1,
+        subscribe: bool = True,
+    ):
         """
-        Runs all jobs that are part of the group.
+        Runs a command per item on a fixed number of workers.
+
+        The items are put into a work queue which the workers pull from until
+        it is empty, so faster workers process more items. Failed items are
+        retried (by any worker) until max_attempts. A worker fails if one of
+        its items failed for the last time. See item_results for the outcome
+        of each item.
+
+        :param args_template the command, "{item}" is replaced by the item
+        :param items the items (e.g. file names)
+        :param workers the number of jobs which process the items
+        :param max_attempts the number of attempts per item
+        :param env_vars, gcs_mounts, gcs_target, gcs_inputs see Job.run
+        :param parallelism, subscribe see run
         """
-        for spec_id, spec in enumerate(self.job_specs):
-            job = self.job_factory.create(name_prefix=f"{self.name}-{spec_id}")
-            job.run(
-                args=spec.args,
-                env_vars=spec.env_vars,
-                gcs_mounts=spec.gcs_mounts,
-                gcs_target=spec.gcs_target,
+        if self.job_specs:
+            raise ValueError("A group cannot map items and run other jobs")
+
+        self.work_queue = WorkQueue(
+            f"{self.name}-clash-job-queue-{str(uuid.uuid1())[0:8]}",
+            self.job_config,
+            self.gcloud,
+        )
+        with span(self.instrumentation, "group.map", self.name):
+            self.work_queue.create()
+            self.work_queue.put(
+                [
+                    translate_args_to_script(
+                        [arg.replace("{item}", str(item)) for arg in args_template]
+                    )
+                    for item in items
+                ]
+            )
+        script = self.work_queue.worker_script(max_attempts)
+        for worker in range(workers):
+            self.add_job(
+                JobRuntimeSpec(
+                    args=[],
+                    env_vars=dict(env_vars or {}, CLASH_WORKER=str(worker)),
+                    gcs_mounts=gcs_mounts,
+                    gcs_target=gcs_target,
+                    gcs_inputs=gcs_inputs,
+                    script=script,
+                )
             )
+        self.run(parallelism, subscribe)
+
+    def item_results(self) -> Dict[int, Dict[str, Any]]:
+        """
+        Returns the latest result (status, attempt and worker) of each item
+        of map which was processed so far (by item index)
+        """
+        if self.work_queue is None:
+            raise ValueError("The group did not map any items")
+        return self.work_queue.results()
+
+    def run(self, parallelism: int = 1, subscribe: bool = True):
+        """
+        Runs all jobs that are part of the group.
+
+        :param parallelism the number of jobs which are submitted concurrently
+        :param subscribe if false, the group does not receive the results of
+            its jobs (e.g. because another process waits for them)
+        """
+        with span(self.instrumentation, "group.run", self.name):
+            self._submit_all(range(len(self.job_specs)), parallelism, subscribe)
+
+    def _submit_all(self, spec_ids, parallelism, subscribe):
+        if parallelism <= 1:
+            for spec_id in spec_ids:
+                self.running_jobs.append(
+                    self._submit(spec_id, self.job_specs[spec_id], subscribe)
+                )
+            return
+
+        with ThreadPoolExecutor(max_workers=parallelism) as executor:
+            futures = [
+                executor.submit(
+                    self._submit, spec_id, self.job_specs[spec_id], subscribe
+                )
+                for spec_id in spec_ids
+            ]
+        # keep the jobs which were submitted, even if others failed
+        errors = [f.exception() for f in futures if f.exception()]
+        self.running_jobs.extend(f.result() for f in futures if not f.exception())
+        if errors:
+            raise errors[0]
+
+    def _submit(self, spec_id, spec, subscribe=True):
+        job = self.job_factory.create(name_prefix=f"{self.name}-{spec_id}")
+        job.group = self.name
+        job.group_index = spec_id
+        run_spec(job, spec)
+        if subscribe:
             # arrays are thread-safe in Python (due to GIL)
+            self._subscribed_jobs.add(job.name)
             job.on_finish(self.jobs_status_codes.append)
-            self.running_jobs.append(job)
+        return job
+
+    @classmethod
+    def resume(cls, name, job_factory, registry: Optional[JobRegistry] = None):
+        """
+        Recreates a group from the registry without resubmitting its jobs.
+
+        Only jobs which were submitted before are part of the resumed group.
+        Call wait() to block until they are complete.
+
+        :param name the name of the group
+        :param job_factory the factory which was used for the group
+        :param registry the registry of the jobs (default: the one of the factory)
+        """
+        group = cls(name, job_factory)
+        group.registry = registry or group.registry
+        if group.registry is None:
+            raise ValueError("Resuming a group requires a registry")
+        records = group.registry.group_members(name)
+        if not records:
+            raise ValueError(f"Could not find group {name} in the registry")
+
+        for record in records:
+            job = Job.from_state(
+                record["state"],
+                gcloud=group.gcloud,
+                instrumentation=group.instrumentation,
+                registry=group.registry,
+                result=record["result"],
+            )
+            group._subscribed_jobs.add(job.name)
+            job.on_finish(group.jobs_status_codes.append)
+            group.running_jobs.append(job)
+        return group
+
+    def outcomes(self) -> Dict[int, Optional[int]]:
+        """
+        Returns the exit code of each member (by spec index) which is known.
+
+        Members which are still running map to None, members which were
+        never submitted (e.g. because the submission failed) are missing.
+        """
+        return {
+            job.group_index: job.result["status"] if job.result else None
+            for job in self.running_jobs
+        }
+
+    def rerun_failed(
+        self,
+        parallelism: int = 1,
+        subscribe: bool = True,
+        since: Optional[float] = None,
+    ):
+        """
+        Resubmits the members which failed or were never submitted.
+
+        Members which succeeded are kept and running members are reattached.
+        With a registry, the outcomes of earlier runs of the group (e.g. of
+        a previous process) are taken into account as well.
+
+        :param parallelism the number of jobs which are submitted concurrently
+        :param subscribe if false, the group does not receive the results of
+            its jobs (e.g. because another process waits for them)
+        :param since only registry records which were created later (a
+            timestamp) are taken into account, since group names are reused
+        :returns the spec indices of the resubmitted members
+        """
+        members = self._latest_members(since)
+        del self.running_jobs[:]
+        del self.jobs_status_codes[:]
+
+        resubmit = []
+        for spec_id in range(len(self.job_specs)):
+            job, status = members.get(spec_id, (None, None))
+            if status not in (SUBMITTED, FINISHED, CLEANED_UP):
+                resubmit.append(spec_id)  # missing or its submission failed
+            elif job.result is None and status == SUBMITTED:
+                self.running_jobs.append(job)
+                if subscribe and job.name not in self._subscribed_jobs:
+                    self._subscribed_jobs.add(job.name)
+                    job.on_finish(self.jobs_status_codes.append)
+            elif job.result is not None and job.result["status"] == 0:
+                self.running_jobs.append(job)
+                self.jobs_status_codes.append(0)
+            else:
+                if status != CLEANED_UP:
+                    self.replaced_jobs.append(job)
+                resubmit.append(spec_id)
+
+        with span(self.instrumentation, "group.rerun_failed", self.name):
+            self._submit_all(resubmit, parallelism, subscribe)
+        return resubmit
+
+    def _latest_members(self, since):
+        """
+        Returns the latest job and its status (see pyclash.registry) per spec
+        index, preferring the jobs of this object over the registry records
+        """
+        members = {}
+        if self.registry is not None:
+            for record in self.registry.group_members(self.name):
+                if since is not None and record["created"] < since:
+                    continue
+                job = Job.from_state(
+                    record["state"],
+                    gcloud=self.gcloud,
+                    instrumentation=self.instrumentation,
+                    registry=self.registry,
+                    result=record["result"],
+                )
+                members[job.group_index] = (job, record["status"])
+        for job in self.running_jobs:
+            members[job.group_index] = (job, FINISHED if job.result else SUBMITTED)
+        return members
 
     def wait(self):
         """
@@ -329,8 +1162,9 @@ class JobGroup:
 
         :returns true if all jobs succeeded else false
         """
-        while len(self.jobs_status_codes) != len(self.running_jobs):
-            time.sleep(1)
+        with span(self.instrumentation, "group.wait", self.name):
+            while len(self.jobs_status_codes) != len(self.running_jobs):
+                time.sleep(1)
 
         return all(map(lambda code: code == 0, self.jobs_status_codes))
 
@@ -338,8 +1172,12 @@ class JobGroup:
         """
         Manual clean up. This method is a workaround and will disappear soon.
         """
-        for job in self.running_jobs:
-            job.clean_up()
+        with span(self.instrumentation, "group.clean_up", self.name):
+            for job in self.replaced_jobs + self.running_jobs:
+                job.clean_up()
+            del self.replaced_jobs[:]
+            if self.work_queue is not None:
+                self.work_queue.remove()
 
     def is_group(self):
         return True
@@ -351,6 +1189,165 @@ class JobGroup:
         self.clean_up()
 
 
+# the states of the nodes of a job graph
+NODE_PENDING = "pending"
+NODE_RUNNING = "running"
+NODE_SUCCEEDED = "succeeded"
+NODE_FAILED = "failed"
+NODE_UPSTREAM_FAILED = "upstream_failed"
+
+
+class JobGraphNode:
+    """ A job or group of a graph and the jobs which were submitted for it """
+
+    def __init__(self, name, specs, upstream):
+        self.name = name
+        self.specs = specs
+        self.upstream = upstream
+        self.status = NODE_PENDING
+        self.jobs = []
+        self.status_codes = []
+
+    def is_done(self):
+        return self.status not in (NODE_PENDING, NODE_RUNNING)
+
+
+class JobGraph:
+    """
+    Runs jobs and groups in the order of their dependencies.
+
+    Each node starts as soon as all its upstream nodes succeeded (e.g. to
+    consume their gcs_target outputs). A node succeeds once all its jobs
+    succeeded. If a node fails, its downstream nodes are skipped, while
+    independent nodes keep running.
+    """
+
+    def __init__(self, name, job_factory, max_parallelism: int = 10):
+        """
+        Constructs a new graph.
+
+        :param name the name of the graph
+        :param job_factory a factory that creates individual jobs
+        :param max_parallelism the maximum number of jobs which run at once
+        """
+        self.name = name
+        self.job_factory = job_factory
+        self.max_parallelism = max_parallelism
+        self.instrumentation = (
+            getattr(job_factory, "instrumentation", None) or Instrumentation()
+        )
+        self.nodes = {}
+
+        self._condition = threading.Condition()
+        self._queue = []
+        self._active_jobs = 0
+
+    def add_job(self, name: str, runtime_spec, upstream: List[str] = ()):
+        """
+        Adds a job to the graph.
+
+        :param name the name of the node
+        :param runtime_spec runtime specification of the job
+        :param upstream the names of the nodes which have to succeed first
+        """
+        return self.add_group(name, [runtime_spec], upstream)
+
+    def add_group(self, name: str, runtime_specs, upstream: List[str] = ()):
+        """
+        Adds a group of jobs to the graph (which succeeds if all jobs succeed).
+
+        Upstream nodes have to be added first, so graphs cannot have cycles.
+        """
+        if name in self.nodes:
+            raise ValueError(f"The graph already has a node {name}")
+        unknown = [u for u in upstream if u not in self.nodes]
+        if unknown:
+            raise ValueError(f"Unknown upstream nodes {unknown} of node {name}")
+        node = JobGraphNode(name, list(runtime_specs), list(upstream))
+        self.nodes[name] = node
+        return node
+
+    def run(self) -> bool:
+        """
+        Runs all nodes and blocks until the graph is complete.
+
+        :returns true if all nodes succeeded else false
+        """
+        with span(self.instrumentation, "graph.run", self.name):
+            with ThreadPoolExecutor(max_workers=self.max_parallelism) as executor:
+                with self._condition:
+                    while True:
+                        self._schedule()
+                        if all(node.is_done() for node in self.nodes.values()):
+                            break
+                        while self._queue and self._active_jobs < self.max_parallelism:
+                            node, spec_id = self._queue.pop(0)
+                            if node.status == NODE_RUNNING:
+                                self._active_jobs += 1
+                                executor.submit(self._submit, node, spec_id)
+                        self._condition.wait()
+
+        return all(node.status == NODE_SUCCEEDED for node in self.nodes.values())
+
+    def _schedule(self):
+        """ Queues the jobs of ready nodes and skips the ones of failed nodes """
+        for node in self.nodes.values():
+            if node.status != NODE_PENDING:
+                continue
+            upstream = [self.nodes[u].status for u in node.upstream]
+            if any(s in (NODE_FAILED, NODE_UPSTREAM_FAILED) for s in upstream):
+                node.status = NODE_UPSTREAM_FAILED
+            elif all(s == NODE_SUCCEEDED for s in upstream):
+                node.status = NODE_RUNNING if node.specs else NODE_SUCCEEDED
+                self._queue += [(node, i) for i in range(len(node.specs))]
+
+    def _submit(self, node, spec_id):
+        spec = node.specs[spec_id]
+        try:
+            job = self.job_factory.create(
+                name_prefix=f"{self.name}-{node.name}-{spec_id}"
+            )
+            job.group = f"{self.name}-{node.name}"
+            job.group_index = spec_id
+            with self._condition:
+                node.jobs.append(job)
+            run_spec(job, spec)
+            job.on_finish(lambda status: self._on_job_finish(node, status))
+        except Exception as e:
+            logger.error(f"Could not submit job {spec_id} of node {node.name}: {e}")
+            self._on_job_finish(node, None)
+
+    def _on_job_finish(self, node, status):
+        """ Updates the node of a complete job (status is None if it failed to start) """
+        with self._condition:
+            self._active_jobs -= 1
+            node.status_codes.append(status)
+            if status != 0 and node.status == NODE_RUNNING:
+                node.status = NODE_FAILED
+            elif len(node.status_codes) == len(node.specs) and not node.is_done():
+                node.status = NODE_SUCCEEDED
+            self._condition.notify_all()
+
+    def outcomes(self) -> Dict[str, str]:
+        """ Returns the state of each node (see NODE_PENDING etc.) """
+        return {name: node.status for name, node in self.nodes.items()}
+
+    def clean_up(self):
+        """
+        Deletes the left-overs of the jobs of all nodes.
+        """
+        with span(self.instrumentation, "graph.clean_up", self.name):
+            for node in self.nodes.values():
+                for job in node.jobs:
+                    job.clean_up()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.clean_up()
+
+
 def translate_args_to_script(args: List[str]):
     res = []
     for arg in args:
@@ -367,6 +1364,15 @@ class Job:
     """
 
     POLLING_INTERVAL_SECONDS = 30
+    PLACEMENT_POLLING_INTERVAL_SECONDS = 5
+    LOGS_POLLING_INTERVAL_SECONDS = 10
+    DEFAULT_PLACEMENT_TIMEOUT_SECONDS = 300
+
+    # instance group errors which indicate that a zone is out of capacity
+    STOCKOUT_ERROR_CODES = {
+        "ZONE_RESOURCE_POOL_EXHAUSTED",
+        "ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS",
+    }
 
     def __init__(
         self,
@@ -375,14 +1381,37 @@ class Job:
         name_prefix=None,
         gcloud: Optional[CloudSdk] = None,
         timeout_seconds: Optional[int] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        registry: Optional[JobRegistry] = None,
+        result_cache=None,
+        utilization_history=None,
     ):
         self.gcloud = gcloud or CloudSdk()
         self.job_config = job_config
         self.started = False
+        # an optional pyclash.cache.ResultCache
+        self.result_cache = result_cache
+        self.cache_key = None
+        self.cached_outputs = None
+        # an optional pyclash.sizing.UtilizationHistory (keyed by name_prefix)
+        self.utilization_history = utilization_history
+        self.name_prefix = name_prefix
+        # the results of the ranks of a multi-node job which are done
+        self.rank_results = {}
+        self._rank_lock = threading.Lock()
+        # the number of preemption notices of the VMs
+        self.preemptions = 0
+        self.instrumentation = instrumentation or Instrumentation()
+        self.spans = []
+        self.registry = registry
+        self.group = None
+        self.group_index = None
+        self.result = None
 
         self.job_status_topic = None
         self.job_status_subscription = None
         self.timeout_seconds = timeout_seconds
+        self.deadline = None
 
         if not name:
             self.name = "clash-job-{}".format(str(uuid.uuid1())[0:16])
@@ -391,8 +1420,232 @@ class Job:
         else:
             self.name = name
 
+    def state(self) -> Dict[str, Any]:
+        """ Returns everything needed to reattach to the job (see from_state) """
+        return {
+            "name": self.name,
+            "name_prefix": self.name_prefix,
+            "job_config": self.job_config,
+            "job_status_topic": self.job_status_topic,
+            "job_status_subscription": self.job_status_subscription,
+            "started": self.started,
+            "group": self.group,
+            "group_index": self.group_index,
+        }
+
+    @classmethod
+    def from_state(
+        cls,
+        state: Dict[str, Any],
+        gcloud: Optional[CloudSdk] = None,
+        instrumentation: Optional[Instrumentation] = None,
+        registry: Optional[JobRegistry] = None,
+        result: Optional[Dict[str, Any]] = None,
+    ):
+        """ Recreates a job from its state without submitting it again """
+        job = cls(
+            state["job_config"],
+            name=state["name"],
+            gcloud=gcloud,
+            instrumentation=instrumentation,
+            registry=registry,
+        )
+        job.job_status_topic = state["job_status_topic"]
+        job.job_status_subscription = state["job_status_subscription"]
+        job.started = state["started"]
+        job.name_prefix = state.get("name_prefix")
+        job.group = state.get("group")
+        job.group_index = state.get("group_index")
+        job.result = result
+        return job
+
+    @classmethod
+    def reattach(
+        cls,
+        name: str,
+        registry: JobRegistry,
+        gcloud: Optional[CloudSdk] = None,
+        instrumentation: Optional[Instrumentation] = None,
+    ):
+        """
+        Recreates a submitted job from the registry (e.g. after a restart).
+
+        Only jobs which were created with the same registry can be reattached.
+        Call attach() or on_finish() on the returned job to resume waiting.
+        """
+        record = registry.get(name)
+        if not record:
+            raise ValueError(f"Could not find job {name} in the registry")
+        return cls.from_state(
+            record["state"],
+            gcloud=gcloud,
+            instrumentation=instrumentation,
+            registry=registry,
+            result=record["result"],
+        )
+
+    def _record(self, status, result=None):
+        """ Records a state transition (if the job has a registry) """
+        if self.registry is None:
+            return
+        try:
+            self.registry.record(self.state(), status, result)
+        except Exception as e:
+            logger.warning(f"Could not record the state of job {self.name}: {e}")
+
+    def nodes(self) -> int:
+        return self.job_config.get("nodes", 1)
+
+    def _receive(self, data):
+        """
+        Adds the status message of a rank and returns the result of the job
+        once it is known (i.e. all ranks succeeded or one of them failed).
+
+        Preemption notices are not final, since the instance group restarts
+        the preempted VM.
+        """
+        if data["status"] == PREEMPTED:
+            self.preemptions += 1
+            logger.warning(
+                f"The VM of job {self.name} (rank {data.get('rank', 0)}) was "
+                f"preempted. Exit code of the container: {data.get('exit_code')}"
+            )
+            return None
+        if self.nodes() == 1:
+            return data
+        with self._rank_lock:
+            self.rank_results[data.get("rank", 0)] = data
+            failed = [r for _, r in sorted(self.rank_results.items()) if r["status"]]
+            if not failed and len(self.rank_results) < self.nodes():
+                return None
+            # the logs and timings of the first failed rank (or of rank 0)
+            result = dict(failed[0] if failed else self.rank_results[0])
+            result["ranks"] = {
+                str(rank): r["status"] for rank, r in self.rank_results.items()
+            }
+            return result
+
+    def _finish(self, result):
+        self.result = result
+        self._record_vm_timings(result)
+        self._record(FINISHED, result)
+        if self.cache_key and result["status"] == 0:
+            self._store_result(result)
+        if self.utilization_history and result.get("utilization", {}).get("samples"):
+            self._record_utilization(result["utilization"])
+        if result.get("baked_digest") not in (None, "", result.get("image_digest")):
+            logger.warning(
+                f"The disk image of job {self.name} has an outdated copy of "
+                f"{self.job_config['image']}, so it should be baked again"
+            )
+
+    def _lookup_result(self, script, env_vars, gcs_target, gcs_mounts, gcs_inputs):
+        """ Returns the result of an identical run from the result cache or None """
+        self.cache_key = None
+        if self.result_cache is None:
+            return None
+        try:
+            with self._span("result_cache_lookup"):
+                key = self.result_cache.key(
+                    self.job_config,
+                    script,
+                    env_vars,
+                    gcs_target,
+                    gcs_mounts,
+                    gcs_inputs,
+                    self.gcloud,
+                )
+                entry = self.result_cache.get(key) if key else None
+        except Exception as e:
+            # the cache is an optimization, so the job runs without it
+            logger.warning(f"Could not look up the result of job {self.name}: {e}")
+            return None
+        if key is None:
+            logger.debug(f"The result of job {self.name} cannot be cached")
+            return None
+        self.cache_key = key
+        self.cached_outputs = gcs_target
+        if entry is None:
+            return None
+        logger.info(f"Reusing the result of job {entry['job']} for job {self.name}")
+        return dict(entry["result"], cached_from=entry["job"])
+
+    def _record_utilization(self, utilization):
+        if not self.name_prefix:
+            return
+        try:
+            self.utilization_history.record(
+                self.name_prefix,
+                self.name,
+                self.job_config["machine_type"],
+                utilization,
+            )
+        except Exception as e:
+            logger.warning(f"Could not record the utilization of job {self.name}: {e}")
+
+    def _auto_size(self):
+        """ Switches to the machine type which the utilization history recommends """
+        if not (
+            self.job_config.get("auto_size")
+            and self.utilization_history
+            and self.name_prefix
+        ):
+            return
+        try:
+            machine_type = self.utilization_history.recommend_machine_type(
+                self.name_prefix, self.job_config["machine_type"]
+            )
+        except Exception as e:
+            logger.warning(f"Could not recommend a machine type for {self.name}: {e}")
+            return
+        if machine_type and machine_type != self.job_config["machine_type"]:
+            logger.info(
+                f"Using machine type {machine_type} instead of "
+                f"{self.job_config['machine_type']} for job {self.name}"
+            )
+            self.job_config = dict(self.job_config, machine_type=machine_type)
+
+    def _store_result(self, result):
+        try:
+            self.result_cache.put(
+                self.cache_key,
+                {"job": self.name, "result": result, "gcs_target": self.cached_outputs},
+            )
+        except Exception as e:
+            logger.warning(f"Could not cache the result of job {self.name}: {e}")
+
+    @contextmanager
+    def _span(self, name, **attributes):
+        """ Measures a phase of the job """
+        with span(self.instrumentation, name, self.name, **attributes) as current:
+            try:
+                yield current
+            finally:
+                self.spans.append(current)
+
+    def _record_vm_timings(self, result):
+        """ Reports the phases which were measured on the VM """
+        for vm_span in vm_spans(self.name, result.get("timings", {})):
+            self.spans.append(vm_span)
+            self.instrumentation.on_span_start(vm_span)
+            self.instrumentation.on_span_end(vm_span)
+
+    def timing_breakdown(self) -> Dict[str, float]:
+        """
+        Returns the time spent in each phase of the job so far.
+
+        Client-side phases are named after the corresponding steps (e.g.
+        create_instance_template), VM-side phases are prefixed with "vm."
+        and are available once the job is complete.
+        """
+        return timing_breakdown(self.spans)
+
     def _wait_for_operation(self, operation, is_global_op):
         """ Waits for an GCE operation to finish """
+        with self._span("wait_for_operation", operation=operation):
+            return self._poll_operation(operation, is_global_op)
+
+    def _poll_operation(self, operation, is_global_op):
         compute = self.gcloud.get_compute_client()
         operations_client = (
             compute.globalOperations() if is_global_op else compute.zoneOperations()
@@ -426,23 +1679,111 @@ class Job:
         self._wait_for_operation(template_op["name"], True)
 
     def _create_managed_instance_group(self, size):
-        """ Create GCE Instance Group and waits for it """
-        template_op = (
-            self.gcloud.get_compute_client()
-            .instanceGroupManagers()
-            .insert(
+        """
+        Create GCE Instance Group and waits for it
+
+        The VMs of multi-node jobs are named after their rank (e.g. job-1),
+        since the runner derives the rank from the hostname.
+        """
+        managers = self.gcloud.get_compute_client().instanceGroupManagers()
+        template_op = managers.insert(
+            project=self.job_config["project_id"],
+            zone=self.job_config["zone"],
+            body={
+                "baseInstanceName": self.name,
+                "instanceTemplate": f"global/instanceTemplates/{self.name}",
+                "name": self.name,
+                "targetSize": size if size == 1 else 0,
+            },
+        ).execute()
+        self._wait_for_operation(template_op["name"], False)
+
+        if size > 1:
+            instances_op = managers.createInstances(
                 project=self.job_config["project_id"],
                 zone=self.job_config["zone"],
+                instanceGroupManager=self.name,
                 body={
-                    "baseInstanceName": self.name,
-                    "instanceTemplate": f"global/instanceTemplates/{self.name}",
-                    "name": self.name,
-                    "targetSize": size,
+                    "instances": [
+                        {"name": f"{self.name}-{rank}"} for rank in range(size)
+                    ]
                 },
-            )
-            .execute()
+            ).execute()
+            self._wait_for_operation(instances_op["name"], False)
+
+    def _wait_for_placement(self, timeout_seconds):
+        """ Waits until the instance group has created its VM """
+        managers = self.gcloud.get_compute_client().instanceGroupManagers()
+        args = {
+            "project": self.job_config["project_id"],
+            "zone": self.job_config["zone"],
+            "instanceGroupManager": self.name,
+        }
+        start_time = time.time()
+        while (time.time() - start_time) <= timeout_seconds:
+            for item in managers.listErrors(**args).execute().get("items", []):
+                code = item.get("error", {}).get("code")
+                if code in Job.STOCKOUT_ERROR_CODES:
+                    raise StockoutError(
+                        f"Zone {self.job_config['zone']} cannot provide the VM ({code})"
+                    )
+
+            try:
+                group = managers.get(**args).execute()
+            except Exception as e:
+                if not is_not_found(e):
+                    raise
+                logger.debug(f"Instance group is gone (job complete?). Message: {e}")
+                return
+            if group.get("currentActions", {}).get("none", 0) >= group["targetSize"]:
+                return
+
+            time.sleep(Job.PLACEMENT_POLLING_INTERVAL_SECONDS)
+
+        raise StockoutError(
+            f"Zone {self.job_config['zone']} did not provide the VM "
+            f"within {timeout_seconds} seconds"
         )
-        self._wait_for_operation(template_op["name"], False)
+
+    def _place(self, candidates, script, env_vars, gcs_target, gcs_mounts, gcs_inputs):
+        """
+        Creates the VM in the first candidate zone with enough capacity.
+
+        Note that this blocks until the VM is placed (up to the placement
+        timeout per zone), so groups should use JobGroup.run(parallelism=...)
+        to place their jobs concurrently.
+        """
+        timeout_seconds = self.job_config.get(
+            "placement_timeout_seconds", Job.DEFAULT_PLACEMENT_TIMEOUT_SECONDS
+        )
+        for i, candidate in enumerate(candidates):
+            self.job_config = candidate
+            with self._span("create_instance_template"):
+                self._create_instance_template(
+                    self._create_machine_config(
+                        script, env_vars, gcs_target, gcs_mounts, gcs_inputs
+                    )
+                )
+            with self._span("create_instance_group", zone=candidate["zone"]):
+                self._create_managed_instance_group(self.nodes())
+            self.started = True
+            # the VM might already run, so record its zone before waiting
+            self._record(SUBMITTED)
+            if len(candidates) == 1:
+                return
+
+            try:
+                with self._span("wait_for_placement", zone=candidate["zone"]):
+                    self._wait_for_placement(timeout_seconds)
+                return
+            except StockoutError as e:
+                ZonePlacement.record_stockout(candidate["zone"])
+                if i == len(candidates) - 1:
+                    raise
+                logger.warning(f"{e}. Trying the next zone...")
+                self._remove_instance_group()
+                self._remove_instance_template()
+                self.started = False
 
     def run(
         self,
@@ -451,6 +1792,7 @@ class Job:
         gcs_target: Optional[Dict[str, str]] = None,
         gcs_mounts: Optional[Dict[str, str]] = None,
         wait_for_result: bool = False,
+        gcs_inputs: Optional[Dict[str, Any]] = None,
     ):
         """
         Runs a script which is given as a string.
@@ -461,28 +1803,59 @@ class Job:
             gcs_target (dict): Files which will be copied to GCS when the script is done.
             gcs_mounts (dict): Buckets which will be mounted using gcsfuse (if available).
             wait_for_result (bool): If true, blocks until the job is complete.
+            gcs_inputs (dict): GCS prefixes which will be copied to local disk
+                before the script starts (see normalize_gcs_inputs).
+
+        With a result cache, the result of an identical earlier run is
+        returned right away (without creating a VM) if there is one.
         """
+        return self._run_script(
+            translate_args_to_script(args),
+            env_vars,
+            gcs_target,
+            gcs_mounts,
+            wait_for_result,
+            gcs_inputs,
+        )
+
+    def _run_script(
+        self, script, env_vars, gcs_target, gcs_mounts, wait_for_result, gcs_inputs
+    ):
         subscriber = self.gcloud.get_subscriber()
         publisher = self.gcloud.get_publisher()
         env_vars = env_vars or {}
         gcs_target = gcs_target or {}
         gcs_mounts = gcs_mounts or {}
-        script = translate_args_to_script(args)
+        gcs_inputs = gcs_inputs or {}
 
-        machine_config = self._create_machine_config(
-            script, env_vars, gcs_target, gcs_mounts
+        self.result = self._lookup_result(
+            script, env_vars, gcs_target, gcs_mounts, gcs_inputs
         )
+        if self.result is not None:
+            self._record(FINISHED, self.result)
+            return self.result
+
+        self._auto_size()
+        candidates = ZonePlacement(self.job_config).candidates()
+        max_run_duration = self.job_config.get(
+            "max_run_duration_seconds", self.timeout_seconds
+        )
+        if max_run_duration:
+            self.deadline = int(time.time() + max_run_duration)
 
         self.job_status_topic = None
         self.job_status_subscription = None
         try:
-            self.job_status_topic = self._create_status_topic(publisher)
-            self.job_status_subscription = self._create_status_subscription(
-                publisher, subscriber
+            with self._span("create_status_topic"):
+                self.job_status_topic = self._create_status_topic(publisher)
+            with self._span("create_status_subscription"):
+                self.job_status_subscription = self._create_status_subscription(
+                    publisher, subscriber
+                )
+            self._record(PLACING)
+            self._place(
+                candidates, script, env_vars, gcs_target, gcs_mounts, gcs_inputs
             )
-            self._create_instance_template(machine_config)
-            self._create_managed_instance_group(1)
-            self.started = True
             if wait_for_result:
                 return self.attach(self.timeout_seconds)
         except Exception as ex:
@@ -508,6 +1881,7 @@ class Job:
                         f"Could not remove pubsub subscription. Message: {e}"
                     )
 
+            self._record(FAILED)
             raise ex
 
     def run_file(
@@ -517,6 +1891,7 @@ class Job:
         gcs_target: Optional[Dict[str, str]] = None,
         gcs_mounts: Optional[Dict[str, str]] = None,
         wait_for_result: bool = False,
+        gcs_inputs: Optional[Dict[str, Any]] = None,
     ):
         """
         Runs a script which is given as a file.
@@ -526,18 +1901,29 @@ class Job:
             env_vars (dict): Environment variables which can be used by the script.
             gcs_target (dict): Files which will be copied to GCS when the script is done.
             gcs_mounts (dict): Buckets which will be mounted using gcsfuse (if available).
+            wait_for_result (bool): If true, blocks until the job is complete.
+            gcs_inputs (dict): GCS prefixes which will be copied to local disk
+                before the script starts (see normalize_gcs_inputs).
         """
-        env_vars = env_vars or {}
-        gcs_target = gcs_target or {}
-        gcs_mounts = gcs_mounts or {}
-
         with open(script_file, "r") as f:
             script = f.read()
-        return self.run(script, wait_for_result, env_vars, gcs_target)
+        return self._run_script(
+            script, env_vars, gcs_target, gcs_mounts, wait_for_result, gcs_inputs
+        )
 
-    def _create_machine_config(self, script, env_vars, gcs_target, gcs_mounts):
+    def _create_machine_config(
+        self, script, env_vars, gcs_target, gcs_mounts, gcs_inputs=None
+    ):
         cloud_init = CloudInitConfig(
-            self.name, script, self.job_config, env_vars, gcs_target, gcs_mounts
+            self.name,
+            script,
+            self.job_config,
+            env_vars,
+            gcs_target,
+            gcs_mounts,
+            gcs_inputs,
+            deadline=self.deadline,
+            gcloud=self.gcloud,
         )
 
         return MachineConfig(
@@ -548,13 +1934,23 @@ class Job:
         """
         Sets a callback function which is executed when the job is complete.
         """
+        if self.result is not None:
+            callback(self.result["status"])
+            return
+
         if not self.started:
             raise ValueError("The job is not running")
 
         def pubsub_callback(message):
-            data = json.loads(message.data)
-            callback(data["status"])
+            result = self._receive(json.loads(message.data))
             message.ack()
+            with self._rank_lock:
+                # the other ranks of a failed multi-node job are ignored
+                if result is None or self.result is not None:
+                    return
+                self.result = result
+            self._finish(result)
+            callback(result["status"])
 
         self.gcloud.get_subscriber().subscribe(
             self.job_status_subscription, pubsub_callback
@@ -566,15 +1962,19 @@ class Job:
             self.gcloud.get_compute_client()
             .instanceGroups()
             .list(project=self.job_config["project_id"], zone=self.job_config["zone"])
-            .execute()["items"]
+            .execute()
+            .get("items", [])
         ):
             res.append(group["name"])
         return res
 
+    def has_instance_group(self) -> bool:
+        """ True until the VM of a complete job has removed its instance group """
+        return self.name in self._retrieve_active_instance_groups()
+
     def _wait_for_instance_group_removal(self) -> None:
         while True:
-            active_instance_groups = self._retrieve_active_instance_groups()
-            if self.name in active_instance_groups:
+            if self.has_instance_group():
                 logger.debug("Instance group is still active. Waiting...")
                 time.sleep(Job.POLLING_INTERVAL_SECONDS)
             else:
@@ -588,9 +1988,62 @@ class Job:
         related instance group is not present anymore.
         """
         if self.started:
-            logger.debug("Deleting instance template...")
+            with self._span("clean_up"):
+                logger.debug("Deleting instance template...")
+                if self.nodes() > 1:
+                    with self._span("remove_instance_group"):
+                        self._tear_down_nodes()
+                else:
+                    with self._span("wait_for_instance_group_removal"):
+                        self._wait_for_instance_group_removal()
+                with self._span("remove_instance_template"):
+                    try:
+                        self._remove_instance_template()
+                    except Exception as e:
+                        # e.g. a job of a previous try which was cleaned up
+                        if not is_not_found(e):
+                            raise
+                        logger.debug(f"Instance template is gone. Message: {e}")
+                with self._span("remove_status_subscription"):
+                    self._remove_status_subscription()
+                if self.nodes() > 1:
+                    self._remove_status_topic()
+            self._record(CLEANED_UP)
+
+    def _tear_down_nodes(self):
+        """
+        Waits for the result of a multi-node job and removes its remaining VMs
+
+        (successful ranks only remove their own VM, so the instance group is
+        left over, while a failed rank removes the instance group itself)
+        """
+        if self.result is None:
+            self.attach(self.timeout_seconds)
+        try:
+            self._remove_instance_group()
+        except Exception as e:
+            if is_not_found(e):
+                return
+            # e.g. a failed rank is removing the instance group right now
+            logger.debug(f"Could not remove instance group. Message: {e}")
             self._wait_for_instance_group_removal()
-            self._remove_instance_template()
+
+    def _remove_status_topic(self):
+        """ Deletes the topic, which the VMs of multi-node jobs leave behind """
+        try:
+            self.gcloud.get_publisher().delete_topic(self.job_status_topic)
+        except Exception as e:
+            if not is_not_found(e):
+                logger.warning(f"Could not remove pubsub topic. Message: {e}")
+
+    def _remove_status_subscription(self):
+        """ Deletes the subscription, which outlives the job for reattaching """
+        try:
+            self.gcloud.get_subscriber().delete_subscription(
+                self.job_status_subscription
+            )
+        except Exception as e:
+            logger.warning(f"Could not remove pubsub subscription. Message: {e}")
 
     def _remove_instance_template(self):
         if not self.started:
@@ -624,26 +2077,127 @@ class Job:
         """
         Blocks until the job terminates.
         """
+        if self.result is not None:
+            return self.result
+
         if not self.started:
             raise ValueError("The job is not running")
 
         subscriber = self.gcloud.get_subscriber()
         start_time = time.time()
-        while not timeout_seconds or (time.time() - start_time) <= timeout_seconds:
-            message = self._pull_message(subscriber, self.job_status_subscription)
-            if message:
-                return json.loads(message.data)
+        with self._span("attach"):
+            while not timeout_seconds or (time.time() - start_time) <= timeout_seconds:
+                message = self._pull_message(subscriber, self.job_status_subscription)
+                result = self._receive(json.loads(message.data)) if message else None
+                if result:
+                    self._finish(result)
+                    return result
 
         raise TimeoutError(f"The job took longer than {timeout_seconds} seconds")
 
-    def _pull_message(self, subscriber, subscription_path):
+    def poll(self) -> Optional[Dict[str, Any]]:
+        """
+        Returns the result if the job is complete (without blocking) or None.
+        """
+        if self.result is not None:
+            return self.result
+
+        if not self.started:
+            raise ValueError("The job is not running")
+
+        subscriber = self.gcloud.get_subscriber()
+        while True:
+            message = self._pull_message(
+                subscriber, self.job_status_subscription, return_immediately=True
+            )
+            if not message:
+                return None
+            result = self._receive(json.loads(message.data))
+            if result:
+                self._finish(result)
+                return result
+
+    def logs(
+        self, since: Optional[float] = None, follow: bool = False, page_size: int = 1000
+    ) -> Iterator[Dict[str, Any]]:
+        """
+        Yields the log lines of the container from Cloud Logging (oldest
+        first) as dictionaries with the keys timestamp, instance and line.
+
+        Unlike the logs of the result, they are complete (within the
+        retention of Cloud Logging). The entries are fetched page by page.
+
+        :param since only lines which were logged since then (a timestamp)
+        :param follow if true, waits for new lines until the job is complete
+        :param page_size the number of entries per request
+        """
+        client = self.gcloud.get_logging(self.job_config["project_id"])
+        complete = not follow or self._is_complete()
+        last_timestamp = since
+        # the entries of the last timestamp, which the next query returns again
+        seen = set()
+        while True:
+            entries = client.list_entries(
+                filter_=self._logs_filter(last_timestamp),
+                order_by="timestamp asc",
+                page_size=page_size,
+            )
+            for entry in entries:
+                if entry.insert_id in seen:
+                    continue
+                timestamp = entry.timestamp.timestamp()
+                if timestamp != last_timestamp:
+                    last_timestamp = timestamp
+                    seen = set()
+                seen.add(entry.insert_id)
+                payload = entry.payload or {}
+                yield {
+                    "timestamp": timestamp,
+                    "instance": payload.get("instance", {}).get("name"),
+                    "line": payload.get("message", ""),
+                }
+            if complete:
+                return
+            time.sleep(Job.LOGS_POLLING_INTERVAL_SECONDS)
+            # once the job is complete, a last query fetches the remaining lines
+            complete = self._is_complete()
+
+    def _logs_filter(self, since):
+        project_id = self.job_config["project_id"]
+        conditions = [
+            f'logName="projects/{project_id}/logs/{CONTAINER_LOG_NAME}"',
+            'jsonPayload.container.name="/clash-runner"',
+            # the VMs are named after the job (e.g. <job name>-x7z1 or <job name>-1)
+            f'jsonPayload.instance.name:"{self.name}-"',
+        ]
+        if since is not None:
+            timestamp = datetime.fromtimestamp(since, timezone.utc).isoformat()
+            conditions.append(f'timestamp>="{timestamp}"')
+        return " AND ".join(conditions)
+
+    def _is_complete(self):
+        if self.result is not None:
+            return True
+        if not self.started:
+            return True  # never runs
+        return self.poll() is not None
+
+    def _pull_message(self, subscriber, subscription_path, return_immediately=False):
         """ Pulls a PubSub message """
-        response = subscriber.pull(
-            subscription_path,
-            max_messages=1,
-            return_immediately=False,
-            timeout=Job.POLLING_INTERVAL_SECONDS,
-        )
+        try:
+            response = subscriber.pull(
+                subscription_path,
+                max_messages=1,
+                return_immediately=return_immediately,
+                timeout=Job.POLLING_INTERVAL_SECONDS,
+            )
+        except Exception as e:
+            if is_not_found(e):
+                raise ValueError(
+                    f"The status subscription of job {self.name} does not exist "
+                    "(the job was cleaned up or started by an older Clash version)"
+                ) from e
+            raise
 
         if len(response.received_messages) > 0:
             message = response.received_messages[0]
@@ -659,16 +2213,10 @@ class Job:
             self.job_config["project_id"], self.name
         )
 
-        message_storage_policy = (
-            lambda regions: MessageStoragePolicy(allowed_persistence_regions=regions)
-            if regions
-            else None
-        )
         publisher.create_topic(
             job_status_topic,
-            message_storage_policy=message_storage_policy(
-                self.job_config.get("allowed_persistence_regions")
-            ),
+            message_storage_policy=message_storage_policy(self.job_config),
+            labels=resource_labels(),
         )
         return job_status_topic
 
@@ -681,7 +2229,9 @@ class Job:
             raise ValueError(f"Could not find status topic for job {self.name}")
 
         subscription_path = subscriber.subscription_path(project_id, self.name)
-        subscriber.create_subscription(subscription_path, self.job_status_topic)
+        subscriber.create_subscription(
+            subscription_path, self.job_status_topic, labels=resource_labels()
+        )
 
         return subscription_path
 
@@ -2,39 +2,59 @@
 
 import sys
 import base64
+import json
+import time
 
 import click
 
-from pyclash.clash import JobConfigBuilder, Job
-
+from pyclash.clash import (
+    CloudSdk,
+    JobConfigBuilder,
+    Job,
+    JobFactory,
+    JobGroup,
+    JobRuntimeSpec,
+)
+from pyclash.bake import ImageBaker
+from pyclash.sweeper import ResourceSweeper, DEFAULT_TTL_SECONDS
+from pyclash.registry import (
+    SqliteJobRegistry,
+    DEFAULT_REGISTRY_PATH,
+    SUBMITTED,
+    FINISHED,
+)
 
-@click.group()
-def cli():
-    pass
+JOB_CONFIG_OPTIONS = [
+    click.option("--project", type=click.STRING, required=True),
+    click.option("--image", type=click.STRING, required=True),
+    click.option("--subnetwork", type=click.STRING, required=True),
+    click.option("--serviceaccount", type=click.STRING, required=False, default=None),
+    click.option("--preemptible", type=click.BOOL, required=False, default=False),
+    click.option(
+        "--machine-type", type=click.STRING, default="n1-standard-1", required=False
+    ),
+]
 
+WAIT_POLLING_INTERVAL_SECONDS = 5
 
-@cli.command()
-@click.option("--name", type=click.STRING, required=True)
-@click.option("--project", type=click.STRING, required=True)
-@click.option("--image", type=click.STRING, required=True)
-@click.option("--subnetwork", type=click.STRING, required=True)
-@click.option("--serviceaccount", type=click.STRING, required=False, default=None)
-@click.option("--preemptible", type=click.BOOL, required=False, default=False)
-@click.option("--timeout", type=click.INT, required=False, default=60 * 60)
-@click.option(
-    "--machine-type", type=click.STRING, default="n1-standard-1", required=False
+registry_option = click.option(
+    "--registry",
+    "registry_path",
+    type=click.STRING,
+    default=DEFAULT_REGISTRY_PATH,
+    show_default=True,
+    help="The SQLite database which records the submitted jobs.",
 )
-@click.option("--arg", type=click.STRING, required=True, multiple=True)
-def run(
-    name,
-    project,
-    image,
-    subnetwork,
-    serviceaccount,
-    preemptible,
-    timeout,
-    machine_type,
-    arg,
+
+
+def job_config_options(function):
+    for option in reversed(JOB_CONFIG_OPTIONS):
+        function = option(function)
+    return function
+
+
+def build_job_config(
+    project, image, subnetwork, serviceaccount, preemptible, machine_type
 ):
     config = (
         JobConfigBuilder()
@@ -46,12 +66,254 @@ def run(
     )
     if serviceaccount:
         config.service_account(serviceaccount)
+    return config.build()
+
+
+def load_jobs(registry, names):
+    """ Recreates the jobs of the given job or group names from the registry """
+    jobs = []
+    for name in names:
+        record = registry.get(name)
+        records = [record] if record else registry.group_members(name)
+        if not records:
+            raise click.ClickException(f"Unknown job or group {name}")
+        jobs += [
+            Job.from_state(
+                r["state"], gcloud=CloudSdk(), registry=registry, result=r["result"]
+            )
+            for r in records
+        ]
+    return jobs
+
+
+def job_summary(registry, job):
+    record = registry.get(job.name)
+    result = record["result"] if record else None
+    return {
+        "name": job.name,
+        "group": job.group,
+        "group_index": job.group_index,
+        "status": record["status"] if record else None,
+        "exit_code": result["status"] if result else None,
+    }
 
+
+def write_json(data):
+    sys.stdout.write(json.dumps(data) + "\n")
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option("--name", type=click.STRING, required=True)
+@job_config_options
+@click.option("--timeout", type=click.INT, required=False, default=60 * 60)
+@click.option("--arg", type=click.STRING, required=True, multiple=True)
+def run(name, timeout, arg, **config):
     with Job(
-        job_config=config.build(), name_prefix=name, timeout_seconds=timeout
+        job_config=build_job_config(**config), name_prefix=name, timeout_seconds=timeout
     ) as job:
         result = job.run(arg, wait_for_result=True)
         sys.stdout.write(base64.b64decode(result["logs"]).decode("utf-8"))
         sys.exit(result["status"])
 
     sys.exit(-3)
+
+
+@cli.command()
+@click.option("--name", type=click.STRING, required=True, help="The group name.")
+@job_config_options
+@click.option(
+    "--manifest",
+    type=click.File("r"),
+    required=True,
+    help="A JSON object per line with the keys args, env_vars, gcs_mounts, "
+    "gcs_target and gcs_inputs ('-' reads from stdin).",
+)
+@click.option(
+    "--parallel",
+    type=click.INT,
+    default=1,
+    show_default=True,
+    help="The number of jobs which are submitted concurrently.",
+)
+@registry_option
+def submit(name, manifest, parallel, registry_path, **config):
+    """ Submits the jobs of a manifest as a group without waiting for them """
+    registry = SqliteJobRegistry(registry_path)
+    group = JobGroup(
+        name,
+        JobFactory(build_job_config(**config), gcloud=CloudSdk(), registry=registry),
+    )
+    for line in manifest:
+        if line.strip():
+            group.add_job(JobRuntimeSpec(**json.loads(line)))
+
+    try:
+        group.run(parallelism=parallel, subscribe=False)
+    finally:
+        for job in group.running_jobs:
+            write_json(job_summary(registry, job))
+
+
+@cli.command()
+@click.argument("names", nargs=-1, required=True)
+@registry_option
+def status(names, registry_path):
+    """ Writes the status of jobs or groups as JSON lines """
+    registry = SqliteJobRegistry(registry_path)
+    for job in load_jobs(registry, names):
+        if registry.get(job.name)["status"] == SUBMITTED:
+            job.poll()
+        write_json(job_summary(registry, job))
+
+
+@cli.command()
+@click.argument("names", nargs=-1, required=True)
+@click.option("--timeout", type=click.INT, default=None, help="In seconds.")
+@click.option("--clean-up/--no-clean-up", default=True, show_default=True)
+@registry_option
+def wait(names, timeout, clean_up, registry_path):
+    """
+    Blocks until jobs or groups are complete and writes their status as
+    JSON lines. Exits with 1 if a job failed or did not finish in time.
+    """
+    registry = SqliteJobRegistry(registry_path)
+    deadline = time.time() + timeout if timeout else None
+    jobs = load_jobs(registry, names)
+
+    # poll all jobs and re-check the registry, since other processes (e.g.
+    # another clash wait) might receive the results
+    pending = [job for job in jobs if registry.get(job.name)["status"] == SUBMITTED]
+    while pending and (deadline is None or time.time() < deadline):
+        for job in list(pending):
+            record = registry.get(job.name)
+            if record["result"] is not None:
+                job.result = record["result"]
+            if job.result is not None or job.poll() is not None:
+                pending.remove(job)
+        if pending:
+            time.sleep(WAIT_POLLING_INTERVAL_SECONDS)
+
+    succeeded = True
+    for job in jobs:
+        if clean_up and job.result is not None:
+            if registry.get(job.name)["status"] == FINISHED:
+                job.clean_up()
+
+        summary = job_summary(registry, job)
+        succeeded = succeeded and summary["exit_code"] == 0
+        write_json(summary)
+
+    sys.exit(0 if succeeded else 1)
+
+
+@cli.command()
+@click.argument("names", nargs=-1, required=True)
+@click.option("--raw", is_flag=True, help="Writes the plain logs (without JSON).")
+@click.option(
+    "--full",
+    is_flag=True,
+    help="Reads the complete logs from Cloud Logging (as a JSON line per line).",
+)
+@click.option(
+    "--follow", is_flag=True, help="Like --full, but waits for the jobs to complete."
+)
+@click.option("--since", type=click.FLOAT, default=None, help="A timestamp (--full).")
+@registry_option
+def logs(names, raw, full, follow, since, registry_path):
+    """ Writes the logs of complete jobs as JSON lines """
+    registry = SqliteJobRegistry(registry_path)
+    if full or follow:
+        for job in load_jobs(registry, names):
+            for line in job.logs(since=since, follow=follow):
+                if raw:
+                    sys.stdout.write(line["line"] + "\n")
+                else:
+                    write_json(dict(line, name=job.name, group_index=job.group_index))
+        return
+
+    for job in load_jobs(registry, names):
+        if registry.get(job.name)["status"] == SUBMITTED:
+            job.poll()
+        result = job.result
+        text = base64.b64decode(result["logs"]).decode("utf-8") if result else None
+        if raw:
+            sys.stdout.write(text or "")
+        else:
+            write_json({"name": job.name, "group_index": job.group_index, "logs": text})
+
+
+@cli.command()
+@click.option("--project", type=click.STRING, required=True)
+@click.option(
+    "--ttl-hours",
+    type=click.FLOAT,
+    default=DEFAULT_TTL_SECONDS / 3600,
+    show_default=True,
+    help="Only resources which are older are removed.",
+)
+@click.option(
+    "--parallel",
+    type=click.INT,
+    default=10,
+    show_default=True,
+    help="The number of resources which are removed concurrently.",
+)
+@click.option("--dry-run", is_flag=True, help="Only writes the stale resources.")
+@click.option(
+    "--include-unlabelled",
+    is_flag=True,
+    help="Also removes topics and subscriptions of older Clash versions.",
+)
+def gc(project, ttl_hours, parallel, dry_run, include_unlabelled):
+    """
+    Removes the left-overs of jobs which were never cleaned up and writes
+    them as JSON lines. Exits with 1 if a resource could not be removed.
+    """
+    sweeper = ResourceSweeper(
+        project,
+        gcloud=CloudSdk(),
+        ttl_seconds=ttl_hours * 3600,
+        parallelism=parallel,
+        include_unlabelled=include_unlabelled,
+    )
+    resources = sweeper.sweep(dry_run=dry_run)
+    for resource in resources:
+        write_json(resource)
+    sys.exit(0 if all(r.get("deleted", True) for r in resources) else 1)
+
+
+@cli.command()
+@click.option("--project", type=click.STRING, required=True)
+@click.option("--zone", type=click.STRING, default="europe-west1-b", show_default=True)
+@click.option("--subnetwork", type=click.STRING, required=True)
+@click.option("--family", type=click.STRING, required=True)
+@click.option(
+    "--image",
+    type=click.STRING,
+    required=True,
+    multiple=True,
+    help="A Docker image which is pulled onto the disk image.",
+)
+@click.option(
+    "--machine-type", type=click.STRING, default="n1-standard-1", show_default=True
+)
+@click.option("--boot-disk-size", type=click.INT, default=100, show_default=True)
+def bake(project, zone, subnetwork, family, image, machine_type, boot_disk_size):
+    """
+    Creates a disk image of the family with the Docker images pulled and
+    writes its name and the digests of the images as JSON
+    """
+    baker = ImageBaker(
+        project,
+        zone,
+        subnetwork,
+        gcloud=CloudSdk(),
+        machine_type=machine_type,
+        boot_disk_size_gb=boot_disk_size,
+    )
+    write_json(baker.bake(list(image), family))
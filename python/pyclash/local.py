@@ -0,0 +1,608 @@
+""" Runs Clash jobs on the local machine instead of the Google Compute Engine """
+
+from typing import Any, Dict, List, Optional
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+import base64
+import itertools
+import json
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+
+import yaml
+
+from pyclash.clash import CloudSdk, JobFactory
+
+logger = logging.getLogger(__name__)
+
+# PubSub restricts the message size, so only the tail of the logs is sent
+MAX_LOG_BYTES = 2097152
+
+
+class NotFoundError(Exception):
+    """ Mirrors the 404 errors of the Google APIs """
+
+    code = 404
+
+    def __init__(self, resource):
+        super().__init__(f"{resource} not found")
+
+
+# the number of vCPUs of shared-core machine types
+SHARED_CORE_VCPUS = {
+    "f1-micro": 0.2,
+    "g1-small": 0.5,
+    "e2-micro": 0.25,
+    "e2-small": 0.5,
+    "e2-medium": 1,
+}
+
+Topic = namedtuple("Topic", "name")
+PullResponse = namedtuple("PullResponse", "received_messages")
+ReceivedMessage = namedtuple("ReceivedMessage", "ack_id message")
+
+
+class LocalMessage:
+    def __init__(self, data):
+        self.data = data
+
+    def ack(self):
+        pass
+
+
+class InMemoryCloud:
+    """
+    Stands in for CloudSdk and keeps topics, subscriptions, instance
+    templates and instance groups in memory.
+
+    Subclasses decide what happens to the VM of a new instance group
+    (_start) and may account for the API calls (_call). Status messages
+    are delivered to the subscriptions of their topic, either by pull or
+    by streaming them to a callback on a worker thread.
+    """
+
+    def __init__(self, max_callback_workers: int = 4):
+        self.topics = {}
+        self.subscriptions = {}
+        self.templates = {}
+        self.instance_groups = {}
+        self._lock = threading.Lock()
+        self._callback_executor = ThreadPoolExecutor(max_workers=max_callback_workers)
+
+    def get_compute_client(self):
+        return _LocalCompute(self)
+
+    def get_publisher(self):
+        return _LocalPublisher(self)
+
+    def get_subscriber(self):
+        return _LocalSubscriber(self)
+
+    def get_logging(self, project=None):
+        raise NotImplementedError("Logging is not available in memory")
+
+    def shutdown(self, wait: bool = True):
+        """ Stops the callback workers """
+        self._callback_executor.shutdown(wait=wait)
+
+    def _call(self, method):
+        """ Called before every API call (e.g. compute.instanceTemplates.insert) """
+
+    def _start(self, project, zone, name, template_name):
+        """ Starts the VM of a new instance group """
+        raise NotImplementedError()
+
+    def _add_instance_group(self, project, zone, name, running=False):
+        with self._lock:
+            self.instance_groups[(zone, name)] = {
+                "name": name,
+                "project": project,
+                "targetSize": 1,
+                "currentActions": {"creating": 0, "none": 1}
+                if running
+                else {"creating": 1, "none": 0},
+            }
+
+    def _finish(self, project, zone, name, result):
+        """ Publishes the result and removes the VM like the runner on GCE """
+        topic = f"projects/{project}/topics/{name}"
+        with self._lock:
+            self.instance_groups.pop((zone, name), None)
+        self._deliver(topic, json.dumps(result).encode())
+        with self._lock:
+            self.topics.pop(topic, None)
+
+    def _subscription(self, name):
+        with self._lock:
+            if name not in self.subscriptions:
+                raise NotFoundError(f"Subscription {name}")
+            return self.subscriptions[name]
+
+    def _deliver(self, topic, data):
+        with self._lock:
+            subscriptions = [s for s in self.subscriptions.values() if s.topic == topic]
+        for subscription in subscriptions:
+            subscription.put(data)
+
+
+class LocalBackend(InMemoryCloud):
+    """
+    Runs jobs on the local machine instead of GCE.
+
+    Creating the instance group of a job runs the script of its cloud-init
+    configuration (/var/script.sh with the variables of /var/clash.env) in a
+    local Docker container or, without Docker, in a subprocess. Jobs share a
+    pool of max_workers workers. Once a script is done, its instance group is
+    removed and the result is published to the status topic of the job in
+    the same format as on GCE, so that Job.run, attach, on_finish and
+    clean_up work unchanged.
+
+    Multi-node jobs, local SSDs, data disks and the GCS features (gcs_inputs,
+    gcs_target and gcs_mounts) are not available locally. Creating the instance group of
+    such a job raises a ValueError.
+    """
+
+    def __init__(self, max_workers: int = 4, use_docker: bool = True):
+        super().__init__(max_callback_workers=max_workers)
+        self.use_docker = use_docker
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def get_logging(self, project=None):
+        raise NotImplementedError("The logs of local jobs are part of their result")
+
+    def shutdown(self, wait: bool = True):
+        """ Stops the workers (and waits for running jobs) """
+        self._executor.shutdown(wait=wait)
+        super().shutdown(wait=wait)
+
+    def _start(self, project, zone, name, template_name):
+        with self._lock:
+            template = self.templates[template_name.rsplit("/", 1)[-1]]
+        user_data = template["properties"]["metadata"]["items"][0]["value"]
+        unsupported = _unsupported_features(_cloud_init_files(user_data))
+        if unsupported:
+            raise ValueError(
+                f"Job {name} cannot run locally, since it needs {', '.join(unsupported)}"
+            )
+
+        self._add_instance_group(project, zone, name)
+        self._executor.submit(self._execute, project, zone, name, user_data)
+
+    def _execute(self, project, zone, name, user_data):
+        with self._lock:
+            group = self.instance_groups.get((zone, name))
+            if group is None:
+                return  # removed before it was started
+            group["currentActions"] = {"creating": 0, "none": 1}
+
+        try:
+            result = self._run_script(name, user_data)
+        except Exception as e:
+            logger.exception(f"Could not run job {name}")
+            result = {
+                "status": 1,
+                "logs": base64.b64encode(str(e).encode()).decode(),
+                "timings": {},
+            }
+        self._finish(project, zone, name, result)
+
+    def _run_script(self, name, user_data) -> Dict[str, Any]:
+        files = _cloud_init_files(user_data)
+        image = _runner_image(files["/var/clash-runner.sh"])
+
+        workdir = tempfile.mkdtemp(prefix=f"{name}-")
+        try:
+            script_path = os.path.join(workdir, "script.sh")
+            env_path = os.path.join(workdir, "clash.env")
+            timings_path = os.path.join(workdir, "clash-timings")
+            open(timings_path, "w").close()
+            with open(env_path, "w") as f:
+                f.write(files.get("/var/clash.env", ""))
+
+            script = files["/var/script.sh"]
+            if self.use_docker:
+                command = [
+                    "docker",
+                    "run",
+                    "--rm",
+                    "--env-file",
+                    env_path,
+                    "-v",
+                    f"{script_path}:/var/script.sh",
+                    "-v",
+                    f"{timings_path}:/tmp/clash-timings",
+                    image,
+                    "bash",
+                    "/var/script.sh",
+                ]
+                env = None
+            else:
+                # keep the state files of concurrent jobs apart
+                script = script.replace("/tmp/clash-", f"{workdir}/clash-")
+                command = ["bash", script_path]
+                env = dict(os.environ, **_read_env_file(env_path))
+            with open(script_path, "w") as f:
+                f.write(script)
+
+            start = time.time()
+            process = subprocess.run(
+                command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env
+            )
+            timings = _read_timings(timings_path)
+            timings["run"] = {"start": start, "end": time.time()}
+        finally:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+        return {
+            "status": process.returncode,
+            "logs": base64.b64encode(process.stdout[-MAX_LOG_BYTES:]).decode(),
+            "timings": timings,
+        }
+
+
+def _cloud_init_files(user_data) -> Dict[str, str]:
+    """ Returns the contents of the files of a cloud-init configuration by path """
+    config = yaml.safe_load(user_data)
+    return {f["path"]: f["content"] for f in config.get("write_files", [])}
+
+
+def _unsupported_features(files) -> List[str]:
+    """ Returns the features of a cloud-init configuration which need GCE """
+    runner = files.get("/var/clash-runner.sh", "")
+    script = files.get("/var/script.sh", "")
+    features = []
+    if "--network host -e CLASH_RANK=" in runner:
+        features.append("multiple nodes")
+    if "/var/clash-fetch.sh" in files:
+        features.append("a staging bucket")
+    if "/var/clash-disks.sh" in files:
+        features.append("local SSDs or data disks")
+    if "staging_start=" in runner:
+        features.append("gcs_inputs")
+    if "upload_start=" in script:
+        features.append("gcs_target")
+    if "mounts_start=" in script:
+        features.append("gcs_mounts")
+    if "gcloud pubsub subscriptions pull" in script:
+        features.append("a work queue (JobGroup.map)")
+    return features
+
+
+def _runner_image(runner_script) -> str:
+    """ Returns the image of the job container """
+    match = re.search(r"--name=clash-runner (\S+) bash /var/script.sh", runner_script)
+    if not match:
+        raise ValueError("Could not find the image in the runner script")
+    return match.group(1)
+
+
+def _read_env_file(path) -> Dict[str, str]:
+    env_vars = {}
+    with open(path, "r") as f:
+        for line in f:
+            if "=" in line:
+                var, value = line.rstrip("\n").split("=", 1)
+                env_vars[var] = value
+    return env_vars
+
+
+def _read_timings(path) -> Dict[str, Dict[str, float]]:
+    """ Parses the lines "<phase> <start> <end>" of a timings file """
+    timings = {}
+    with open(path, "r") as f:
+        for line in f:
+            phase, start, end = line.split()
+            timings[phase] = {"start": float(start), "end": float(end)}
+    return timings
+
+
+class _Request:
+    def __init__(self, backend, method, function):
+        self._backend = backend
+        self._method = method
+        self._function = function
+
+    def execute(self, *args, **kwargs):
+        self._backend._call(self._method)
+        return self._function()
+
+
+class _LocalCompute:
+    def __init__(self, backend):
+        self._backend = backend
+        self._operations = itertools.count()
+
+    def _operation(self):
+        return {"name": f"local-operation-{next(self._operations)}"}
+
+    def images(self):
+        return _Images(self._backend)
+
+    def instanceTemplates(self):
+        return _InstanceTemplates(self)
+
+    def instanceGroupManagers(self):
+        return _InstanceGroupManagers(self)
+
+    def instanceGroups(self):
+        return _InstanceGroups(self._backend)
+
+    def globalOperations(self):
+        return _Operations(self._backend, "compute.globalOperations.get")
+
+    def zoneOperations(self):
+        return _Operations(self._backend, "compute.zoneOperations.get")
+
+
+class _Images:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def getFromFamily(self, project, family):
+        return _Request(
+            self._backend,
+            "compute.images.getFromFamily",
+            lambda: {"selfLink": f"projects/{project}/global/images/family/{family}"},
+        )
+
+
+class _InstanceTemplates:
+    def __init__(self, compute):
+        self._compute = compute
+        self._backend = compute._backend
+
+    def insert(self, project, body, requestId=None):
+        def insert():
+            with self._backend._lock:
+                self._backend.templates[body["name"]] = body
+            return self._compute._operation()
+
+        return _Request(self._backend, "compute.instanceTemplates.insert", insert)
+
+    def delete(self, project, instanceTemplate, requestId=None):
+        def delete():
+            with self._backend._lock:
+                self._backend.templates.pop(instanceTemplate, None)
+            return self._compute._operation()
+
+        return _Request(self._backend, "compute.instanceTemplates.delete", delete)
+
+
+class _InstanceGroupManagers:
+    def __init__(self, compute):
+        self._compute = compute
+        self._backend = compute._backend
+
+    def insert(self, project, zone, body, requestId=None):
+        def insert():
+            self._backend._start(project, zone, body["name"], body["instanceTemplate"])
+            return self._compute._operation()
+
+        return _Request(self._backend, "compute.instanceGroupManagers.insert", insert)
+
+    def delete(self, project, zone, instanceGroupManager, requestId=None):
+        def delete():
+            with self._backend._lock:
+                self._backend.instance_groups.pop((zone, instanceGroupManager), None)
+            return self._compute._operation()
+
+        return _Request(self._backend, "compute.instanceGroupManagers.delete", delete)
+
+    def get(self, project, zone, instanceGroupManager):
+        def get():
+            with self._backend._lock:
+                group = self._backend.instance_groups.get((zone, instanceGroupManager))
+                if group is None:
+                    raise NotFoundError(f"Instance group {instanceGroupManager}")
+                return dict(group)
+
+        return _Request(self._backend, "compute.instanceGroupManagers.get", get)
+
+    def listErrors(self, project, zone, instanceGroupManager):
+        return _Request(
+            self._backend, "compute.instanceGroupManagers.listErrors", lambda: {}
+        )
+
+
+class _InstanceGroups:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def list(self, project, zone):
+        def list_groups():
+            with self._backend._lock:
+                names = [n for (z, n) in self._backend.instance_groups if z == zone]
+            # like the real API, the response has no items if the list is empty
+            return {"items": [{"name": name} for name in names]} if names else {}
+
+        return _Request(self._backend, "compute.instanceGroups.list", list_groups)
+
+
+class _Operations:
+    def __init__(self, backend, method):
+        self._backend = backend
+        self._method = method
+
+    def get(self, **kwargs):
+        return _Request(self._backend, self._method, lambda: {"status": "DONE"})
+
+
+class _Subscription:
+    def __init__(self, backend, topic):
+        self.topic = topic
+        self._backend = backend
+        self._messages = []
+        self._callback = None
+        self._condition = threading.Condition()
+
+    def put(self, data):
+        with self._condition:
+            callback = self._callback
+            if not callback:
+                self._messages.append(data)
+                self._condition.notify()
+                return
+        self._backend._callback_executor.submit(callback, LocalMessage(data))
+
+    def take(self, timeout):
+        with self._condition:
+            if not self._messages and timeout:
+                self._condition.wait(timeout)
+            return self._messages.pop(0) if self._messages else None
+
+    def stream_to(self, callback):
+        with self._condition:
+            self._callback = callback
+            pending, self._messages = self._messages, []
+        for data in pending:
+            self._backend._callback_executor.submit(callback, LocalMessage(data))
+
+
+class _LocalPublisher:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def topic_path(self, project, topic):
+        return f"projects/{project}/topics/{topic}"
+
+    def create_topic(self, name, **kwargs):
+        self._backend._call("pubsub.create_topic")
+        with self._backend._lock:
+            if name in self._backend.topics:
+                raise ValueError(f"Topic {name} already exists")
+            self._backend.topics[name] = kwargs
+        return Topic(name=name)
+
+    def list_topics(self, project):
+        self._backend._call("pubsub.list_topics")
+        with self._backend._lock:
+            return [
+                Topic(name=name)
+                for name in self._backend.topics
+                if name.startswith(f"{project}/")
+            ]
+
+    def delete_topic(self, topic):
+        self._backend._call("pubsub.delete_topic")
+        with self._backend._lock:
+            self._backend.topics.pop(topic, None)
+
+    def publish(self, topic, data, **attributes):
+        self._backend._call("pubsub.publish")
+        self._backend._deliver(topic, data)
+        future = Future()
+        future.set_result(None)
+        return future
+
+
+class _LocalSubscriber:
+    def __init__(self, backend):
+        self._backend = backend
+
+    def subscription_path(self, project, subscription):
+        return f"projects/{project}/subscriptions/{subscription}"
+
+    def create_subscription(self, name, topic, **kwargs):
+        self._backend._call("pubsub.create_subscription")
+        with self._backend._lock:
+            if topic not in self._backend.topics:
+                raise ValueError(f"Topic {topic} not found")
+            self._backend.subscriptions[name] = _Subscription(self._backend, topic)
+
+    def delete_subscription(self, subscription):
+        self._backend._call("pubsub.delete_subscription")
+        with self._backend._lock:
+            self._backend.subscriptions.pop(subscription, None)
+
+    def pull(
+        self, subscription, max_messages=1, return_immediately=False, timeout=None
+    ):
+        self._backend._call("pubsub.pull")
+        data = self._backend._subscription(subscription).take(
+            0 if return_immediately else timeout
+        )
+        if data is None:
+            return PullResponse(received_messages=[])
+        return PullResponse(
+            received_messages=[ReceivedMessage(ack_id=0, message=LocalMessage(data))]
+        )
+
+    def acknowledge(self, subscription, ack_ids):
+        self._backend._call("pubsub.acknowledge")
+
+    def subscribe(self, subscription, callback):
+        self._backend._call("pubsub.subscribe")
+        self._backend._subscription(subscription).stream_to(callback)
+        return Future()
+
+
+def machine_type_vcpus(machine_type: str) -> float:
+    """ Returns the number of vCPUs of a machine type (e.g. 4 for n1-standard-4) """
+    if machine_type in SHARED_CORE_VCPUS:
+        return SHARED_CORE_VCPUS[machine_type]
+    match = re.search(r"custom-(\d+)-", machine_type) or re.search(
+        r"-(\d+)$", machine_type
+    )
+    if not match:
+        raise ValueError(f"Unknown machine type {machine_type}")
+    return int(match.group(1))
+
+
+class SizeBasedRouting:
+    """
+    Runs small jobs locally and all others on GCE.
+
+    A job is small if it runs on a single node, its machine type has at most
+    max_local_vcpus vCPUs and it needs no local SSDs, data disks or GCS
+    features (gcs_inputs, gcs_target and gcs_mounts need GCE and its
+    service account).
+    """
+
+    def __init__(
+        self,
+        local_backend: Optional[LocalBackend] = None,
+        gcloud=None,
+        max_local_vcpus: float = 2,
+    ):
+        self.local_backend = local_backend or LocalBackend()
+        self.gcloud = gcloud or CloudSdk()
+        self.max_local_vcpus = max_local_vcpus
+
+    def is_local(self, job_config, runtime_spec=None) -> bool:
+        if job_config.get("local_ssds") or job_config.get("data_disks"):
+            return False
+        if job_config.get("nodes", 1) > 1:
+            return False
+        if runtime_spec is not None and (
+            runtime_spec.gcs_inputs
+            or runtime_spec.gcs_target
+            or runtime_spec.gcs_mounts
+        ):
+            return False
+        return machine_type_vcpus(job_config["machine_type"]) <= self.max_local_vcpus
+
+    def backend(self, job_config, runtime_spec=None):
+        """ Returns the backend (i.e. the gcloud of a job) for the configuration """
+        if self.is_local(job_config, runtime_spec):
+            return self.local_backend
+        return self.gcloud
+
+    def job_factory(
+        self, job_config, instrumentation=None, runtime_specs=()
+    ) -> JobFactory:
+        """
+        Returns a factory for a job or group. The jobs run locally only if
+        all of their runtime specifications (e.g. of a group) allow it.
+        """
+        is_local = all(self.is_local(job_config, spec) for spec in runtime_specs)
+        return JobFactory(
+            job_config,
+            gcloud=self.backend(job_config) if is_local else self.gcloud,
+            instrumentation=instrumentation,
+        )
@@ -0,0 +1,259 @@
+""" Rate limiting, retries and call accounting for the GCP clients """
+
+from typing import Dict, Optional
+from collections import Counter
+import logging
+import random
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# requests per second for each quota bucket
+DEFAULT_RATE_LIMITS = {
+    "compute.read": 20.0,
+    "compute.write": 10.0,
+    "pubsub.admin": 20.0,
+    "pubsub.data": 200.0,
+}
+
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+PUBSUB_DATA_METHODS = {
+    "publish",
+    "pull",
+    "acknowledge",
+    "modify_ack_deadline",
+    "subscribe",
+}
+
+# Compute methods which deduplicate retries by a requestId
+REQUEST_ID_METHODS = {"insert", "delete"}
+
+
+def quota_bucket(api: str, method: str) -> str:
+    """ Returns the quota bucket of an API method (e.g. compute.write) """
+    if api == "compute":
+        is_read = method.startswith(("get", "list", "aggregatedList"))
+        return "compute.read" if is_read else "compute.write"
+    return "pubsub.data" if method in PUBSUB_DATA_METHODS else "pubsub.admin"
+
+
+def is_retryable(error: Exception) -> bool:
+    """ True for rate limit errors (429 or Compute's rateLimitExceeded) and 5xx """
+    response = getattr(error, "resp", None)  # googleapiclient.errors.HttpError
+    if response is not None:
+        status = int(response.status)
+        if status == 403:
+            return b"ateLimitExceeded" in (getattr(error, "content", None) or b"")
+        return status in RETRYABLE_STATUS_CODES
+
+    code = getattr(error, "code", None)  # google.api_core.exceptions
+    return isinstance(code, int) and code in RETRYABLE_STATUS_CODES
+
+
+def is_already_exists(error: Exception) -> bool:
+    """ True if a create failed because the resource exists (409) """
+    response = getattr(error, "resp", None)
+    if response is not None:
+        return int(response.status) == 409
+    return getattr(error, "code", None) == 409
+
+
+class TokenBucket:
+    """ Allows `rate` calls per second with bursts of up to `capacity` calls """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """
+        Takes a token and blocks until it is available.
+
+        Returns:
+            float: the number of seconds spent waiting
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.capacity, self._tokens + (now - self._updated) * self.rate
+            )
+            self._updated = now
+            # tokens may become negative, which reserves them for waiting callers
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class ApiMetrics:
+    """ Counts the calls, retries and errors per API method """
+
+    def __init__(self):
+        self.calls = Counter()
+        self.retries = Counter()
+        self.errors = Counter()
+        self.throttled_seconds = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, counter: Counter, key: str, value: float = 1):
+        with self._lock:
+            counter[key] += value
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        """ Returns a copy of all counters """
+        with self._lock:
+            return {
+                "calls": dict(self.calls),
+                "retries": dict(self.retries),
+                "errors": dict(self.errors),
+                "throttled_seconds": dict(self.throttled_seconds),
+            }
+
+
+class RateLimitedCloudSdk:
+    """
+    Wraps the clients of a CloudSdk.
+
+    Every call goes through a token bucket of its quota bucket, is counted
+    by method and is retried with jittered exponential backoff if it failed
+    because of a rate limit or a server error.
+
+    Retries must not create resources twice: Compute inserts and deletes get
+    a requestId, which is kept across the retries of a request, and PubSub
+    creates treat AlreadyExists after a retry as success.
+    """
+
+    def __init__(
+        self,
+        gcloud=None,
+        rate_limits: Optional[Dict[str, float]] = None,
+        max_retries: int = 5,
+        initial_backoff_seconds: float = 1.0,
+        max_backoff_seconds: float = 32.0,
+    ):
+        if gcloud is None:
+            from pyclash.clash import CloudSdk
+
+            gcloud = CloudSdk()
+        self.gcloud = gcloud
+        self.max_retries = max_retries
+        self.initial_backoff_seconds = initial_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self.metrics = ApiMetrics()
+
+        limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self._buckets = {name: TokenBucket(rate) for name, rate in limits.items()}
+
+    def call(self, method: str, bucket: str, function, create: bool = False):
+        """
+        Calls the function within the limits of the given bucket.
+
+        If create is true, an AlreadyExists error of a retry means that a
+        previous attempt succeeded, so None is returned.
+        """
+        attempt = 0
+        while True:
+            throttled = self._buckets[bucket].acquire()
+            if throttled:
+                self.metrics.record(self.metrics.throttled_seconds, bucket, throttled)
+            self.metrics.record(self.metrics.calls, method)
+            try:
+                return function()
+            except Exception as e:
+                self.metrics.record(self.metrics.errors, method)
+                if create and attempt > 0 and is_already_exists(e):
+                    logger.debug(f"{method} succeeded before it was retried")
+                    return None
+                if attempt >= self.max_retries or not is_retryable(e):
+                    raise
+                backoff = random.uniform(
+                    0,
+                    min(
+                        self.max_backoff_seconds,
+                        self.initial_backoff_seconds * 2 ** attempt,
+                    ),
+                )
+                logger.debug(f"{method} failed ({e}). Retrying in {backoff:.1f}s...")
+                self.metrics.record(self.metrics.retries, method)
+                time.sleep(backoff)
+                attempt += 1
+
+    def get_compute_client(self):
+        return _ComputeProxy(self.gcloud.get_compute_client(), "compute", self)
+
+    def get_publisher(self):
+        return _PubSubProxy(self.gcloud.get_publisher(), self)
+
+    def get_subscriber(self):
+        return _PubSubProxy(self.gcloud.get_subscriber(), self)
+
+    def get_logging(self, project=None):
+        return self.gcloud.get_logging(project)
+
+    def __getattr__(self, name):
+        # other clients of the wrapped CloudSdk are passed through
+        return getattr(self.gcloud, name)
+
+
+class _ComputeProxy:
+    """
+    Wraps discovery resources (e.g. compute.instanceTemplates()) and their
+    requests, so that execute() is limited and retried
+    """
+
+    def __init__(self, target, path, sdk):
+        self._target = target
+        self._path = path
+        self._sdk = sdk
+
+    def execute(self, *args, **kwargs):
+        bucket = quota_bucket("compute", self._path.rsplit(".", 1)[-1])
+        return self._sdk.call(
+            self._path, bucket, lambda: self._target.execute(*args, **kwargs)
+        )
+
+    def __getattr__(self, name):
+        attribute = getattr(self._target, name)
+        if not callable(attribute):
+            return attribute
+        path = f"{self._path}.{name}"
+
+        def wrapper(*args, **kwargs):
+            if name in REQUEST_ID_METHODS:
+                kwargs.setdefault("requestId", str(uuid.uuid4()))
+            return _ComputeProxy(attribute(*args, **kwargs), path, self._sdk)
+
+        return wrapper
+
+
+class _PubSubProxy:
+    """ Wraps a PubSub publisher or subscriber client """
+
+    def __init__(self, client, sdk):
+        self._client = client
+        self._sdk = sdk
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name.endswith("_path"):
+            return attribute
+        method = f"pubsub.{name}"
+        bucket = quota_bucket("pubsub", name)
+
+        def wrapper(*args, **kwargs):
+            return self._sdk.call(
+                method,
+                bucket,
+                lambda: attribute(*args, **kwargs),
+                create=name.startswith("create_"),
+            )
+
+        return wrapper
@@ -0,0 +1,170 @@
+""" Durable records of submitted jobs (e.g. to reattach after a restart) """
+
+from typing import Any, Dict, List, Optional
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_REGISTRY_PATH = os.path.join("~", ".clash", "registry.db")
+
+# the states of a job
+PLACING = "placing"
+SUBMITTED = "submitted"
+FAILED = "failed"
+FINISHED = "finished"
+CLEANED_UP = "cleaned_up"
+
+
+class JobRegistry:
+    """
+    Records the resources and state transitions of jobs.
+
+    Subclasses implement the storage. A record is a dictionary with the keys
+    name, group, group_index, status, state (see Job.state), result (the
+    status message of a finished job or None), created and updated.
+    """
+
+    def record(
+        self,
+        state: Dict[str, Any],
+        status: str,
+        result: Optional[Dict[str, Any]] = None,
+    ):
+        """ Stores the state of a job and its transition to the given status """
+        raise NotImplementedError()
+
+    def get(self, name: str) -> Optional[Dict[str, Any]]:
+        """ Returns the record of a job or None if it is unknown """
+        raise NotImplementedError()
+
+    def list_jobs(
+        self, group: Optional[str] = None, status: Optional[str] = None
+    ) -> List[Dict[str, Any]]:
+        """ Returns the records of all jobs (optionally of a group or status) """
+        raise NotImplementedError()
+
+    def transitions(self, name: str) -> List[Dict[str, Any]]:
+        """ Returns the status changes of a job in chronological order """
+        raise NotImplementedError()
+
+    def group_members(self, group: str) -> List[Dict[str, Any]]:
+        """
+        Returns the records of the latest job per index of a group.
+
+        Group names are usually reused (e.g. by daily workflows), so the
+        registry might contain several jobs for the same index.
+        """
+        latest = {}
+        for record in self.list_jobs(group=group):
+            index = record["group_index"]
+            if index not in latest or record["created"] >= latest[index]["created"]:
+                latest[index] = record
+        return [record for _, record in sorted(latest.items())]
+
+
+class SqliteJobRegistry(JobRegistry):
+    """ Keeps the records in a local SQLite database """
+
+    def __init__(self, path: str = DEFAULT_REGISTRY_PATH):
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    name TEXT PRIMARY KEY,
+                    group_name TEXT,
+                    group_index INTEGER,
+                    status TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    result TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_by_group ON jobs (group_name);
+                CREATE TABLE IF NOT EXISTS transitions (
+                    name TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    timestamp REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS transitions_by_name ON transitions (name);
+                """
+            )
+
+    def record(self, state, status, result=None):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO jobs
+                    (name, group_name, group_index, status, state, result, created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (name) DO UPDATE SET
+                    status = excluded.status,
+                    state = excluded.state,
+                    result = COALESCE(excluded.result, jobs.result),
+                    updated = excluded.updated
+                """,
+                (
+                    state["name"],
+                    state.get("group"),
+                    state.get("group_index"),
+                    status,
+                    json.dumps(state),
+                    json.dumps(result) if result is not None else None,
+                    now,
+                    now,
+                ),
+            )
+            self._connection.execute(
+                "INSERT INTO transitions (name, status, timestamp) VALUES (?, ?, ?)",
+                (state["name"], status, now),
+            )
+
+    def get(self, name):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT * FROM jobs WHERE name = ?", (name,)
+            ).fetchone()
+        return self._to_record(row) if row else None
+
+    def list_jobs(self, group=None, status=None):
+        query = "SELECT * FROM jobs WHERE 1 = 1"
+        params = []
+        if group is not None:
+            query += " AND group_name = ?"
+            params.append(group)
+        if status is not None:
+            query += " AND status = ?"
+            params.append(status)
+        query += " ORDER BY group_index IS NULL, group_index, created"
+        with self._lock:
+            rows = self._connection.execute(query, params).fetchall()
+        return [self._to_record(row) for row in rows]
+
+    def transitions(self, name):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT status, timestamp FROM transitions WHERE name = ? ORDER BY rowid",
+                (name,),
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    @staticmethod
+    def _to_record(row):
+        return {
+            "name": row["name"],
+            "group": row["group_name"],
+            "group_index": row["group_index"],
+            "status": row["status"],
+            "state": json.loads(row["state"]),
+            "result": json.loads(row["result"]) if row["result"] else None,
+            "created": row["created"],
+            "updated": row["updated"],
+        }
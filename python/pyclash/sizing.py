@@ -0,0 +1,187 @@
+""" Utilization history of jobs and machine type recommendations """
+
+from typing import Any, Dict, List, Optional, Tuple
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+from pyclash.local import machine_type_vcpus
+
+DEFAULT_HISTORY_PATH = os.path.join("~", ".clash", "utilization.db")
+
+# the recommended machine type leaves room for peaks between the samples
+DEFAULT_HEADROOM = 1.25
+DEFAULT_HISTORY_RUNS = 10
+
+# GB of memory per vCPU and the vCPU counts of the predefined machine types
+MACHINE_TYPES = {
+    ("n1", "standard"): (3.75, [1, 2, 4, 8, 16, 32, 64, 96]),
+    ("n1", "highmem"): (6.5, [2, 4, 8, 16, 32, 64, 96]),
+    ("n1", "highcpu"): (0.9, [2, 4, 8, 16, 32, 64, 96]),
+    ("n2", "standard"): (4, [2, 4, 8, 16, 32, 48, 64, 80, 96, 128]),
+    ("n2", "highmem"): (8, [2, 4, 8, 16, 32, 48, 64, 80, 96, 128]),
+    ("n2", "highcpu"): (1, [2, 4, 8, 16, 32, 48, 64, 80, 96]),
+    ("n2d", "standard"): (4, [2, 4, 8, 16, 32, 48, 64, 80, 96, 128, 224]),
+    ("n2d", "highmem"): (8, [2, 4, 8, 16, 32, 48, 64, 80, 96]),
+    ("n2d", "highcpu"): (1, [2, 4, 8, 16, 32, 48, 64, 80, 96, 128, 224]),
+    ("e2", "standard"): (4, [2, 4, 8, 16, 32]),
+    ("e2", "highmem"): (8, [2, 4, 8, 16]),
+    ("e2", "highcpu"): (1, [2, 4, 8, 16, 32]),
+}
+
+# the on-demand prices per vCPU hour and GB hour (only their ratio matters)
+SERIES_PRICES = {
+    "n1": (0.031611, 0.004237),
+    "n2": (0.031611, 0.004237),
+    "n2d": (0.027502, 0.003686),
+    "e2": (0.021811, 0.002923),
+}
+
+
+def machine_type_resources(machine_type: str) -> Tuple[float, float]:
+    """ Returns the vCPUs and the GB of memory of a machine type """
+    custom = re.search(r"custom-(\d+)-(\d+)", machine_type)
+    if custom:
+        return int(custom.group(1)), int(custom.group(2)) / 1024
+    series, _, family = machine_type.rpartition("-")[0].partition("-")
+    if (series, family) not in MACHINE_TYPES:
+        raise ValueError(f"Unknown machine type {machine_type}")
+    vcpus = machine_type_vcpus(machine_type)
+    return vcpus, vcpus * MACHINE_TYPES[(series, family)][0]
+
+
+def recommend_machine_type(
+    utilizations: List[Dict[str, Any]],
+    machine_type: str,
+    headroom: float = DEFAULT_HEADROOM,
+) -> Optional[str]:
+    """
+    Returns the cheapest machine type of the same series (e.g. n1) which
+    fits the peak CPU and memory usage of the given runs plus some headroom.
+
+    Returns None without samples and the given machine type if no predefined
+    machine type is large enough.
+    """
+    utilizations = [u for u in utilizations if u.get("samples")]
+    if not utilizations:
+        return None
+    cores = max(u["cpu_cores_max"] for u in utilizations) * headroom
+    memory_gb = max(u["memory_bytes_max"] for u in utilizations) / 2 ** 30 * headroom
+
+    series = machine_type.split("-")[0]
+    if series not in SERIES_PRICES:
+        series = "n1"  # e.g. custom machine types
+    vcpu_price, memory_price = SERIES_PRICES[series]
+
+    candidates = []
+    for (candidate_series, family), (memory_per_vcpu, sizes) in MACHINE_TYPES.items():
+        if candidate_series != series:
+            continue
+        for vcpus in sizes:
+            memory = vcpus * memory_per_vcpu
+            if vcpus >= max(math.ceil(cores), 1) and memory >= memory_gb:
+                price = vcpus * vcpu_price + memory * memory_price
+                candidates.append((price, f"{series}-{family}-{vcpus}"))
+                break
+    return min(candidates)[1] if candidates else machine_type
+
+
+class UtilizationHistory:
+    """
+    Records the utilization summaries which the VMs report with the results.
+
+    Subclasses implement the storage. Runs are keyed by the name prefix of
+    their jobs, so repeated jobs (e.g. of daily workflows) share a history.
+    """
+
+    def record(
+        self,
+        name_prefix: str,
+        job_name: str,
+        machine_type: str,
+        utilization: Dict[str, Any],
+    ):
+        """ Stores the utilization summary of a run """
+        raise NotImplementedError()
+
+    def runs(
+        self, name_prefix: str, limit: int = DEFAULT_HISTORY_RUNS
+    ) -> List[Dict[str, Any]]:
+        """
+        Returns the latest runs (with the keys job_name, machine_type,
+        utilization and created), starting with the most recent one
+        """
+        raise NotImplementedError()
+
+    def recommend_machine_type(
+        self,
+        name_prefix: str,
+        machine_type: str,
+        headroom: float = DEFAULT_HEADROOM,
+        limit: int = DEFAULT_HISTORY_RUNS,
+    ) -> Optional[str]:
+        """ Recommends a machine type based on the latest runs (see above) """
+        return recommend_machine_type(
+            [run["utilization"] for run in self.runs(name_prefix, limit)],
+            machine_type,
+            headroom,
+        )
+
+
+class SqliteUtilizationHistory(UtilizationHistory):
+    """ Keeps the history in a local SQLite database """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH):
+        self.path = os.path.expanduser(path)
+        if self.path != ":memory:":
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        with self._lock, self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS runs (
+                    name_prefix TEXT NOT NULL,
+                    job_name TEXT NOT NULL,
+                    machine_type TEXT NOT NULL,
+                    utilization TEXT NOT NULL,
+                    created REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS runs_by_prefix ON runs (name_prefix);
+                """
+            )
+
+    def record(self, name_prefix, job_name, machine_type, utilization):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+                (
+                    name_prefix,
+                    job_name,
+                    machine_type,
+                    json.dumps(utilization),
+                    time.time(),
+                ),
+            )
+
+    def runs(self, name_prefix, limit=DEFAULT_HISTORY_RUNS):
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM runs WHERE name_prefix = ? "
+                "ORDER BY created DESC, rowid DESC LIMIT ?",
+                (name_prefix, limit),
+            ).fetchall()
+        return [
+            {
+                "job_name": row["job_name"],
+                "machine_type": row["machine_type"],
+                "utilization": json.loads(row["utilization"]),
+                "created": row["created"],
+            }
+            for row in rows
+        ]
@@ -0,0 +1,219 @@
+""" Removes the left-overs of jobs which were never cleaned up """
+
+from typing import Any, Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import logging
+import time
+
+from pyclash.clash import CloudSdk, MANAGED_LABEL, CREATED_LABEL, is_not_found
+
+logger = logging.getLogger(__name__)
+
+# every job name contains this (see Job)
+JOB_NAME_MARKER = "clash-job-"
+
+DEFAULT_TTL_SECONDS = 24 * 60 * 60
+DEFAULT_PARALLELISM = 10
+
+# VMs in these states might still publish a result
+LIVE_INSTANCE_STATES = {"PROVISIONING", "STAGING", "RUNNING"}
+
+# the kinds of resources in the order of their removal
+INSTANCE_GROUP = "instance_group"
+INSTANCE_TEMPLATE = "instance_template"
+SUBSCRIPTION = "subscription"
+TOPIC = "topic"
+
+
+def job_name(path: str) -> str:
+    """ Returns the job name of a resource (e.g. projects/p/topics/<job name>) """
+    return path.rsplit("/", 1)[-1]
+
+
+def creation_age(timestamp: str) -> float:
+    """ Returns the age of a compute resource by its creationTimestamp """
+    return time.time() - datetime.fromisoformat(timestamp).timestamp()
+
+
+class ResourceSweeper:
+    """
+    Finds and removes the resources of jobs which were not cleaned up (e.g.
+    because the client died or the runner of the VM could not clean up).
+
+    Resources belong to Clash if their name contains "clash-job-" and, for
+    PubSub, if they have the label clash-managed. They are stale if they
+    are older than ttl_seconds and the instance group of their job is gone
+    or has no live VM. PubSub resources of older Clash versions have no
+    creation label, so they are only removed with include_unlabelled.
+    """
+
+    OPERATION_POLLING_INTERVAL_SECONDS = 1
+
+    def __init__(
+        self,
+        project_id: str,
+        gcloud: Optional[CloudSdk] = None,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        parallelism: int = DEFAULT_PARALLELISM,
+        include_unlabelled: bool = False,
+    ):
+        self.project_id = project_id
+        self.gcloud = gcloud or CloudSdk()
+        self.ttl_seconds = ttl_seconds
+        self.parallelism = parallelism
+        self.include_unlabelled = include_unlabelled
+
+    def find_stale(self) -> List[Dict[str, Any]]:
+        """
+        Returns the stale resources as dictionaries with the keys kind (e.g.
+        instance_group), name, zone (of instance groups) and age_seconds
+        (None if unknown)
+        """
+        compute = self.gcloud.get_compute_client()
+        live_vms = [
+            instance["name"]
+            for _, instance in self._aggregated(compute.instances(), "instances")
+            if instance.get("status") in LIVE_INSTANCE_STATES
+        ]
+
+        stale = []
+        active_jobs = set()
+        for zone, group in self._aggregated(
+            compute.instanceGroupManagers(), "instanceGroupManagers"
+        ):
+            age = creation_age(group["creationTimestamp"])
+            has_live_vm = any(vm.startswith(f"{group['name']}-") for vm in live_vms)
+            if age <= self.ttl_seconds or has_live_vm:
+                active_jobs.add(group["name"])
+            else:
+                stale.append(self._resource(INSTANCE_GROUP, group["name"], age, zone))
+
+        for template in self._list(compute.instanceTemplates()):
+            age = creation_age(template["creationTimestamp"])
+            if age > self.ttl_seconds and template["name"] not in active_jobs:
+                stale.append(self._resource(INSTANCE_TEMPLATE, template["name"], age))
+
+        project = f"projects/{self.project_id}"
+        subscriptions = self.gcloud.get_subscriber().list_subscriptions(project)
+        topics = self.gcloud.get_publisher().list_topics(project)
+        for kind, resources in [(SUBSCRIPTION, subscriptions), (TOPIC, topics)]:
+            for resource in resources:
+                if JOB_NAME_MARKER not in job_name(resource.name):
+                    continue
+                if job_name(resource.name) in active_jobs:
+                    continue
+                age = self._pubsub_age(resource.labels)
+                if age is None and not self.include_unlabelled:
+                    continue
+                if age is None or age > self.ttl_seconds:
+                    stale.append(self._resource(kind, resource.name, age))
+        return stale
+
+    def delete(self, resources: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Removes resources (see find_stale) in parallel and returns them with
+        the additional keys deleted and error.
+
+        Instance groups are removed first, since their templates cannot be
+        removed before.
+        """
+        results = []
+        with ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            for kind in [INSTANCE_GROUP, INSTANCE_TEMPLATE, SUBSCRIPTION, TOPIC]:
+                batch = [r for r in resources if r["kind"] == kind]
+                results += executor.map(self._delete, batch)
+        return results
+
+    def sweep(self, dry_run: bool = False) -> List[Dict[str, Any]]:
+        """ Finds the stale resources and removes them (unless dry_run) """
+        stale = self.find_stale()
+        return stale if dry_run else self.delete(stale)
+
+    def _delete(self, resource):
+        try:
+            self._remove(resource)
+            return dict(resource, deleted=True, error=None)
+        except Exception as e:
+            if is_not_found(e):  # e.g. removed by the job in the meantime
+                return dict(resource, deleted=True, error=None)
+            logger.warning(f"Could not remove {resource['kind']} {resource['name']}")
+            return dict(resource, deleted=False, error=str(e))
+
+    def _remove(self, resource):
+        compute = self.gcloud.get_compute_client()
+        if resource["kind"] == INSTANCE_GROUP:
+            operation = (
+                compute.instanceGroupManagers()
+                .delete(
+                    project=self.project_id,
+                    zone=resource["zone"],
+                    instanceGroupManager=resource["name"],
+                )
+                .execute()
+            )
+            self._wait_for_operation(
+                compute.zoneOperations(), operation["name"], zone=resource["zone"]
+            )
+        elif resource["kind"] == INSTANCE_TEMPLATE:
+            operation = (
+                compute.instanceTemplates()
+                .delete(project=self.project_id, instanceTemplate=resource["name"])
+                .execute()
+            )
+            self._wait_for_operation(compute.globalOperations(), operation["name"])
+        elif resource["kind"] == SUBSCRIPTION:
+            self.gcloud.get_subscriber().delete_subscription(resource["name"])
+        else:
+            self.gcloud.get_publisher().delete_topic(resource["name"])
+
+    def _wait_for_operation(self, operations, operation, zone=None):
+        args = {"project": self.project_id, "operation": operation}
+        if zone:
+            args["zone"] = zone
+        while True:
+            result = operations.get(**args).execute()
+            if result["status"] == "DONE":
+                if "error" in result:
+                    raise Exception(result["error"])
+                return
+            time.sleep(ResourceSweeper.OPERATION_POLLING_INTERVAL_SECONDS)
+
+    def _list(self, collection):
+        """ Returns the Clash resources of a compute collection (of all pages) """
+        for response in self._pages(collection.list):
+            for item in response.get("items", []):
+                if JOB_NAME_MARKER in item["name"]:
+                    yield item
+
+    def _aggregated(self, collection, key):
+        """ Returns the zone and resource of the Clash resources of all zones """
+        for response in self._pages(collection.aggregatedList):
+            for scope, items in response.get("items", {}).items():
+                for item in items.get(key, []):
+                    if JOB_NAME_MARKER in item["name"]:
+                        yield job_name(scope), item
+
+    def _pages(self, method):
+        page_token = None
+        while True:
+            response = method(
+                project=self.project_id,
+                filter=f"name eq .*{JOB_NAME_MARKER}.*",
+                pageToken=page_token,
+            ).execute()
+            yield response
+            page_token = response.get("nextPageToken")
+            if not page_token:
+                return
+
+    def _pubsub_age(self, labels):
+        if labels.get(MANAGED_LABEL) != "true" or CREATED_LABEL not in labels:
+            return None
+        return time.time() - int(labels[CREATED_LABEL])
+
+    @staticmethod
+    def _resource(kind, name, age, zone=None):
+        resource = {"kind": kind, "name": name, "zone": zone}
+        resource["age_seconds"] = round(age) if age is not None else None
+        return resource
@@ -0,0 +1,124 @@
+""" Instrumentation of the job lifecycle """
+
+from typing import Dict, Optional, Any, List
+from contextlib import contextmanager
+import threading
+import time
+
+
+class Span:
+    """ A timed phase of a job (e.g. the creation of the instance template) """
+
+    def __init__(
+        self,
+        name: str,
+        job_name: str,
+        start: float,
+        end: Optional[float] = None,
+        attributes: Optional[Dict[str, Any]] = None,
+    ):
+        self.name = name
+        self.job_name = job_name
+        self.start = start
+        self.end = end
+        self.attributes = attributes or {}
+
+    @property
+    def duration(self) -> Optional[float]:
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return f"Span({self.name}, job={self.job_name}, duration={self.duration})"
+
+
+class Instrumentation:
+    """
+    Receives the spans of jobs and groups.
+
+    The default implementation ignores all spans. Subclasses override the
+    callbacks, which might be called from different threads.
+    """
+
+    def on_span_start(self, span: Span):
+        pass
+
+    def on_span_end(self, span: Span):
+        pass
+
+
+class SpanCollector(Instrumentation):
+    """ Keeps all finished spans in memory (e.g. for all jobs of a group) """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def on_span_end(self, span):
+        with self._lock:
+            self.spans.append(span)
+
+    def breakdown(self, job_name: Optional[str] = None) -> Dict[str, float]:
+        """ Sums up the durations per phase (optionally for a single job) """
+        with self._lock:
+            spans = [s for s in self.spans if job_name in (None, s.job_name)]
+        return timing_breakdown(spans)
+
+
+class OpenTelemetryExporter(Instrumentation):
+    """
+    Exports spans to OpenTelemetry.
+
+    Requires the opentelemetry-api package. Without an explicit tracer, the
+    tracer of the globally configured provider is used.
+    """
+
+    def __init__(self, tracer=None):
+        if tracer is None:
+            from opentelemetry import trace
+
+            tracer = trace.get_tracer("pyclash")
+        self.tracer = tracer
+
+    def on_span_end(self, span):
+        attributes = {"clash.job": span.job_name}
+        attributes.update(
+            {f"clash.{key}": value for key, value in span.attributes.items()}
+        )
+        exported = self.tracer.start_span(
+            span.name, start_time=int(span.start * 1e9), attributes=attributes
+        )
+        exported.end(end_time=int(span.end * 1e9))
+
+
+@contextmanager
+def span(instrumentation: Instrumentation, name: str, job_name: str, **attributes):
+    """ Measures the enclosed block and reports it to the instrumentation """
+    current = Span(name, job_name, time.time(), attributes=attributes)
+    instrumentation.on_span_start(current)
+    try:
+        yield current
+    except Exception as e:
+        current.attributes["error"] = str(e)
+        raise
+    finally:
+        current.end = time.time()
+        instrumentation.on_span_end(current)
+
+
+def vm_spans(job_name: str, timings: Dict[str, Dict[str, float]]) -> List[Span]:
+    """ Translates the timings of the status message into spans (vm.<phase>) """
+    return [
+        Span(f"vm.{phase}", job_name, timing["start"], timing["end"])
+        for phase, timing in sorted(timings.items(), key=lambda t: t[1]["start"])
+    ]
+
+
+def timing_breakdown(spans: List[Span]) -> Dict[str, float]:
+    """ Sums up the durations of finished spans per name """
+    breakdown = {}
+    for s in spans:
+        if s.end is not None:
+            breakdown[s.name] = breakdown.get(s.name, 0.0) + s.duration
+    return breakdown
@@ -0,0 +1,22 @@
+import pytest
+
+from pyclash import clash
+from pyclash import local
+from pyclash import registry
+
+
+@pytest.fixture
+def backend():
+    backend = local.LocalBackend(max_workers=2, use_docker=False)
+    yield backend
+    backend.shutdown()
+
+
+@pytest.fixture
+def job_registry(tmp_path):
+    return registry.SqliteJobRegistry(str(tmp_path / "clash" / "registry.db"))
+
+
+@pytest.fixture
+def job_config():
+    return clash.JobConfigBuilder().project_id("local-project").build()
@@ -0,0 +1,109 @@
+import json
+import subprocess
+
+from click.testing import CliRunner
+from mock import MagicMock, patch
+import pytest
+
+from pyclash import bake
+from pyclash import cli
+
+SERIAL_OUTPUT = "\n".join(
+    [
+        "[    1.0] cloud-init: running",
+        "clash-bake: pulled eu.gcr.io/p/job:latest eu.gcr.io/p/job@sha256:aaa\r",
+        "clash-bake: pulled google/cloud-sdk:228.0.0 google/cloud-sdk@sha256:bbb",
+        "clash-bake: done",
+    ]
+)
+
+
+@pytest.fixture
+def gcloud():
+    gcloud = MagicMock()
+    compute = gcloud.get_compute_client.return_value
+    compute.images.return_value.getFromFamily.return_value.execute.return_value = {
+        "selfLink": "cos"
+    }
+    compute.instances.return_value.get.return_value.execute.return_value = {
+        "status": "TERMINATED"
+    }
+    compute.instances.return_value.getSerialPortOutput.return_value.execute.return_value = {
+        "contents": SERIAL_OUTPUT
+    }
+    for operations in [compute.zoneOperations, compute.globalOperations]:
+        operations.return_value.get.return_value.execute.return_value = {
+            "status": "DONE"
+        }
+    return gcloud
+
+
+def test_bake_creates_an_image_of_the_family(gcloud):
+    baker = bake.ImageBaker("p", "europe-west1-b", "default", gcloud=gcloud)
+
+    image = baker.bake(["eu.gcr.io/p/job:latest"], "clash-jobs")
+
+    compute = gcloud.get_compute_client.return_value
+    vm = compute.instances.return_value.insert.call_args[1]["body"]
+    user_data = vm["metadata"]["items"][0]["value"]
+    assert "docker pull eu.gcr.io/p/job:latest" in user_data
+    assert "docker pull google/cloud-sdk:228.0.0-alpine" in user_data
+    assert vm["labels"] == {"clash-managed": "true"}
+    body = compute.images.return_value.insert.call_args[1]["body"]
+    assert body["family"] == "clash-jobs"
+    assert body["sourceDisk"] == f"zones/europe-west1-b/disks/{vm['name']}"
+    assert image["name"] == body["name"]
+    assert image["images"] == {
+        "eu.gcr.io/p/job:latest": "eu.gcr.io/p/job@sha256:aaa",
+        "google/cloud-sdk:228.0.0": "google/cloud-sdk@sha256:bbb",
+    }
+    assert json.loads(body["description"]) == {"images": image["images"]}
+    compute.instances.return_value.delete.assert_called_once_with(
+        project="p", zone="europe-west1-b", instance=vm["name"]
+    )
+
+
+def test_failed_bake_removes_the_vm(gcloud):
+    compute = gcloud.get_compute_client.return_value
+    compute.instances.return_value.getSerialPortOutput.return_value.execute.return_value = {
+        "contents": "clash-bake: failed"
+    }
+    baker = bake.ImageBaker("p", "europe-west1-b", "default", gcloud=gcloud)
+
+    with pytest.raises(bake.BakeError):
+        baker.bake(["eu.gcr.io/p/job:latest"], "clash-jobs")
+
+    compute.images.return_value.insert.assert_not_called()
+    compute.instances.return_value.delete.assert_called_once()
+
+
+def test_bake_script_is_valid(gcloud):
+    baker = bake.ImageBaker("p", "europe-west1-b", "default", gcloud=gcloud)
+    user_data = baker.template_env.get_template("bake-init.yaml.j2").render(
+        images=["eu.gcr.io/p/job:latest"]
+    )
+    script = user_data.split("content: |\n")[1].split("\nruncmd:")[0]
+
+    assert "{{index .RepoDigests 0}}" in script
+    subprocess.run(["bash", "-n"], input=script.encode(), check=True)
+
+
+def test_bake_command(gcloud):
+    with patch("pyclash.cli.CloudSdk", return_value=gcloud):
+        result = CliRunner().invoke(
+            cli.cli,
+            [
+                "bake",
+                "--project",
+                "p",
+                "--subnetwork",
+                "default",
+                "--family",
+                "clash-jobs",
+                "--image",
+                "eu.gcr.io/p/job:latest",
+            ],
+        )
+
+    assert result.exit_code == 0
+    assert json.loads(result.output)["family"] == "clash-jobs"
@@ -0,0 +1,191 @@
+import json
+import time
+
+from mock import MagicMock
+import pytest
+
+from pyclash import cache
+from pyclash import clash
+from pyclash import registry
+
+PINNED_IMAGE = "eu.gcr.io/project/app@sha256:" + "a" * 64
+
+
+@pytest.fixture
+def result_cache(tmp_path):
+    return cache.SqliteResultCache(str(tmp_path / "clash" / "results.db"))
+
+
+@pytest.fixture
+def pinned_config(job_config):
+    return dict(job_config, image=PINNED_IMAGE)
+
+
+def test_identical_run_reuses_the_result(backend, pinned_config, result_cache):
+    first = clash.Job(pinned_config, gcloud=backend, result_cache=result_cache)
+    first.run(args=["echo", "hello"], wait_for_result=True)
+    first.clean_up()
+
+    second = clash.Job(pinned_config, gcloud=backend, result_cache=result_cache)
+    result = second.run(args=["echo", "hello"])
+
+    assert result["status"] == 0
+    assert result["cached_from"] == first.name
+    assert result["logs"] == first.result["logs"]
+    assert not second.started
+    assert second.attach() == result
+    assert second.name not in backend.instance_groups
+    second.clean_up()
+
+
+def test_cached_result_is_recorded(backend, pinned_config, result_cache, job_registry):
+    clash.Job(pinned_config, gcloud=backend, result_cache=result_cache).run(
+        args=["true"], wait_for_result=True
+    )
+
+    job = clash.Job(
+        pinned_config, gcloud=backend, result_cache=result_cache, registry=job_registry
+    )
+    job.run(args=["true"])
+
+    assert job_registry.get(job.name)["status"] == registry.FINISHED
+    assert job_registry.get(job.name)["result"]["status"] == 0
+
+
+def test_failed_and_different_runs_are_not_reused(backend, pinned_config, result_cache):
+    clash.Job(pinned_config, gcloud=backend, result_cache=result_cache).run(
+        args=["false"], wait_for_result=True
+    )
+    clash.Job(pinned_config, gcloud=backend, result_cache=result_cache).run(
+        args=["echo", "$A"], env_vars={"A": "1"}, wait_for_result=True
+    )
+
+    failed = clash.Job(pinned_config, gcloud=backend, result_cache=result_cache)
+    other_env = clash.Job(pinned_config, gcloud=backend, result_cache=result_cache)
+
+    assert failed.run(args=["false"]) is None
+    assert other_env.run(args=["echo", "$A"], env_vars={"A": "2"}) is None
+    assert failed.attach(timeout_seconds=30)["status"] == 1
+
+
+def test_group_members_reuse_results(backend, pinned_config, result_cache):
+    factory = clash.JobFactory(pinned_config, backend, result_cache=result_cache)
+    clash.Job(pinned_config, gcloud=backend, result_cache=result_cache).run(
+        args=["true"], wait_for_result=True
+    )
+
+    group = clash.JobGroup("cached", factory)
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+    group.run()
+
+    assert group.wait()
+    assert "cached_from" in group.running_jobs[0].result
+
+
+def test_mutable_images_are_not_cached(job_config, result_cache):
+    key = result_cache.key(job_config, "true", {}, {}, {}, {})
+
+    assert key is None
+
+
+def test_jobs_with_mounts_are_not_cached(pinned_config, result_cache):
+    key = result_cache.key(pinned_config, "true", {}, {}, {"bucket": "/mnt"}, {})
+
+    assert key is None
+
+
+def test_key_depends_on_input_generations(pinned_config, result_cache):
+    gcloud = MagicMock()
+    objects = gcloud.get_storage_client.return_value.objects.return_value
+    objects.list.return_value.execute.side_effect = [
+        {"items": [{"name": "data/a", "generation": "1"}], "nextPageToken": "t"},
+        {"items": [{"name": "data/b", "generation": "1"}]},
+        {"items": [{"name": "data/a", "generation": "2"}], "nextPageToken": "t"},
+        {"items": [{"name": "data/b", "generation": "1"}]},
+    ]
+    inputs = {"bucket/data": "/data"}
+
+    first = result_cache.key(pinned_config, "true", {}, {}, {}, inputs, gcloud)
+    second = result_cache.key(pinned_config, "true", {}, {}, {}, inputs, gcloud)
+
+    assert first != second
+    objects.list.assert_any_call(
+        bucket="bucket",
+        prefix="data",
+        pageToken="t",
+        fields="items(name,generation),nextPageToken",
+    )
+
+
+def test_entries_expire(tmp_path):
+    result_cache = cache.SqliteResultCache(str(tmp_path / "results.db"), ttl_seconds=0)
+    result_cache.put("key", {"job": "job", "result": {"status": 0}})
+    time.sleep(0.01)
+
+    assert result_cache.get("key") is None
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    result_cache = cache.SqliteResultCache(str(tmp_path / "results.db"), max_entries=2)
+    for key in ["a", "b"]:
+        result_cache.put(key, {"job": key, "result": {"status": 0}})
+        time.sleep(0.01)
+    result_cache.get("a")
+    result_cache.put("c", {"job": "c", "result": {"status": 0}})
+
+    assert result_cache.get("a")["job"] == "a"
+    assert result_cache.get("b") is None
+    assert result_cache.get("c")["job"] == "c"
+
+
+def test_evict_removes_expired_entries(tmp_path):
+    result_cache = cache.SqliteResultCache(str(tmp_path / "results.db"))
+    result_cache.put("key", {"job": "job", "result": {"status": 0}})
+    assert result_cache.evict() == 0
+
+    result_cache.ttl_seconds = 0
+    time.sleep(0.01)
+    assert result_cache.evict() == 1
+
+
+class NotFound(Exception):
+    code = 404
+
+
+def test_gcs_cache_reads_and_expires_entries():
+    gcloud = MagicMock()
+    objects = gcloud.get_storage_client.return_value.objects.return_value
+    result_cache = cache.GcsResultCache("bucket", gcloud=gcloud, ttl_seconds=60)
+
+    objects.get_media.return_value.execute.side_effect = [
+        json.dumps({"job": "job", "result": {"status": 0}, "created": time.time()}),
+        json.dumps({"job": "job", "result": {"status": 0}, "created": 0}),
+        NotFound(),
+    ]
+
+    assert result_cache.get("key")["job"] == "job"
+    assert result_cache.get("key") is None
+    objects.delete.assert_called_once_with(
+        bucket="bucket", object="clash-results/key.json"
+    )
+    assert result_cache.get("key") is None
+
+
+def test_gcs_cache_evicts_expired_entries():
+    gcloud = MagicMock()
+    objects = gcloud.get_storage_client.return_value.objects.return_value
+    objects.list.return_value.execute.return_value = {
+        "items": [
+            {"name": "clash-results/old.json", "metadata": {"created": "0"}},
+            {
+                "name": "clash-results/new.json",
+                "metadata": {"created": str(time.time())},
+            },
+        ]
+    }
+    result_cache = cache.GcsResultCache("bucket", gcloud=gcloud, ttl_seconds=60)
+
+    assert result_cache.evict() == 1
+    objects.delete.assert_called_once_with(
+        bucket="bucket", object="clash-results/old.json"
+    )
@@ -1,5 +1,7 @@
 import mock
 import copy
+import hashlib
+import json
 import pickle
 from mock import patch, MagicMock
 from collections import namedtuple
@@ -9,11 +11,15 @@ from io import BytesIO as StringIO
 import sys
 import contextlib
 import os
+import subprocess
+import time
+from datetime import datetime, timezone
 
 from google.cloud.pubsub_v1.types import MessageStoragePolicy
 
 import pyclash
 from pyclash import clash
+from pyclash import tracing
 
 Topic = namedtuple("Topic", "name")
 
@@ -63,7 +69,9 @@ class CloudSdkStub:
             project, name
         )
         self.publisher.create_topic.side_effect = (
-            lambda topic, message_storage_policy: self.topics.append(Topic(name=topic))
+            lambda topic, message_storage_policy, labels: self.topics.append(
+                Topic(name=topic)
+            )
         )
 
         self.subscriber = MagicMock()
@@ -126,6 +134,16 @@ class TestMachineConfig:
 
         assert machine_config["machineType"] == "n1-standard-1"
 
+    def test_baked_image_defaults_to_the_project_of_the_job(self):
+        job_config = clash.JobConfigBuilder(TEST_JOB_CONFIG).baked_image("jobs").build()
+        compute = self.gcloud.get_compute_client()
+
+        clash.MachineConfig(compute, "_", self.cloud_init, job_config).to_dict()
+
+        compute.images.return_value.getFromFamily.assert_called_with(
+            project=TEST_JOB_CONFIG["project_id"], family="jobs"
+        )
+
     def test_automatic_restart_is_always_false(self):
         manifest = clash.MachineConfig(
             self.gcloud.get_compute_client(), "_", self.cloud_init, TEST_JOB_CONFIG
@@ -157,6 +175,30 @@ class TestMachineConfig:
 
         assert not machine_config["scheduling"]["preemptible"]
 
+    def test_config_has_no_max_run_duration_without_deadline(self):
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, TEST_JOB_CONFIG
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert "maxRunDuration" not in machine_config["scheduling"]
+
+    @patch("time.time")
+    def test_config_contains_max_run_duration_after_the_deadline(self, time_mock):
+        time_mock.return_value = 1000
+        cloud_init = clash.CloudInitConfig("_", "", TEST_JOB_CONFIG, deadline=4600)
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", cloud_init, TEST_JOB_CONFIG
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert machine_config["scheduling"]["maxRunDuration"] == {
+            "seconds": str(3600 + clash.MAX_RUN_DURATION_MARGIN_SECONDS)
+        }
+        assert machine_config["scheduling"]["instanceTerminationAction"] == "DELETE"
+
     def test_config_contains_custom_service_account(self):
         job_config = copy.deepcopy(TEST_JOB_CONFIG)
         job_config["service_account"] = "myaccount@foo.bar"
@@ -187,7 +229,10 @@ class TestMachineConfig:
 
         machine_config = manifest.to_dict()
 
-        assert machine_config["labels"] == {"customer": "dummy"}
+        assert machine_config["labels"] == {
+            "customer": "dummy",
+            "clash-managed": "true",
+        }
 
     def test_config_empty_labels(self):
         job_config = copy.deepcopy(TEST_JOB_CONFIG)
@@ -197,7 +242,491 @@ class TestMachineConfig:
 
         machine_config = manifest.to_dict()
 
-        assert machine_config["labels"] == {}
+        assert machine_config["labels"] == {"clash-managed": "true"}
+
+    def test_config_contains_default_boot_disk(self):
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, TEST_JOB_CONFIG
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert len(machine_config["disks"]) == 1
+        assert machine_config["disks"][0]["initializeParams"]["diskSizeGb"] == "100"
+        assert "diskType" not in machine_config["disks"][0]["initializeParams"]
+
+    def test_config_contains_custom_boot_disk(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .boot_disk_size_gb(200)
+            .boot_disk_type("pd-ssd")
+            .build()
+        )
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, job_config
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert machine_config["disks"][0]["initializeParams"] == {
+            "sourceImage": mock.ANY,
+            "diskSizeGb": "200",
+            "diskType": "pd-ssd",
+        }
+
+    def test_config_contains_local_ssds(self):
+        job_config = clash.JobConfigBuilder(TEST_JOB_CONFIG).local_ssds(2).build()
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, job_config
+        )
+
+        machine_config = manifest.to_dict()
+
+        local_ssds = [d for d in machine_config["disks"] if d["type"] == "SCRATCH"]
+        assert len(local_ssds) == 2
+        assert local_ssds[0]["interface"] == "NVME"
+
+    def test_config_attaches_existing_data_disks_read_only(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .data_disks(
+                [{"device_name": "dataset", "mount_path": "/data", "source": "mydisk"}]
+            )
+            .build()
+        )
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, job_config
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert machine_config["disks"][1] == {
+            "autoDelete": False,
+            "deviceName": "dataset",
+            "source": "mydisk",
+            "mode": "READ_ONLY",
+            "type": "PERSISTENT",
+        }
+
+    def test_config_creates_new_data_disks(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .data_disks(
+                [
+                    {
+                        "device_name": "work",
+                        "mount_path": "/work",
+                        "size_gb": 500,
+                        "disk_type": "pd-ssd",
+                    }
+                ]
+            )
+            .build()
+        )
+        manifest = clash.MachineConfig(
+            self.gcloud.get_compute_client(), "_", self.cloud_init, job_config
+        )
+
+        machine_config = manifest.to_dict()
+
+        assert machine_config["disks"][1]["mode"] == "READ_WRITE"
+        assert machine_config["disks"][1]["initializeParams"] == {
+            "diskSizeGb": "500",
+            "diskType": "pd-ssd",
+        }
+
+
+def cloud_init_file(cloud_init, path):
+    rendered = yaml.safe_load(cloud_init.render())
+    return next(f["content"] for f in rendered["write_files"] if f["path"] == path)
+
+
+class NotFound(Exception):
+    code = 404
+
+
+class TestPayloadStaging:
+    def setup(self):
+        clash.PayloadStore._STAGED.clear()
+        self.gcloud = MagicMock()
+        self.objects = self.gcloud.get_storage_client.return_value.objects.return_value
+        self.objects.get.return_value.execute.side_effect = NotFound()
+        self.job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG).staging_bucket("staging").build()
+        )
+
+    def test_script_and_env_file_are_fetched_from_the_bucket(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "echo hello", self.job_config, {"A": "1"}, gcloud=self.gcloud
+        )
+
+        rendered = yaml.safe_load(cloud_init.render())
+        paths = [f["path"] for f in rendered["write_files"]]
+        fetch = cloud_init_file(cloud_init, "/var/clash-fetch.sh")
+
+        assert "/var/script.sh" not in paths
+        assert "/var/clash.env" not in paths
+        assert rendered["runcmd"][0] == "bash /var/clash-fetch.sh"
+        assert "echo hello" not in cloud_init.render()
+        env_sha256 = hashlib.sha256(b"A=1").hexdigest()
+        assert (
+            f"__fetch /var/clash.env clash-staging%2F{env_sha256} {env_sha256}" in fetch
+        )
+        subprocess.run(["bash", "-n"], input=fetch.encode("utf-8"), check=True)
+
+    def test_identical_payloads_are_uploaded_once(self):
+        for name in ["job-1", "job-2"]:
+            clash.CloudInitConfig(
+                name, "echo hello", self.job_config, gcloud=self.gcloud
+            ).render()
+
+        names = [c[1]["body"]["name"] for c in self.objects.insert.call_args_list]
+        assert len(names) == 2  # the script and the (empty) env file
+        assert self.objects.insert.call_args[1]["ifGenerationMatch"] == 0
+
+    def test_existing_payloads_are_not_uploaded(self):
+        self.objects.get.return_value.execute.side_effect = None
+
+        clash.CloudInitConfig(
+            "myvm", "echo hello", self.job_config, gcloud=self.gcloud
+        ).render()
+
+        self.objects.insert.assert_not_called()
+
+    def test_machine_config_stays_small(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "echo " + "x" * 300000, self.job_config, gcloud=self.gcloud
+        )
+        manifest = clash.MachineConfig(
+            CloudSdkStub().get_compute_client(), "myvm", cloud_init, self.job_config
+        )
+
+        user_data = manifest.to_dict()["metadata"]["items"][0]["value"]
+
+        assert len(user_data) < 50000
+
+
+class TestCloudInitConfig:
+    def test_runner_pulls_job_image_in_background(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "docker pull test-cloudsdk:latest > /dev/null" in runner
+        assert runner.index("docker pull test-cloudsdk") < runner.index("docker run")
+
+    def test_runner_waits_for_helper_images_after_the_job(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert runner.index("wait $image_pull_pid") < runner.index("docker run")
+        assert runner.index("wait $tools_pull_pid") > runner.index(
+            "--name=clash-runner"
+        )
+        assert runner.index("wait $tools_pull_pid") < runner.index("base64 -w 0")
+
+    def test_runner_publishes_timings(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert '\\"timings\\": $timings' in runner
+
+    def test_runner_publishes_the_digests_of_the_image(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        inspect = "docker image inspect --format '{{index .RepoDigests 0}}' test-cloudsdk:latest"
+        assert runner.index(f"baked_digest=$({inspect}") < runner.index("docker pull")
+        assert runner.index(f"image_digest=$({inspect}") > runner.index(
+            "wait $image_pull_pid"
+        )
+        assert '\\"baked_digest\\": \\"$baked_digest\\"' in runner
+
+    def test_runner_publishes_utilization(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", dict(TEST_JOB_CONFIG, utilization_interval_seconds=5)
+        )
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "while sleep 5; do" in runner
+        assert runner.index("__sample_utilization &") < runner.index("docker run")
+        assert '\\"utilization\\": $utilization' in runner
+
+    def test_runner_summarizes_docker_stats(self, tmp_path):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+        function = runner[
+            runner.index("function __utilization_json") : runner.index(
+                "__record_phase boot"
+            )
+        ]
+        stats = tmp_path / "stats"
+        stats.write_text(
+            "-- -- / -- -- / -- -- / --\n"
+            "150.00% 1GiB / 4GiB 1kB / 2kB 0B / 0B\n"
+            "250.00% 512MiB / 4GiB 1MB / 2MB 3MB / 4GB\n"
+        )
+
+        summary = subprocess.run(
+            ["bash", "-c", f"{function}\nutilization_file={stats}\n__utilization_json"],
+            stdout=subprocess.PIPE,
+            check=True,
+        ).stdout
+
+        utilization = json.loads(summary)
+        assert utilization["samples"] == 2
+        assert utilization["cpu_cores_avg"] == 2
+        assert utilization["cpu_cores_max"] == 2.5
+        assert utilization["memory_bytes_max"] == 2 ** 30
+        assert utilization["memory_limit_bytes"] == 4 * 2 ** 30
+        assert utilization["network_tx_bytes"] == 2e6
+        assert utilization["disk_write_bytes"] == 4e9
+
+    def test_runner_passes_the_rank_to_the_container(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "-e CLASH_RANK=0 -e CLASH_WORLD_SIZE=1" in runner
+        assert "--env-file /var/clash.env $node_options" in runner
+        assert '\\"rank\\": $rank' in runner
+        assert "delete-instances" not in runner
+
+    def test_multi_node_runner_derives_the_rank_from_the_hostname(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", dict(TEST_JOB_CONFIG, nodes=4, coordinator_port=1234)
+        )
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "rank=${rank##*-}" in runner
+        assert (
+            "--network host -e CLASH_RANK=$rank -e CLASH_WORLD_SIZE=4 "
+            "-e CLASH_COORDINATOR_ADDRESS=myvm-0 -e CLASH_COORDINATOR_PORT=1234"
+        ) in runner
+        assert "delete-instances myvm --instances=$(hostname -s)" in runner
+        assert "gcloud pubsub topics delete" not in runner
+
+    def test_preemptible_runner_forwards_the_preemption_notice(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", dict(TEST_JOB_CONFIG, preemptible=True)
+        )
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "instance/preempted?wait_for_change=true" in runner
+        assert "docker kill --signal=SIGTERM clash-runner" in runner
+        assert runner.index("__watch_preemption &") < runner.index("docker run")
+        assert "-e CLASH_PREEMPTION_GRACE_SECONDS=20" in runner
+        assert '\\"status\\": \\"preempted\\"' in runner
+        subprocess.run(["bash", "-n"], input=runner.encode("utf-8"), check=True)
+
+    def test_runner_ignores_preemption_of_standard_vms(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+        script = cloud_init_file(cloud_init, "/var/script.sh")
+
+        assert "preempted" not in runner
+        assert "__on_preemption" not in script
+
+    def test_preemptible_script_flushes_the_outputs_on_preemption(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm",
+            "echo hello",
+            dict(TEST_JOB_CONFIG, preemptible=True),
+            gcs_target={"/artifacts": "bucket/a"},
+        )
+
+        script = cloud_init_file(cloud_init, "/var/script.sh")
+        handler = script[
+            script.index("function __on_preemption") : script.index("set -m")
+        ]
+
+        assert "kill -TERM -- -$job_pid" in handler
+        assert "gsutil -q -m rsync -r /artifacts gs://bucket/a" in handler
+        assert "trap __on_preemption TERM" in script
+        subprocess.run(["bash", "-n"], input=script.encode("utf-8"), check=True)
+
+    def test_runner_stops_the_job_at_the_deadline(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG, deadline=1234)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "deadline=1234" in runner
+        assert runner.index("__enforce_deadline &") < runner.index("docker pull")
+        assert "success=124" in runner
+        subprocess.run(["bash", "-n"], input=runner.encode("utf-8"), check=True)
+
+    def test_runner_kills_the_container_once_the_deadline_passed(self, tmp_path):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG, deadline=1)
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+        function = runner[
+            runner.index("function __enforce_deadline") : runner.index(
+                "__enforce_deadline &"
+            )
+        ]
+        timed_out_file = tmp_path / "timed-out"
+        docker_calls = tmp_path / "docker"
+
+        subprocess.run(
+            [
+                "bash",
+                "-c",
+                f'function docker {{ echo "$@" >> {docker_calls}; }}\n'
+                f"deadline=1\ntimed_out_file={timed_out_file}\n"
+                f"{function}\n__enforce_deadline",
+            ],
+            check=True,
+            timeout=10,
+        )
+
+        assert timed_out_file.exists()
+        assert docker_calls.read_text() == "kill clash-runner\n"
+
+    def test_runner_has_no_deadline_by_default(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "__enforce_deadline" not in runner
+
+    def test_script_mounts_buckets_concurrently(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm",
+            "_",
+            TEST_JOB_CONFIG,
+            gcs_mounts={"bucket_a": "/mnt/a", "bucket_b": "/mnt/b"},
+        )
+
+        script = cloud_init_file(cloud_init, "/var/script.sh")
+
+        assert "gcsfuse --implicit-dirs bucket_a /mnt/a &" in script
+        assert "gcsfuse --implicit-dirs bucket_b /mnt/b &" in script
+        assert "wait $pid" in script
+
+    def test_script_uploads_artifacts_concurrently(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm",
+            "_",
+            TEST_JOB_CONFIG,
+            gcs_target={"/artifacts_a": "bucket/a", "/artifacts_b": "bucket/b"},
+        )
+
+        script = cloud_init_file(cloud_init, "/var/script.sh")
+
+        assert "rsync -r /artifacts_a gs://bucket/a &" in script
+        assert "rsync -r /artifacts_b gs://bucket/b &" in script
+        assert "gsutil -m" in script
+        assert "clash-sync-stop" not in script
+
+    def test_script_syncs_artifacts_while_running_if_configured(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG).artifact_sync_interval(60).build()
+        )
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", job_config, gcs_target={"/artifacts": "bucket"}
+        )
+
+        script = cloud_init_file(cloud_init, "/var/script.sh")
+
+        assert "gsutil -q -m rsync -r /artifacts gs://bucket" in script
+        assert "seq 60" in script
+
+    def test_local_ssds_are_mounted_as_scratch_space(self):
+        job_config = clash.JobConfigBuilder(TEST_JOB_CONFIG).local_ssds(1).build()
+        cloud_init = clash.CloudInitConfig("myvm", "_", job_config)
+
+        disks = cloud_init_file(cloud_init, "/var/clash-disks.sh")
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "mount -o discard,defaults $scratch_device /mnt/disks/scratch" in disks
+        assert "-v /mnt/disks/scratch:/scratch" in runner
+        assert (
+            "bash /var/clash-disks.sh" in yaml.safe_load(cloud_init.render())["runcmd"]
+        )
+
+    def test_data_disks_are_mounted_into_the_container(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .data_disks(
+                [{"device_name": "dataset", "mount_path": "/data", "source": "mydisk"}]
+            )
+            .build()
+        )
+        cloud_init = clash.CloudInitConfig("myvm", "_", job_config)
+
+        disks = cloud_init_file(cloud_init, "/var/clash-disks.sh")
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "mount -o ro,noload /dev/disk/by-id/google-dataset" in disks
+        assert "-v /mnt/disks/dataset:/data:ro" in runner
+
+    def test_inputs_are_copied_to_local_disk_before_the_script_starts(self):
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", TEST_JOB_CONFIG, gcs_inputs={"bucket/prefix": "/inputs"}
+        )
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "rsync -r gs://bucket/prefix /var/clash-inputs/0 &" in runner
+        assert "check_hashes=always" in runner
+        assert "-v /var/clash-inputs/0:/inputs" in runner
+        assert runner.index("clash-inputs/0 &") < runner.index("docker run  --env")
+
+    def test_inputs_are_copied_to_local_ssd_if_available(self):
+        job_config = clash.JobConfigBuilder(TEST_JOB_CONFIG).local_ssds(1).build()
+        cloud_init = clash.CloudInitConfig(
+            "myvm", "_", job_config, gcs_inputs={"bucket/prefix": "/inputs"}
+        )
+
+        runner = cloud_init_file(cloud_init, "/var/clash-runner.sh")
+
+        assert "-v /mnt/disks/scratch/clash-inputs/0:/inputs" in runner
+
+    def test_disk_setup_is_skipped_without_extra_disks(self):
+        cloud_init = clash.CloudInitConfig("myvm", "_", TEST_JOB_CONFIG)
+
+        rendered = yaml.safe_load(cloud_init.render())
+
+        assert "bash /var/clash-disks.sh" not in rendered["runcmd"]
+
+
+def test_input_patterns_are_translated_to_an_exclude_regex():
+    inputs = clash.normalize_gcs_inputs(
+        {
+            "bucket/prefix": {
+                "path": "/inputs",
+                "include": [r".*\.tfrecord$"],
+                "exclude": ["tmp/.*"],
+            }
+        }
+    )
+
+    assert inputs == [
+        {
+            "source": "gs://bucket/prefix",
+            "path": "/inputs",
+            "host_path": "/var/clash-inputs/0",
+            "exclude_regex": "'(?!(?:.*\\.tfrecord$))|(?:tmp/.*)'",
+        }
+    ]
+
+
+def test_importing_clash_defers_the_gcp_client_libraries():
+    code = (
+        "import sys, pyclash.clash, pyclash.cli\n"
+        "print([m for m in sys.modules if m.startswith("
+        "('googleapiclient', 'google.cloud.pubsub', 'google.cloud.logging'))])"
+    )
+
+    output = subprocess.check_output([sys.executable, "-c", code])
+
+    assert output.decode().strip() == "[]"
 
 
 def test_argument_to_script_with_whitespace():
@@ -239,6 +768,31 @@ class TestJob:
 
         self.gcloud.get_compute_client().instanceTemplates.return_value.insert.return_value.execute.assert_called()
 
+    @patch("time.time")
+    def test_timeout_sets_the_deadline_of_the_vm(self, time_mock):
+        time_mock.return_value = 1000
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud, timeout_seconds=60)
+
+        job.run(args=[])
+
+        body = self.gcloud.get_compute_client().instanceTemplates.return_value.insert.call_args[
+            1
+        ][
+            "body"
+        ]
+        assert job.deadline == 1060
+        assert "deadline=1060" in body["properties"]["metadata"]["items"][0]["value"]
+
+    def test_max_run_duration_overrides_the_timeout(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG).max_run_duration(3600).build()
+        )
+        job = clash.Job(job_config, gcloud=self.gcloud, timeout_seconds=60)
+
+        job.run(args=[])
+
+        assert job.deadline - time.time() > 3000
+
     def test_running_a_job_creates_a_managed_instance_group(self):
         job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
 
@@ -246,6 +800,22 @@ class TestJob:
 
         self.gcloud.get_compute_client().instanceGroupManagers.return_value.insert.return_value.execute.assert_called()
 
+    def test_running_a_file_passes_the_script_and_inputs(self, tmp_path):
+        script_file = tmp_path / "script.sh"
+        script_file.write_text("echo 'from file'")
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
+
+        job.run_file(str(script_file), gcs_inputs={"gs://bucket/data": "/data"})
+
+        body = self.gcloud.get_compute_client().instanceTemplates.return_value.insert.call_args[
+            1
+        ][
+            "body"
+        ]
+        user_data = body["properties"]["metadata"]["items"][0]["value"]
+        assert "echo 'from file'" in user_data
+        assert "gs://bucket/data" in user_data
+
     def test_deletes_instance_template_after_job_is_complete(self):
         self.gcloud.get_compute_client().instanceGroups.return_value.list.return_value.execute.return_value = {
             "items": [{"name": "anothergroup"}]
@@ -256,6 +826,16 @@ class TestJob:
 
         self.gcloud.get_compute_client().instanceTemplates.return_value.delete.return_value.execute.assert_called()
 
+    def test_deletes_instance_template_if_there_are_no_instance_groups(self):
+        self.gcloud.get_compute_client().instanceGroups.return_value.list.return_value.execute.return_value = (
+            {}
+        )
+
+        with clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud) as job:
+            job.run(args=[])
+
+        self.gcloud.get_compute_client().instanceTemplates.return_value.delete.return_value.execute.assert_called()
+
     def test_removes_subscription_if_job_creation_failed(self):
         self.gcloud.get_compute_client().instanceGroupManagers.return_value.insert.return_value.execute.side_effect = Exception(
             "Failure!"
@@ -291,6 +871,7 @@ class TestJob:
             TEST_JOB_CONFIG["project_id"], job.name
         )
 
+    @patch("time.time", MagicMock(return_value=1600000000.5))
     @patch("uuid.uuid1")
     def test_running_a_job_creates_a_pubsub_topic(self, mock_uuid_call):
         mock_uuid_call.return_value = 1234
@@ -303,6 +884,7 @@ class TestJob:
             message_storage_policy=MessageStoragePolicy(
                 allowed_persistence_regions=["europe-west1"]
             ),
+            labels={"clash-managed": "true", "clash-created": "1600000000"},
         )
 
     def test_attaching_fails_if_there_is_not_a_running_job(self):
@@ -333,7 +915,7 @@ class TestJob:
         job.run(args=[])
 
         self.gcloud.get_subscriber().create_subscription.assert_called_with(
-            "mysubscription", "mytopic"
+            "mysubscription", "mytopic", labels=mock.ANY
         )
 
     def test_attaching_pulls_message(self):
@@ -435,6 +1017,387 @@ class TestJob:
         with pytest.raises(ValueError) as e_info:
             job.on_finish(lambda status_code: None)
 
+    def test_running_a_job_reports_spans_to_the_instrumentation(self):
+        collector = tracing.SpanCollector()
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud, instrumentation=collector)
+
+        job.run(args=[])
+
+        names = [span.name for span in collector.spans]
+        assert "create_status_topic" in names
+        assert "create_instance_template" in names
+        assert "create_instance_group" in names
+        assert all(span.job_name == job.name for span in collector.spans)
+
+    def test_attaching_adds_vm_timings_to_the_breakdown(self):
+        message = MagicMock()
+        message.message = MagicMock(
+            data='{"status": 0, "timings": {"image_pull": {"start": 1, "end": 3}}}'
+        )
+        self.gcloud.get_subscriber().pull.return_value.received_messages = [message]
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
+        job.run(args=[])
+
+        job.attach()
+
+        breakdown = job.timing_breakdown()
+        assert breakdown["vm.image_pull"] == 2
+        assert "attach" in breakdown
+
+    @patch("time.sleep")
+    def test_running_a_job_tries_the_next_zone_after_a_stockout(self, _):
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        managers.listErrors.return_value.execute.side_effect = [
+            {"items": [{"error": {"code": "ZONE_RESOURCE_POOL_EXHAUSTED"}}]},
+            {},
+        ]
+        managers.get.return_value.execute.return_value = {
+            "targetSize": 1,
+            "currentActions": {"none": 1},
+        }
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c"])
+            .build()
+        )
+        job = clash.Job(job_config, gcloud=self.gcloud)
+
+        job.run(args=[])
+
+        zones = [c.kwargs["zone"] for c in managers.insert.call_args_list]
+        assert zones == ["europe-west1-b", "europe-west1-c"]
+        managers.delete.assert_called_once_with(
+            project="test-project", zone="europe-west1-b", instanceGroupManager=job.name
+        )
+        assert job.job_config["zone"] == "europe-west1-c"
+
+    @patch("time.sleep")
+    def test_running_a_job_fails_if_all_zones_are_stocked_out(self, _):
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        managers.listErrors.return_value.execute.return_value = {
+            "items": [{"error": {"code": "ZONE_RESOURCE_POOL_EXHAUSTED"}}]
+        }
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c"])
+            .build()
+        )
+        job = clash.Job(job_config, gcloud=self.gcloud)
+
+        with pytest.raises(clash.StockoutError):
+            job.run(args=[])
+
+        self.gcloud.get_publisher().delete_topic.assert_called()
+
+    @patch("time.sleep")
+    def test_placement_is_done_if_the_instance_group_is_gone(self, _):
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        managers.listErrors.return_value.execute.return_value = {}
+        not_found = Exception("not found")
+        not_found.code = 404
+        managers.get.return_value.execute.side_effect = not_found
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c"])
+            .build()
+        )
+        job = clash.Job(job_config, gcloud=self.gcloud)
+
+        job.run(args=[])
+
+        assert managers.insert.call_count == 1
+
+    @patch("time.sleep")
+    def test_placement_fails_on_other_errors_of_the_instance_group(self, _):
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        managers.listErrors.return_value.execute.return_value = {}
+        unavailable = Exception("backend error")
+        unavailable.code = 503
+        managers.get.return_value.execute.side_effect = unavailable
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c"])
+            .build()
+        )
+        job = clash.Job(job_config, gcloud=self.gcloud)
+
+        with pytest.raises(Exception, match="backend error"):
+            job.run(args=[])
+
+    def test_running_a_job_in_a_single_zone_does_not_wait_for_placement(self):
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
+
+        job.run(args=[])
+
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        managers.listErrors.assert_not_called()
+
+
+def rank_message(rank, status):
+    message = MagicMock()
+    message.message = MagicMock(data=json.dumps({"status": status, "rank": rank}))
+    return MagicMock(received_messages=[message])
+
+
+def log_entry(insert_id, timestamp, line):
+    return MagicMock(
+        insert_id=insert_id,
+        timestamp=datetime.fromtimestamp(timestamp, timezone.utc),
+        payload={"instance": {"name": "vm"}, "message": line},
+    )
+
+
+class TestJobLogs:
+    def setup(self):
+        self.gcloud = CloudSdkStub()
+        self.job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
+        self.list_entries = self.gcloud.logging_client.list_entries
+
+    def test_reads_the_logs_of_the_container(self):
+        self.job.result = {"status": 0}
+        self.list_entries.return_value = iter(
+            [log_entry("a", 10, "hello"), log_entry("b", 11, "world")]
+        )
+
+        lines = list(self.job.logs(since=5))
+
+        assert lines == [
+            {"timestamp": 10, "instance": "vm", "line": "hello"},
+            {"timestamp": 11, "instance": "vm", "line": "world"},
+        ]
+        query = self.list_entries.call_args[1]
+        assert f'jsonPayload.instance.name:"{self.job.name}-"' in query["filter_"]
+        assert 'timestamp>="1970-01-01T00:00:05+00:00"' in query["filter_"]
+        assert query["order_by"] == "timestamp asc"
+
+    def test_entries_are_fetched_lazily(self):
+        self.job.result = {"status": 0}
+
+        lines = self.job.logs()
+
+        self.list_entries.assert_not_called()
+        assert list(lines) == []
+
+    @patch.object(clash.Job, "LOGS_POLLING_INTERVAL_SECONDS", 0)
+    def test_follows_the_logs_until_the_job_is_complete(self):
+        self.job.started = True
+        results = [None, None, {"status": 0}]
+        self.job.poll = MagicMock(side_effect=lambda: results.pop(0))
+        self.list_entries.side_effect = [
+            iter([log_entry("a", 10, "first")]),
+            iter([]),
+            iter([log_entry("a", 10, "first"), log_entry("b", 12, "last")]),
+        ]
+
+        lines = [line["line"] for line in self.job.logs(follow=True)]
+
+        assert lines == ["first", "last"]
+        assert 'timestamp>="1970-01-01T00:00:10+00:00"' in (
+            self.list_entries.call_args[1]["filter_"]
+        )
+
+
+class TestPreemptedJob:
+    def setup(self):
+        self.gcloud = CloudSdkStub()
+
+    def test_preemption_notices_are_not_final(self):
+        preempted = MagicMock()
+        preempted.message = MagicMock(
+            data=json.dumps({"status": "preempted", "exit_code": 143, "rank": 0})
+        )
+        self.gcloud.get_subscriber().pull.side_effect = [
+            MagicMock(received_messages=[preempted]),
+            rank_message(0, 0),
+        ]
+        job = clash.Job(dict(TEST_JOB_CONFIG, preemptible=True), gcloud=self.gcloud)
+        job.run(args=[])
+
+        result = job.attach()
+
+        assert result["status"] == 0
+        assert job.preemptions == 1
+
+    def test_outdated_baked_image_is_reported(self, caplog):
+        message = MagicMock()
+        message.message = MagicMock(
+            data=json.dumps(
+                {
+                    "status": 0,
+                    "rank": 0,
+                    "image_digest": "image@sha256:new",
+                    "baked_digest": "image@sha256:old",
+                }
+            )
+        )
+        self.gcloud.get_subscriber().pull.return_value = MagicMock(
+            received_messages=[message]
+        )
+        job = clash.Job(TEST_JOB_CONFIG, gcloud=self.gcloud)
+        job.run(args=[])
+
+        result = job.attach()
+
+        assert result["baked_digest"] == "image@sha256:old"
+        assert "should be baked again" in caplog.text
+
+
+class TestMultiNodeJob:
+    def setup(self):
+        self.gcloud = CloudSdkStub()
+        self.job_config = dict(TEST_JOB_CONFIG, nodes=3)
+
+    def test_creates_a_vm_per_rank(self):
+        job = clash.Job(self.job_config, gcloud=self.gcloud)
+
+        job.run(args=[])
+
+        managers = self.gcloud.get_compute_client().instanceGroupManagers.return_value
+        assert managers.insert.call_args[1]["body"]["targetSize"] == 0
+        assert managers.createInstances.call_args[1]["body"]["instances"] == [
+            {"name": f"{job.name}-{rank}"} for rank in range(3)
+        ]
+
+    def test_succeeds_once_all_ranks_succeeded(self):
+        self.gcloud.get_subscriber().pull.side_effect = [
+            rank_message(2, 0),
+            rank_message(0, 0),
+            rank_message(1, 0),
+        ]
+        job = clash.Job(self.job_config, gcloud=self.gcloud)
+        job.run(args=[])
+
+        result = job.attach()
+
+        assert result["status"] == 0
+        assert result["rank"] == 0
+        assert result["ranks"] == {"0": 0, "1": 0, "2": 0}
+
+    def test_fails_as_soon_as_a_rank_failed(self):
+        self.gcloud.get_subscriber().pull.side_effect = [
+            rank_message(0, 0),
+            rank_message(1, 3),
+        ]
+        job = clash.Job(self.job_config, gcloud=self.gcloud)
+        job.run(args=[])
+
+        result = job.attach()
+
+        assert result["status"] == 3
+        assert result["rank"] == 1
+        assert result["ranks"] == {"0": 0, "1": 3}
+
+    def test_on_finish_runs_callback_once(self):
+        messages = [
+            MagicMock(data=json.dumps({"status": status, "rank": rank}))
+            for rank, status in [(0, 1), (1, 0), (2, 2)]
+        ]
+
+        def subscribe(path, callback):
+            for message in messages:
+                callback(message)
+
+        self.gcloud.get_subscriber().subscribe.side_effect = subscribe
+        job = clash.Job(self.job_config, gcloud=self.gcloud)
+        job.run(args=[])
+        statuses = []
+
+        job.on_finish(statuses.append)
+
+        assert statuses == [1]
+        assert all(message.ack.called for message in messages)
+
+    def test_clean_up_tears_down_all_vms_and_the_topic(self):
+        self.gcloud.get_subscriber().pull.side_effect = [rank_message(1, 3)]
+        with clash.Job(self.job_config, gcloud=self.gcloud) as job:
+            job.run(args=[])
+
+        compute = self.gcloud.get_compute_client()
+        compute.instanceGroupManagers.return_value.delete.assert_called_with(
+            project=self.job_config["project_id"],
+            zone=self.job_config["zone"],
+            instanceGroupManager=job.name,
+        )
+        compute.instanceTemplates.return_value.delete.return_value.execute.assert_called()
+        self.gcloud.get_publisher().delete_topic.assert_called_with(
+            job.job_status_topic
+        )
+
+
+class TestZonePlacement:
+    def setup(self):
+        clash.ZonePlacement._STOCKOUTS.clear()
+
+    def test_uses_the_job_config_without_candidate_zones(self):
+        placement = clash.ZonePlacement(TEST_JOB_CONFIG)
+
+        assert placement.candidates() == [TEST_JOB_CONFIG]
+
+    def test_ordered_policy_keeps_the_order_of_the_zones(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-c", "europe-west1-b"])
+            .build()
+        )
+
+        candidates = clash.ZonePlacement(job_config).candidates()
+
+        assert [c["zone"] for c in candidates] == ["europe-west1-c", "europe-west1-b"]
+
+    def test_spread_policy_rotates_the_zones(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c"])
+            .placement_policy("spread")
+            .build()
+        )
+
+        first = clash.ZonePlacement(job_config).candidates()[0]["zone"]
+        second = clash.ZonePlacement(job_config).candidates()[0]["zone"]
+
+        assert first != second
+
+    def test_least_recently_stocked_out_policy_prefers_zones_with_capacity(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west1-c", "europe-west1-d"])
+            .placement_policy("least_recently_stocked_out")
+            .build()
+        )
+        clash.ZonePlacement.record_stockout("europe-west1-b")
+
+        candidates = clash.ZonePlacement(job_config).candidates()
+
+        assert [c["zone"] for c in candidates] == [
+            "europe-west1-c",
+            "europe-west1-d",
+            "europe-west1-b",
+        ]
+
+    def test_candidates_in_other_regions_use_their_subnetwork(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west4-a"])
+            .subnetworks({"europe-west4": "default-europe-west4"})
+            .build()
+        )
+
+        candidates = clash.ZonePlacement(job_config).candidates()
+
+        assert candidates[0]["subnetwork"] == "default-europe-west1"
+        assert candidates[1]["region"] == "europe-west4"
+        assert candidates[1]["subnetwork"] == "default-europe-west4"
+
+    def test_candidates_in_other_regions_require_a_subnetwork(self):
+        job_config = (
+            clash.JobConfigBuilder(TEST_JOB_CONFIG)
+            .zones(["europe-west1-b", "europe-west4-a"])
+            .build()
+        )
+
+        with pytest.raises(ValueError):
+            clash.ZonePlacement(job_config).candidates()
+
 
 class TestJobGroup:
     def setup(self):
@@ -467,7 +1430,11 @@ class TestJobGroup:
 
         self.test_factory.create.assert_called_with(name_prefix=f"mygroup-0")
         self.test_job_one.run.assert_called_with(
-            args=["echo", "hello"], env_vars={}, gcs_mounts={}, gcs_target={}
+            args=["echo", "hello"],
+            env_vars={},
+            gcs_mounts={},
+            gcs_target={},
+            gcs_inputs={},
         )
 
     def test_runs_multiple_jobs(self):
@@ -478,10 +1445,18 @@ class TestJobGroup:
         group.run()
 
         self.test_job_one.run.assert_called_with(
-            args=["echo", "hello"], env_vars={}, gcs_mounts={}, gcs_target={}
+            args=["echo", "hello"],
+            env_vars={},
+            gcs_mounts={},
+            gcs_target={},
+            gcs_inputs={},
         )
         self.test_job_two.run.assert_called_with(
-            args=["echo", "world"], env_vars={}, gcs_mounts={}, gcs_target={}
+            args=["echo", "world"],
+            env_vars={},
+            gcs_mounts={},
+            gcs_target={},
+            gcs_inputs={},
         )
 
     def test_passes_runtime_spec_to_job(self):
@@ -492,6 +1467,7 @@ class TestJobGroup:
                 env_vars={"FOO": "bar"},
                 gcs_mounts={"bucket_name": "mount_dir"},
                 gcs_target={"artifacts_dir", "bucket_name"},
+                gcs_inputs={"bucket_name/prefix": "input_dir"},
             )
         )
 
@@ -502,6 +1478,7 @@ class TestJobGroup:
             env_vars={"FOO": "bar"},
             gcs_mounts={"bucket_name": "mount_dir"},
             gcs_target={"artifacts_dir", "bucket_name"},
+            gcs_inputs={"bucket_name/prefix": "input_dir"},
         )
 
     def test_attach_returns_true_when_all_jobs_have_finished_sucessfully(self):
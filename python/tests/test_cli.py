@@ -0,0 +1,111 @@
+import json
+
+from click.testing import CliRunner
+from mock import patch
+import pytest
+
+from pyclash import cli
+
+CONFIG_ARGS = [
+    "--project",
+    "local-project",
+    "--image",
+    "ubuntu",
+    "--subnetwork",
+    "default",
+]
+
+
+@pytest.fixture
+def backend(backend):
+    with patch("pyclash.cli.CloudSdk", return_value=backend), patch(
+        "pyclash.cli.WAIT_POLLING_INTERVAL_SECONDS", 0.1
+    ):
+        yield backend
+
+
+@pytest.fixture
+def registry_args(tmp_path):
+    return ["--registry", str(tmp_path / "registry.db")]
+
+
+def json_lines(output):
+    return [json.loads(line) for line in output.splitlines()]
+
+
+def submit(registry_args, manifest, parallel=1):
+    return CliRunner().invoke(
+        cli.cli,
+        ["submit", "--name", "mygroup", "--manifest", "-", "--parallel", str(parallel)]
+        + CONFIG_ARGS
+        + registry_args,
+        input="\n".join(json.dumps(spec) for spec in manifest),
+    )
+
+
+def test_submit_writes_submitted_jobs(backend, registry_args):
+    result = submit(
+        registry_args, [{"args": ["echo", "a"]}, {"args": ["echo", "b"]}], parallel=2
+    )
+
+    assert result.exit_code == 0, result.output
+    jobs = json_lines(result.output)
+    assert [job["group_index"] for job in jobs] == [0, 1]
+    assert all(job["status"] == "submitted" for job in jobs)
+
+
+def test_wait_for_group(backend, registry_args):
+    submit(registry_args, [{"args": ["true"]}, {"args": ["exit", "4"]}])
+
+    result = CliRunner().invoke(cli.cli, ["wait", "mygroup"] + registry_args)
+
+    assert result.exit_code == 1
+    jobs = json_lines(result.output)
+    assert [job["exit_code"] for job in jobs] == [0, 4]
+    assert all(job["status"] == "cleaned_up" for job in jobs)
+
+
+def test_status_and_logs_of_job(backend, registry_args):
+    submitted = json_lines(submit(registry_args, [{"args": ["echo", "hi"]}]).output)
+    name = submitted[0]["name"]
+    CliRunner().invoke(cli.cli, ["wait", name, "--no-clean-up"] + registry_args)
+
+    status = CliRunner().invoke(cli.cli, ["status", name] + registry_args)
+    logs = CliRunner().invoke(cli.cli, ["logs", "--raw", name] + registry_args)
+
+    assert json_lines(status.output)[0]["status"] == "finished"
+    assert json_lines(status.output)[0]["exit_code"] == 0
+    assert logs.output == "hi\n"
+
+
+def test_full_logs_are_read_from_cloud_logging(backend, registry_args):
+    submitted = json_lines(submit(registry_args, [{"args": ["echo", "hi"]}]).output)
+    name = submitted[0]["name"]
+    lines = [{"timestamp": 1.0, "instance": f"{name}-x1", "line": "hi"}]
+
+    with patch("pyclash.cli.Job.logs", return_value=iter(lines)) as logs:
+        result = CliRunner().invoke(
+            cli.cli, ["logs", "--follow", "--since", "1", name] + registry_args
+        )
+
+    assert result.exit_code == 0, result.output
+    logs.assert_called_once_with(since=1.0, follow=True)
+    assert json_lines(result.output) == [dict(lines[0], name=name, group_index=0)]
+
+
+def test_wait_times_out(backend, registry_args):
+    submit(registry_args, [{"args": ["sleep", "5"]}])
+
+    result = CliRunner().invoke(
+        cli.cli, ["wait", "mygroup", "--timeout", "1"] + registry_args
+    )
+
+    assert result.exit_code == 1
+    assert json_lines(result.output)[0]["status"] == "submitted"
+
+
+def test_unknown_name(registry_args):
+    result = CliRunner().invoke(cli.cli, ["status", "unknown"] + registry_args)
+
+    assert result.exit_code != 0
+    assert "Unknown job or group unknown" in result.output
@@ -0,0 +1,92 @@
+import pytest
+
+from pyclash import clash
+
+
+@pytest.fixture
+def graph(backend, job_config):
+    graph = clash.JobGraph("pipeline", clash.JobFactory(job_config, backend))
+    yield graph
+    graph.clean_up()
+
+
+def spec(*args):
+    return clash.JobRuntimeSpec(args=list(args))
+
+
+def test_nodes_run_after_their_upstream(graph, tmp_path):
+    output = str(tmp_path / "output")
+    graph.add_job("produce", spec("touch", output))
+    graph.add_job("consume", spec("test", "-f", output), upstream=["produce"])
+
+    assert graph.run()
+    assert graph.outcomes() == {"produce": "succeeded", "consume": "succeeded"}
+
+
+def test_fan_out_and_fan_in(graph, tmp_path):
+    graph.add_job("prepare", spec("mkdir", str(tmp_path / "shards")))
+    graph.add_group(
+        "shards",
+        [spec("touch", str(tmp_path / "shards" / str(i))) for i in range(3)],
+        upstream=["prepare"],
+    )
+    graph.add_job("check", spec("mkdir", str(tmp_path / "check")))
+    graph.add_job(
+        "merge",
+        spec("test", "-f", str(tmp_path / "shards" / "2")),
+        upstream=["shards", "check"],
+    )
+
+    assert graph.run()
+    assert len(graph.nodes["shards"].jobs) == 3
+    assert graph.nodes["merge"].jobs[0].group == "pipeline-merge"
+
+
+def test_failures_skip_downstream_nodes(graph):
+    graph.add_job("broken", spec("false"))
+    graph.add_job("downstream", spec("true"), upstream=["broken"])
+    graph.add_job("transitive", spec("true"), upstream=["downstream"])
+    graph.add_job("independent", spec("true"))
+
+    assert not graph.run()
+    assert graph.outcomes() == {
+        "broken": "failed",
+        "downstream": "upstream_failed",
+        "transitive": "upstream_failed",
+        "independent": "succeeded",
+    }
+    assert graph.nodes["downstream"].jobs == []
+
+
+def test_max_parallelism(backend, job_config, tmp_path):
+    graph = clash.JobGraph(
+        "serial", clash.JobFactory(job_config, backend), max_parallelism=1
+    )
+    # fails if another job holds the lock at the same time
+    lock = str(tmp_path / "lock")
+    graph.add_group(
+        "jobs", [spec("mkdir", lock, "&&", "sleep", "0.2", "&&", "rmdir", lock)] * 3
+    )
+
+    assert graph.run()
+    graph.clean_up()
+
+
+def test_failed_submissions_fail_the_node(backend, tmp_path):
+    # the local backend rejects data disks
+    config = clash.JobConfigBuilder().local_ssds(1).build()
+    graph = clash.JobGraph("pipeline", clash.JobFactory(config, backend))
+    graph.add_job("unsupported", spec("true"))
+    graph.add_job("downstream", spec("true"), upstream=["unsupported"])
+
+    assert not graph.run()
+    assert graph.outcomes()["downstream"] == "upstream_failed"
+
+
+def test_upstream_nodes_have_to_exist(graph):
+    graph.add_job("a", spec("true"))
+
+    with pytest.raises(ValueError):
+        graph.add_job("b", spec("true"), upstream=["missing"])
+    with pytest.raises(ValueError):
+        graph.add_job("a", spec("true"))
@@ -0,0 +1,138 @@
+import base64
+
+from mock import MagicMock
+import pytest
+
+from pyclash import clash
+from pyclash import local
+
+
+def test_job_runs_in_subprocess(backend, job_config):
+    job = clash.Job(job_config, gcloud=backend)
+
+    result = job.run(
+        args=["echo", "$GREETING"], env_vars={"GREETING": "hello"}, wait_for_result=True
+    )
+    job.clean_up()
+
+    assert result["status"] == 0
+    assert base64.b64decode(result["logs"]).decode() == "hello\n"
+    assert "vm.run" in job.timing_breakdown()
+    assert backend.instance_groups == {}
+    assert backend.templates == {}
+
+
+def test_job_returns_exit_code(backend, job_config):
+    job = clash.Job(job_config, gcloud=backend)
+
+    result = job.run(args=["exit", "3"], wait_for_result=True)
+
+    assert result["status"] == 3
+
+
+def test_group_runs_locally(backend, job_config):
+    group = clash.JobGroup("local", clash.JobFactory(job_config, backend))
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+    group.add_job(clash.JobRuntimeSpec(args=["false"]))
+
+    group.run()
+    succeeded = group.wait()
+    group.clean_up()
+
+    assert not succeeded
+    assert sorted(group.jobs_status_codes) == [0, 1]
+
+
+@pytest.mark.parametrize(
+    "machine_type, vcpus",
+    [
+        ("n1-standard-4", 4),
+        ("n2-highmem-16", 16),
+        ("custom-6-23040", 6),
+        ("n2-custom-8-16384", 8),
+        ("e2-micro", 0.25),
+    ],
+)
+def test_machine_type_vcpus(machine_type, vcpus):
+    assert local.machine_type_vcpus(machine_type) == vcpus
+
+
+def test_small_jobs_are_routed_locally():
+    routing = local.SizeBasedRouting(MagicMock(), MagicMock(), max_local_vcpus=2)
+
+    small = clash.JobConfigBuilder().machine_type("n1-standard-2").build()
+    large = clash.JobConfigBuilder().machine_type("n1-standard-8").build()
+    with_ssds = (
+        clash.JobConfigBuilder().machine_type("n1-standard-1").local_ssds(1).build()
+    )
+
+    assert routing.backend(small) is routing.local_backend
+    assert routing.backend(large) is routing.gcloud
+    assert routing.backend(with_ssds) is routing.gcloud
+    assert routing.job_factory(small).gcloud is routing.local_backend
+
+
+def test_jobs_with_gcs_features_are_routed_to_gce():
+    routing = local.SizeBasedRouting(MagicMock(), MagicMock(), max_local_vcpus=2)
+    small = clash.JobConfigBuilder().machine_type("n1-standard-1").build()
+    with_inputs = clash.JobRuntimeSpec(args=[], gcs_inputs={"/data": "gs://b/data"})
+    plain = clash.JobRuntimeSpec(args=[])
+
+    assert routing.backend(small, plain) is routing.local_backend
+    assert routing.backend(small, with_inputs) is routing.gcloud
+    assert routing.job_factory(small, runtime_specs=[plain]).gcloud is (
+        routing.local_backend
+    )
+    assert routing.job_factory(small, runtime_specs=[plain, with_inputs]).gcloud is (
+        routing.gcloud
+    )
+
+
+@pytest.mark.parametrize(
+    "run_args",
+    [
+        {"gcs_inputs": {"/data": "gs://bucket/data"}},
+        {"gcs_target": {"/artifacts": "bucket/artifacts"}},
+        {"gcs_mounts": {"bucket": "/mnt/bucket"}},
+    ],
+)
+def test_jobs_with_gcs_features_fail_locally(backend, run_args, job_config):
+    job = clash.Job(job_config, gcloud=backend)
+
+    with pytest.raises(ValueError, match="cannot run locally"):
+        job.run(args=["true"], **run_args)
+
+    assert backend.instance_groups == {}
+    assert backend.topics == {}
+
+
+def test_jobs_with_staged_payloads_fail_locally(backend, job_config, monkeypatch):
+    monkeypatch.setattr(clash.PayloadStore, "_upload", MagicMock())
+    job_config = clash.JobConfigBuilder(job_config).staging_bucket("bucket").build()
+    job = clash.Job(job_config, gcloud=backend)
+
+    with pytest.raises(ValueError, match="staging bucket"):
+        job.run(args=["true"])
+
+
+def test_jobs_with_local_ssds_fail_locally(backend, job_config):
+    job = clash.Job(
+        clash.JobConfigBuilder(job_config).local_ssds(1).build(), gcloud=backend
+    )
+
+    with pytest.raises(ValueError, match="local SSDs"):
+        job.run(args=["true"])
+
+
+def test_multi_node_jobs_fail_loudly(backend, job_config):
+    job = clash.Job(dict(job_config, nodes=2), gcloud=backend)
+
+    with pytest.raises(ValueError, match="multiple nodes"):
+        job.run(args=["true"])
+
+
+def test_multi_node_jobs_are_routed_to_gce():
+    routing = local.SizeBasedRouting(MagicMock(), MagicMock(), max_local_vcpus=2)
+    config = clash.JobConfigBuilder().machine_type("n1-standard-1").nodes(2).build()
+
+    assert routing.backend(config) is routing.gcloud
@@ -0,0 +1,135 @@
+import json
+import subprocess
+
+from mock import MagicMock
+import pytest
+
+from pyclash import clash
+
+
+@pytest.fixture
+def gcloud(job_config):
+    gcloud = MagicMock()
+    gcloud.get_publisher.return_value.topic_path.side_effect = (
+        lambda project, name: f"projects/{project}/topics/{name}"
+    )
+    gcloud.get_subscriber.return_value.subscription_path.side_effect = (
+        lambda project, name: f"projects/{project}/subscriptions/{name}"
+    )
+    return gcloud
+
+
+def test_map_queues_an_item_per_input(gcloud, job_config):
+    factory = MagicMock(job_config=job_config, gcloud=gcloud, registry=None)
+    group = clash.JobGroup("files", factory)
+
+    group.map(["process", "{item}", "--fast"], ["a.csv", "b c.csv"], workers=2)
+
+    publish = gcloud.get_publisher.return_value.publish
+    assert [c[0][1] for c in publish.call_args_list] == [
+        b"process a.csv --fast",
+        b"process 'b c.csv' --fast",
+    ]
+    assert publish.call_args_list[1][1] == {"index": "1", "attempt": "1"}
+    assert len(group.job_specs) == 2
+    assert group.job_specs[1].env_vars == {"CLASH_WORKER": "1"}
+    assert "gcloud pubsub subscriptions pull" in group.job_specs[0].script
+
+
+def test_workers_run_the_worker_script(gcloud, job_config):
+    factory = MagicMock(job_config=job_config, gcloud=gcloud, registry=None)
+    group = clash.JobGroup("files", factory)
+
+    group.map(["true"], ["a"], workers=1)
+
+    job = factory.create.return_value
+    assert job._run_script.call_args[0][0] == group.job_specs[0].script
+    job.run.assert_not_called()
+
+
+def test_map_cannot_be_combined_with_other_jobs(gcloud, job_config):
+    group = clash.JobGroup("files", MagicMock(job_config=job_config, gcloud=gcloud))
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+
+    with pytest.raises(ValueError):
+        group.map(["true"], ["a"])
+
+
+def test_item_results_keep_the_latest_attempt(backend, job_config):
+    group = clash.JobGroup("files", clash.JobFactory(job_config, backend))
+    queue = clash.WorkQueue("queue", job_config, backend)
+    queue.create()
+    group.work_queue = queue
+    publisher = backend.get_publisher()
+    for index, attempt, status in [(0, 1, 0), (1, 2, 1), (1, 1, 1)]:
+        publisher.publish(
+            queue.results_topic,
+            json.dumps(
+                {"index": index, "attempt": attempt, "status": status, "worker": 0}
+            ).encode("utf-8"),
+        )
+
+    results = group.item_results()
+
+    assert results == {
+        0: {"attempt": 1, "status": 0, "worker": 0},
+        1: {"attempt": 2, "status": 1, "worker": 0},
+    }
+    group.clean_up()
+    assert backend.topics == {}
+
+
+def test_map_fails_locally_and_removes_its_queue(backend, job_config):
+    group = clash.JobGroup("files", clash.JobFactory(job_config, backend))
+
+    with pytest.raises(ValueError, match="work queue"):
+        group.map(["true"], ["a"])
+
+    group.clean_up()
+    assert backend.topics == {}
+
+
+def test_worker_processes_and_retries_items(tmp_path, gcloud, job_config, monkeypatch):
+    monkeypatch.setattr(clash.WorkQueue, "EMPTY_PULL_INTERVAL_SECONDS", 0)
+    queue = clash.WorkQueue("queue", job_config, gcloud)
+    queue.topic = "work"
+    queue.results_topic = "results"
+    script = queue.worker_script(max_attempts=2)
+    messages = tmp_path / "messages"
+    results = tmp_path / "results"
+    # a fake of the PubSub commands which keeps the messages in files
+    gcloud = f"""
+        function gcloud {{
+          case "$2 $3 $4" in
+            "subscriptions pull "*)
+              head -n 1 {messages}
+              sed -i 1d {messages} ;;
+            "topics publish results")
+              echo "${{5#--message=}}" >> {results} ;;
+            "topics publish work")
+              attributes=${{6#--attribute=index=}}
+              data=$(printf %s "${{5#--message=}}" | base64 -w 0)
+              printf 'retry\\t%s\\t%s\\t%s\\n' "${{attributes%%,*}}" "${{attributes##*=}}" "$data" >> {messages} ;;
+          esac
+        }}
+    """
+    messages.write_text(
+        "".join(
+            f"ack{i}\t{i}\t1\t{subprocess.check_output(['base64', '-w', '0'], input=item).decode()}\n"
+            for i, item in enumerate([b"echo first", b"exit 3"])
+        )
+    )
+
+    worker = subprocess.run(
+        ["bash", "-c", f"{gcloud}\nset -e\n{script}"],
+        stdout=subprocess.PIPE,
+        timeout=30,
+    )
+
+    assert worker.returncode == 1
+    assert b"first" in worker.stdout
+    assert [json.loads(line) for line in results.read_text().splitlines()] == [
+        {"index": 0, "attempt": 1, "status": 0, "worker": 0},
+        {"index": 1, "attempt": 1, "status": 3, "worker": 0},
+        {"index": 1, "attempt": 2, "status": 3, "worker": 0},
+    ]
@@ -0,0 +1,147 @@
+from mock import MagicMock, patch
+import pytest
+
+from pyclash import ratelimit
+
+
+class ApiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"Error {code}")
+        self.code = code
+
+
+class HttpError(Exception):
+    def __init__(self, status, content=b""):
+        super().__init__(f"HTTP {status}")
+        self.resp = MagicMock(status=status)
+        self.content = content
+
+
+def create_sdk(**kwargs):
+    gcloud = MagicMock()
+    sdk = ratelimit.RateLimitedCloudSdk(
+        gcloud, rate_limits={"compute.write": 1000.0}, **kwargs
+    )
+    return gcloud, sdk
+
+
+@pytest.mark.parametrize(
+    "api, method, bucket",
+    [
+        ("compute", "get", "compute.read"),
+        ("compute", "listErrors", "compute.read"),
+        ("compute", "insert", "compute.write"),
+        ("pubsub", "create_topic", "pubsub.admin"),
+        ("pubsub", "publish", "pubsub.data"),
+    ],
+)
+def test_quota_bucket(api, method, bucket):
+    assert ratelimit.quota_bucket(api, method) == bucket
+
+
+@pytest.mark.parametrize(
+    "error, retryable",
+    [
+        (ApiError(429), True),
+        (ApiError(503), True),
+        (ApiError(404), False),
+        (HttpError(500), True),
+        (HttpError(403, b'{"reason": "rateLimitExceeded"}'), True),
+        (HttpError(403, b'{"reason": "forbidden"}'), False),
+        (ValueError("Failure!"), False),
+    ],
+)
+def test_is_retryable(error, retryable):
+    assert ratelimit.is_retryable(error) == retryable
+
+
+def test_token_bucket_allows_bursts_up_to_capacity():
+    bucket = ratelimit.TokenBucket(rate=10.0, capacity=2)
+
+    with patch("time.sleep") as sleep:
+        assert bucket.acquire() == 0.0
+        assert bucket.acquire() == 0.0
+        assert bucket.acquire() > 0.0
+
+    sleep.assert_called_once()
+
+
+def test_compute_calls_are_counted_by_method():
+    gcloud, sdk = create_sdk()
+    gcloud.get_compute_client().instanceTemplates().insert().execute.return_value = {
+        "name": "operation"
+    }
+
+    compute = sdk.get_compute_client()
+    result = compute.instanceTemplates().insert(project="p", body={}).execute()
+
+    assert result == {"name": "operation"}
+    assert sdk.metrics.snapshot()["calls"] == {"compute.instanceTemplates.insert": 1}
+
+
+def test_pubsub_path_helpers_are_not_counted():
+    gcloud, sdk = create_sdk()
+    gcloud.get_publisher().topic_path.return_value = "projects/p/topics/t"
+
+    publisher = sdk.get_publisher()
+    publisher.create_topic(publisher.topic_path("p", "t"))
+
+    gcloud.get_publisher().create_topic.assert_called_once_with("projects/p/topics/t")
+    assert sdk.metrics.snapshot()["calls"] == {"pubsub.create_topic": 1}
+
+
+@patch("time.sleep")
+def test_retryable_errors_are_retried(sleep):
+    gcloud, sdk = create_sdk()
+    gcloud.get_publisher().create_topic.side_effect = [ApiError(429), "topic"]
+
+    assert sdk.get_publisher().create_topic("t") == "topic"
+
+    metrics = sdk.metrics.snapshot()
+    assert metrics["calls"] == {"pubsub.create_topic": 2}
+    assert metrics["retries"] == {"pubsub.create_topic": 1}
+
+
+@patch("time.sleep")
+def test_retries_are_limited(sleep):
+    gcloud, sdk = create_sdk(max_retries=2)
+    gcloud.get_publisher().create_topic.side_effect = ApiError(503)
+
+    with pytest.raises(ApiError):
+        sdk.get_publisher().create_topic("t")
+
+    assert sdk.metrics.snapshot()["errors"] == {"pubsub.create_topic": 3}
+
+
+def test_other_errors_are_raised_immediately():
+    gcloud, sdk = create_sdk()
+    gcloud.get_publisher().create_topic.side_effect = ApiError(409)
+
+    with pytest.raises(ApiError):
+        sdk.get_publisher().create_topic("t")
+
+    assert sdk.metrics.snapshot()["retries"] == {}
+
+
+def test_compute_inserts_keep_their_request_id_across_retries():
+    gcloud, sdk = create_sdk()
+    templates = gcloud.get_compute_client().instanceTemplates()
+
+    request = sdk.get_compute_client().instanceTemplates().insert(project="p", body={})
+    request_id = templates.insert.call_args.kwargs["requestId"]
+    with patch("time.sleep"):
+        templates.insert().execute.side_effect = [ApiError(503), {"name": "op"}]
+        assert request.execute() == {"name": "op"}
+
+    assert request_id
+    assert sdk.metrics.snapshot()["retries"] == {"compute.instanceTemplates.insert": 1}
+
+
+@patch("time.sleep")
+def test_already_exists_after_a_retried_create_is_a_success(sleep):
+    gcloud, sdk = create_sdk()
+    gcloud.get_publisher().create_topic.side_effect = [ApiError(503), ApiError(409)]
+
+    assert sdk.get_publisher().create_topic("t") is None
+
+    assert sdk.metrics.snapshot()["calls"] == {"pubsub.create_topic": 2}
@@ -0,0 +1,204 @@
+import pytest
+
+from pyclash import clash
+from pyclash import registry
+
+
+def test_record_and_get(job_registry):
+    state = {"name": "myjob", "group": "mygroup", "group_index": 0}
+
+    job_registry.record(state, registry.SUBMITTED)
+    job_registry.record(state, registry.FINISHED, {"status": 0})
+    job_registry.record(state, registry.CLEANED_UP)
+
+    record = job_registry.get("myjob")
+    assert record["status"] == registry.CLEANED_UP
+    assert record["state"] == state
+    assert record["result"] == {"status": 0}
+    assert [t["status"] for t in job_registry.transitions("myjob")] == [
+        registry.SUBMITTED,
+        registry.FINISHED,
+        registry.CLEANED_UP,
+    ]
+
+
+def test_get_unknown_job(job_registry):
+    assert job_registry.get("unknown") is None
+
+
+def test_list_jobs_by_group_and_status(job_registry):
+    job_registry.record({"name": "b", "group": "g", "group_index": 1}, "submitted")
+    job_registry.record({"name": "a", "group": "g", "group_index": 0}, "finished")
+    job_registry.record({"name": "c"}, "submitted")
+
+    assert [r["name"] for r in job_registry.list_jobs(group="g")] == ["a", "b"]
+    assert [r["name"] for r in job_registry.list_jobs(status="submitted")] == [
+        "b",
+        "c",
+    ]
+
+
+def test_reattach_to_running_job(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["sleep", "0.5"])
+
+    reattached = clash.Job.reattach(job.name, job_registry, gcloud=backend)
+    result = reattached.attach(timeout_seconds=10)
+    reattached.clean_up()
+
+    assert result["status"] == 0
+    assert reattached.job_status_subscription == job.job_status_subscription
+    assert job_registry.get(job.name)["status"] == registry.CLEANED_UP
+
+
+def test_reattach_to_finished_job(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["exit", "2"], wait_for_result=True)
+
+    reattached = clash.Job.reattach(job.name, job_registry, gcloud=backend)
+
+    assert reattached.attach()["status"] == 2
+
+
+def test_submission_is_recorded_before_placement(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["true"], wait_for_result=True)
+
+    transitions = [t["status"] for t in job_registry.transitions(job.name)]
+    assert transitions == [registry.PLACING, registry.SUBMITTED, registry.FINISHED]
+    assert job_registry.get(job.name)["state"]["job_config"]["zone"] == "europe-west1-b"
+
+
+def test_reattach_after_the_vm_removed_its_topic(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["true"])
+    job.attach(timeout_seconds=10)
+    job_registry.record(job.state(), registry.SUBMITTED)  # e.g. the client crashed
+
+    reattached = clash.Job.reattach(job.name, job_registry, gcloud=backend)
+
+    assert backend.topics == {}
+    assert reattached.attach(timeout_seconds=10)["status"] == 0
+
+
+def test_reattach_without_subscription(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["true"])
+    # like the EXIT trap of older runners, which also removed the subscription
+    backend.get_subscriber().delete_subscription(job.job_status_subscription)
+
+    reattached = clash.Job.reattach(job.name, job_registry, gcloud=backend)
+
+    with pytest.raises(ValueError, match="subscription"):
+        reattached.attach(timeout_seconds=10)
+
+
+def test_clean_up_removes_the_subscription(backend, job_registry, job_config):
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+    job.run(args=["true"], wait_for_result=True)
+
+    assert backend.subscriptions != {}
+    job.clean_up()
+
+    assert backend.subscriptions == {}
+
+
+def test_reattach_to_unknown_job(job_registry):
+    with pytest.raises(ValueError):
+        clash.Job.reattach("unknown", job_registry, gcloud=object())
+
+
+def test_failed_submission_is_recorded(backend, job_registry, job_config):
+    job_config.pop("image")
+    job = clash.Job(job_config, gcloud=backend, registry=job_registry)
+
+    with pytest.raises(KeyError):
+        job.run(args=["true"])
+
+    assert job_registry.get(job.name)["status"] == registry.FAILED
+
+
+def test_resume_group(backend, job_registry, job_config):
+    factory = clash.JobFactory(job_config, backend, registry=job_registry)
+    group = clash.JobGroup("mygroup", factory)
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+    group.add_job(clash.JobRuntimeSpec(args=["false"]))
+    job_registry.record(
+        {"name": "previous-run", "group": "mygroup", "group_index": 0}, "cleaned_up"
+    )
+    group.run()
+
+    resumed = clash.JobGroup.resume("mygroup", factory)
+    succeeded = resumed.wait()
+
+    assert not succeeded
+    assert [job.group_index for job in resumed.running_jobs] == [0, 1]
+    assert "previous-run" not in [job.name for job in resumed.running_jobs]
+    assert sorted(resumed.jobs_status_codes) == [0, 1]
+
+
+def test_resume_group_requires_a_registry(backend, job_config):
+    with pytest.raises(ValueError):
+        clash.JobGroup.resume("mygroup", clash.JobFactory(job_config, backend))
+
+
+def test_rerun_failed_members(backend, job_config, tmp_path):
+    marker = str(tmp_path / "marker")
+    group = clash.JobGroup("mygroup", clash.JobFactory(job_config, backend))
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+    group.add_job(clash.JobRuntimeSpec(args=["test", "-f", marker]))
+    group.run()
+    assert not group.wait()
+    first_member = group.running_jobs[0]
+
+    open(marker, "w").close()
+    resubmitted = group.rerun_failed()
+
+    assert resubmitted == [1]
+    assert group.wait()
+    assert group.outcomes() == {0: 0, 1: 0}
+    assert group.running_jobs[0] is first_member
+    assert len(group.replaced_jobs) == 1
+    group.clean_up()
+    assert backend.templates == {}
+
+
+def test_rerun_failed_members_of_a_previous_process(
+    backend, job_registry, job_config, tmp_path
+):
+    marker = str(tmp_path / "marker")
+    factory = clash.JobFactory(job_config, backend, registry=job_registry)
+    specs = [
+        clash.JobRuntimeSpec(args=["true"]),
+        clash.JobRuntimeSpec(args=["test", "-f", marker]),
+    ]
+    group = clash.JobGroup("mygroup", factory)
+    for spec in specs:
+        group.add_job(spec)
+    group.run()
+    group.wait()
+    group.clean_up()
+
+    open(marker, "w").close()
+    retry = clash.JobGroup("mygroup", factory)
+    for spec in specs:
+        retry.add_job(spec)
+    resubmitted = retry.rerun_failed()
+
+    assert resubmitted == [1]
+    assert retry.wait()
+    assert retry.running_jobs[0].name == group.running_jobs[0].name
+
+
+def test_rerun_failed_ignores_earlier_runs_of_the_group(
+    backend, job_registry, job_config
+):
+    state = {"name": "yesterday", "group": "mygroup", "group_index": 0}
+    job_registry.record(state, registry.CLEANED_UP, {"status": 0})
+    since = job_registry.get("yesterday")["created"] + 0.001
+    factory = clash.JobFactory(job_config, backend, registry=job_registry)
+    group = clash.JobGroup("mygroup", factory)
+    group.add_job(clash.JobRuntimeSpec(args=["true"]))
+
+    assert group.rerun_failed(since=since) == [0]
+    assert group.wait()
@@ -0,0 +1,89 @@
+import pytest
+
+from pyclash import clash
+from pyclash import sizing
+
+GIB = 2 ** 30
+
+
+def utilization(cores, memory_gib):
+    return {"samples": 10, "cpu_cores_max": cores, "memory_bytes_max": memory_gib * GIB}
+
+
+@pytest.fixture
+def history(tmp_path):
+    return sizing.SqliteUtilizationHistory(str(tmp_path / "clash" / "utilization.db"))
+
+
+@pytest.mark.parametrize(
+    "machine_type, resources",
+    [
+        ("n1-standard-4", (4, 15)),
+        ("n2-highmem-16", (16, 128)),
+        ("custom-6-23040", (6, 22.5)),
+        ("n2-custom-8-16384", (8, 16)),
+    ],
+)
+def test_machine_type_resources(machine_type, resources):
+    assert sizing.machine_type_resources(machine_type) == resources
+
+
+@pytest.mark.parametrize(
+    "utilizations, machine_type, recommended",
+    [
+        ([utilization(2.9, 4)], "n1-standard-32", "n1-standard-4"),
+        ([utilization(1.2, 40)], "n1-standard-32", "n1-highmem-8"),
+        ([utilization(12, 8)], "n1-standard-4", "n1-highcpu-16"),
+        ([utilization(0.5, 1), utilization(7, 20)], "n2-standard-2", "n2-standard-16"),
+        ([utilization(3, 2)], "custom-6-23040", "n1-highcpu-4"),
+        ([utilization(500, 10)], "n1-standard-4", "n1-standard-4"),
+        ([{"samples": 0}], "n1-standard-4", None),
+    ],
+)
+def test_recommend_machine_type(utilizations, machine_type, recommended):
+    assert sizing.recommend_machine_type(utilizations, machine_type) == recommended
+
+
+def test_history_keeps_the_latest_runs_per_prefix(history):
+    for i in range(3):
+        history.record("daily", f"daily-{i}", "n1-standard-32", utilization(i + 1, 1))
+    history.record("other", "other-0", "n1-standard-1", utilization(30, 1))
+
+    runs = history.runs("daily", limit=2)
+
+    assert [run["job_name"] for run in runs] == ["daily-2", "daily-1"]
+    assert history.recommend_machine_type("daily", "n1-standard-32") == ("n1-highcpu-4")
+    assert history.recommend_machine_type("unknown", "n1-standard-32") is None
+
+
+def test_jobs_record_their_utilization(history, job_config):
+    job = clash.Job(job_config, name_prefix="daily", utilization_history=history)
+
+    job._finish({"status": 0, "utilization": utilization(2, 3)})
+
+    assert history.runs("daily")[0]["job_name"] == job.name
+    assert history.runs("daily")[0]["machine_type"] == job_config["machine_type"]
+
+
+def test_auto_sizing_uses_the_recommendation(backend, history):
+    history.record("daily", "daily-0", "n1-standard-32", utilization(2.9, 4))
+    job_config = (
+        clash.JobConfigBuilder().machine_type("n1-standard-32").auto_size(True).build()
+    )
+    factory = clash.JobFactory(job_config, backend, utilization_history=history)
+
+    job = factory.create("daily")
+    job.run(args=["true"], wait_for_result=True)
+
+    assert job.job_config["machine_type"] == "n1-standard-4"
+
+
+def test_auto_sizing_is_opt_in(backend, history, job_config):
+    history.record("daily", "daily-0", "n1-standard-32", utilization(2.9, 4))
+
+    job = clash.Job(
+        job_config, gcloud=backend, name_prefix="daily", utilization_history=history
+    )
+    job.run(args=["true"], wait_for_result=True)
+
+    assert job.job_config["machine_type"] == job_config["machine_type"]
@@ -0,0 +1,174 @@
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone
+import json
+
+from click.testing import CliRunner
+from mock import MagicMock, patch
+import pytest
+
+from pyclash import cli
+from pyclash import sweeper
+
+PubSubResource = namedtuple("PubSubResource", "name labels")
+
+
+class NotFound(Exception):
+    code = 404
+
+
+def created(hours_ago):
+    return (datetime.now(timezone.utc) - timedelta(hours=hours_ago)).isoformat()
+
+
+def pubsub_labels(hours_ago):
+    created = datetime.now(timezone.utc) - timedelta(hours=hours_ago)
+    return {"clash-managed": "true", "clash-created": str(int(created.timestamp()))}
+
+
+@pytest.fixture
+def gcloud():
+    gcloud = MagicMock()
+    compute = gcloud.get_compute_client.return_value
+    compute.instances.return_value.aggregatedList.return_value.execute.return_value = {
+        "items": {
+            "zones/europe-west1-b": {
+                "instances": [
+                    {"name": "old-running-clash-job-1-abcd", "status": "RUNNING"},
+                    {"name": "old-stopped-clash-job-2-abcd", "status": "TERMINATED"},
+                ]
+            }
+        }
+    }
+    managers = compute.instanceGroupManagers.return_value
+    managers.aggregatedList.return_value.execute.side_effect = [
+        {
+            "items": {
+                "zones/europe-west1-b": {
+                    "instanceGroupManagers": [
+                        {
+                            "name": "old-running-clash-job-1",
+                            "creationTimestamp": created(48),
+                        },
+                        {
+                            "name": "old-stopped-clash-job-2",
+                            "creationTimestamp": created(48),
+                        },
+                    ]
+                }
+            },
+            "nextPageToken": "page-2",
+        },
+        {
+            "items": {
+                "zones/europe-west4-a": {
+                    "instanceGroupManagers": [
+                        {"name": "new-clash-job-3", "creationTimestamp": created(1)},
+                        {"name": "not-clash", "creationTimestamp": created(48)},
+                    ]
+                },
+                "zones/us-east1-b": {"warning": {"code": "NO_RESULTS_ON_PAGE"}},
+            }
+        },
+    ]
+    compute.instanceTemplates.return_value.list.return_value.execute.return_value = {
+        "items": [
+            {"name": "old-running-clash-job-1", "creationTimestamp": created(48)},
+            {"name": "old-stopped-clash-job-2", "creationTimestamp": created(48)},
+            {"name": "orphan-clash-job-4", "creationTimestamp": created(48)},
+            {"name": "new-clash-job-3", "creationTimestamp": created(1)},
+        ]
+    }
+    gcloud.get_subscriber.return_value.list_subscriptions.return_value = [
+        PubSubResource(
+            "projects/p/subscriptions/orphan-clash-job-4", pubsub_labels(48)
+        ),
+        PubSubResource("projects/p/subscriptions/recent-clash-job-5", pubsub_labels(1)),
+        PubSubResource("projects/p/subscriptions/legacy-clash-job-6", {}),
+        PubSubResource("projects/p/subscriptions/other", pubsub_labels(48)),
+    ]
+    gcloud.get_publisher.return_value.list_topics.return_value = [
+        PubSubResource("projects/p/topics/old-running-clash-job-1", pubsub_labels(48)),
+        PubSubResource("projects/p/topics/old-stopped-clash-job-2", pubsub_labels(48)),
+    ]
+    for operations in [compute.zoneOperations, compute.globalOperations]:
+        operations.return_value.get.return_value.execute.return_value = {
+            "status": "DONE"
+        }
+    return gcloud
+
+
+def names(resources):
+    return {(r["kind"], sweeper.job_name(r["name"])) for r in resources}
+
+
+def test_finds_stale_resources(gcloud):
+    stale = sweeper.ResourceSweeper("p", gcloud=gcloud).find_stale()
+
+    assert names(stale) == {
+        ("instance_group", "old-stopped-clash-job-2"),
+        ("instance_template", "old-stopped-clash-job-2"),
+        ("instance_template", "orphan-clash-job-4"),
+        ("subscription", "orphan-clash-job-4"),
+        ("topic", "old-stopped-clash-job-2"),
+    }
+    group = next(r for r in stale if r["kind"] == "instance_group")
+    assert group["zone"] == "europe-west1-b"
+    assert 47 * 3600 < group["age_seconds"] < 49 * 3600
+
+
+def test_unlabelled_pubsub_resources_are_optional(gcloud):
+    resources = sweeper.ResourceSweeper(
+        "p", gcloud=gcloud, include_unlabelled=True
+    ).find_stale()
+
+    assert ("subscription", "legacy-clash-job-6") in names(resources)
+
+
+def test_deletes_instance_groups_before_their_templates(gcloud):
+    compute = gcloud.get_compute_client.return_value
+    calls = []
+    compute.instanceGroupManagers.return_value.delete.side_effect = (
+        lambda **kwargs: calls.append(kwargs["instanceGroupManager"]) or MagicMock()
+    )
+    compute.instanceTemplates.return_value.delete.side_effect = (
+        lambda **kwargs: calls.append(kwargs["instanceTemplate"]) or MagicMock()
+    )
+
+    results = sweeper.ResourceSweeper("p", gcloud=gcloud).sweep()
+
+    assert calls[0] == "old-stopped-clash-job-2"
+    assert sorted(calls[1:]) == ["old-stopped-clash-job-2", "orphan-clash-job-4"]
+    assert all(r["deleted"] for r in results)
+    gcloud.get_publisher().delete_topic.assert_called_once_with(
+        "projects/p/topics/old-stopped-clash-job-2"
+    )
+
+
+def test_reports_resources_which_could_not_be_deleted(gcloud):
+    gcloud.get_subscriber().delete_subscription.side_effect = Exception("denied")
+    gcloud.get_publisher().delete_topic.side_effect = NotFound()
+
+    results = sweeper.ResourceSweeper("p", gcloud=gcloud).sweep()
+
+    failed = [r for r in results if not r["deleted"]]
+    assert names(failed) == {("subscription", "orphan-clash-job-4")}
+    assert failed[0]["error"] == "denied"
+
+
+def test_dry_run_deletes_nothing(gcloud):
+    sweeper.ResourceSweeper("p", gcloud=gcloud).sweep(dry_run=True)
+
+    gcloud.get_compute_client().instanceGroupManagers().delete.assert_not_called()
+    gcloud.get_subscriber().delete_subscription.assert_not_called()
+
+
+def test_gc_command(gcloud):
+    gcloud.get_subscriber().delete_subscription.side_effect = Exception("denied")
+
+    with patch("pyclash.cli.CloudSdk", return_value=gcloud):
+        result = CliRunner().invoke(cli.cli, ["gc", "--project", "p"])
+
+    assert result.exit_code == 1
+    lines = [json.loads(line) for line in result.output.splitlines()]
+    assert len(lines) == 5
+    assert lines[0]["kind"] == "instance_group"
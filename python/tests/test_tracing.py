@@ -0,0 +1,75 @@
+from mock import MagicMock
+import pytest
+
+from pyclash import tracing
+
+
+class RecordingInstrumentation(tracing.Instrumentation):
+    def __init__(self):
+        self.events = []
+
+    def on_span_start(self, span):
+        self.events.append(("start", span.name))
+
+    def on_span_end(self, span):
+        self.events.append(("end", span.name))
+
+
+def test_span_reports_start_and_end():
+    instrumentation = RecordingInstrumentation()
+
+    with tracing.span(instrumentation, "phase", "myjob") as span:
+        pass
+
+    assert instrumentation.events == [("start", "phase"), ("end", "phase")]
+    assert span.duration >= 0
+
+
+def test_span_records_errors():
+    collector = tracing.SpanCollector()
+
+    with pytest.raises(ValueError):
+        with tracing.span(collector, "phase", "myjob"):
+            raise ValueError("Failure!")
+
+    assert collector.spans[0].attributes["error"] == "Failure!"
+    assert collector.spans[0].end is not None
+
+
+def test_vm_spans_are_created_from_timings():
+    spans = tracing.vm_spans(
+        "myjob",
+        {
+            "image_pull": {"start": 110, "end": 150},
+            "boot": {"start": 100, "end": 110},
+        },
+    )
+
+    assert [(s.name, s.duration) for s in spans] == [
+        ("vm.boot", 10),
+        ("vm.image_pull", 40),
+    ]
+
+
+def test_collector_breaks_down_timings_per_job():
+    collector = tracing.SpanCollector()
+    collector.on_span_end(tracing.Span("phase", "job-a", 0, 1))
+    collector.on_span_end(tracing.Span("phase", "job-a", 2, 4))
+    collector.on_span_end(tracing.Span("phase", "job-b", 0, 8))
+
+    assert collector.breakdown("job-a") == {"phase": 3}
+    assert collector.breakdown() == {"phase": 11}
+
+
+def test_opentelemetry_exporter_uses_the_timestamps_of_the_span():
+    tracer = MagicMock()
+    exporter = tracing.OpenTelemetryExporter(tracer=tracer)
+
+    exporter.on_span_end(tracing.Span("phase", "myjob", 1, 2, {"zone": "a"}))
+
+    tracer.start_span.assert_called_with(
+        "phase",
+        start_time=1000000000,
+        attributes={"clash.job": "myjob", "clash.zone": "a"},
+    )
+    tracer.start_span.return_value.end.assert_called_with(end_time=2000000000)
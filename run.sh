@@ -3,7 +3,7 @@
 set -e
 
 function task_usage {
-  echo 'Usage: ./run.sh init | lint | build | unit-test | format | integration-test | package | release | deploy-airflow-plugin'
+  echo 'Usage: ./run.sh init | lint | build | unit-test | format | integration-test | benchmark | package | release | deploy-airflow-plugin'
   exit 1
 }
 
@@ -40,12 +40,17 @@ function task_lint {
 
 function task_format {
   cd python
-  (poetry install && poetry run black pyclash/ tests/)
+  (poetry install && poetry run black pyclash/ tests/ benchmarks/)
 }
 
 function task_unit_test {
   cd python
-  (poetry install && poetry run pytest tests/test_clash.py "$@")
+  (poetry install && poetry run pytest tests/ "$@")
+}
+
+function task_benchmark {
+  cd python
+  (poetry install && poetry run python -m benchmarks.control_plane "$@")
 }
 
 function task_build_image {
@@ -97,6 +102,7 @@ case "$cmd" in
   lint) task_lint ;;
   unit-test) task_unit_test "$@" ;;
   integration-test) task_integration_test ;;
+  benchmark) task_benchmark "$@" ;;
   build-image) task_build_image ;;
   format) task_format ;;
   package) task_package ;;